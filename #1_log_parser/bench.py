@@ -0,0 +1,397 @@
+"""
+Synthetic traffic generator and benchmark of log parser stages
+
+    python bench.py generate --count 1000000 --format ndjson --output logs.ndjson
+    python bench.py run --count 1000000 --output bench.json
+    python bench.py attribution --count 10000000 --no-baseline
+
+Benchmark results are json, so they can be stored and compared between versions
+"""
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing as T
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ingest import DATE_FORMAT, deserialize_log, deserialize_row, iter_json_objects, iter_log_records, parse_epoch_us
+from binlog import BinaryLog, write_binary_log
+from lib import SALE_LOCATION, LogBatch, RefererClassifier, Solution, as_numpy
+from pipeline import LogPipeline
+
+# --- CONSTANTS ---
+FORMATS = ("json", "ndjson", "columnar")
+STARTED_AT = datetime(2019, 10, 1)
+USER_AGENTS = ("Firefox 59", "Chrome 65", "Safari 12", "Edge 18")
+OUR_REFERERS = ("https://referal.ours.com/?ref={}",)
+COMPETITOR_REFERERS = ("https://ad.theirs1.com/?src={}", "http://theirs1.com/?ref={}")
+ORGANIC_REFERERS = ("https://yandex.ru/search/?q={}", "https://www.google.com/search?q={}", None)
+SHOP_LOCATIONS = ("https://shop.com/", "https://shop.com/products/?id={}", "https://shop.com/cart")
+
+
+# --- GENERATOR ---
+def generate_logs(
+        count: int,
+        clients: int = 10000,
+        our_share: float = 0.05,
+        competitor_share: float = 0.05,
+        organic_share: float = 0.2,
+        sale_share: float = 0.02,
+        days: float = 1,
+        seed: int = 0
+) -> T.Iterator[T.Dict]:
+    """
+    Generate raw log objects in the format of logs.json, ordered by time
+
+    :param count: number of records
+    :param clients: number of distinct clients
+    :param our_share: share of records with our affiliate referer
+    :param competitor_share: share of records with competitor affiliate referer
+    :param organic_share: share of records with search engine or without referer
+    :param sale_share: share of checkout records, rest are internal shop transitions
+    :param days: time spread of records
+    :param seed: random seed
+    :return: iterator over log objects
+    """
+    generator = random.Random(seed)
+    step = days * 24 * 3600 / max(count, 1)
+    created_at = STARTED_AT
+    kinds = ("ours", "competitor", "organic", "sale", "internal")
+    weights = (our_share, competitor_share, organic_share, sale_share,
+               max(1 - our_share - competitor_share - organic_share - sale_share, 0))
+
+    for index in range(count):
+        created_at += timedelta(seconds=generator.expovariate(1 / step) if step else 0)
+        client = generator.randrange(clients)
+        kind = generator.choices(kinds, weights)[0]
+        location = generator.choice(SHOP_LOCATIONS).format(index)
+
+        if kind == "ours":
+            referer = generator.choice(OUR_REFERERS).format(index)
+        elif kind == "competitor":
+            referer = generator.choice(COMPETITOR_REFERERS).format(index)
+        elif kind == "organic":
+            referer = generator.choice(ORGANIC_REFERERS)
+            referer = referer and referer.format(index)
+        elif kind == "sale":
+            location, referer = SALE_LOCATION, "https://shop.com/cart"
+        else:
+            referer = generator.choice(SHOP_LOCATIONS).format(index)
+
+        yield {
+            "client_id": f"user{client}",
+            "User-Agent": USER_AGENTS[client % len(USER_AGENTS)],
+            "document.location": location,
+            "document.referer": referer,
+            "date": created_at.strftime(DATE_FORMAT),
+        }
+
+
+def write_logs(logs: T.Iterable[T.Dict], path: str, file_format: str):
+    """
+    :param logs: raw log objects
+    :param path: output path
+    :param file_format: json - json array, ndjson - one object per line, columnar - serialized LogBatch
+    """
+    if file_format == "columnar":
+        with open(path, "wb") as f:
+            f.write(LogBatch.from_records(map(deserialize_log, logs)).to_bytes())
+        return
+
+    with open(path, "w", encoding="utf-8") as f:
+        separator = "\n" if file_format == "ndjson" else ",\n"
+        if file_format == "json":
+            f.write("[\n")
+
+        for index, log in enumerate(logs):
+            if index:
+                f.write(separator)
+            f.write(json.dumps(log, ensure_ascii=False))
+
+        f.write("\n]\n" if file_format == "json" else "\n")
+
+
+# --- HARNESS ---
+def measure(stage: T.Callable[[], T.Any], rows: int, memory: bool = True) -> T.Dict[str, float]:
+    """
+    Time stage and, in separate run, measure its peak python memory allocations with tracemalloc,
+    which is too slow to be enabled while timing
+    """
+    started_at = time.perf_counter()
+    stage()
+    seconds = time.perf_counter() - started_at
+
+    result = {"seconds": seconds, "rows_per_second": rows / seconds if seconds else None}
+
+    if memory:
+        tracemalloc.start()
+        try:
+            stage()
+            result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def consume(iterator: T.Iterable):
+    for _ in iterator:
+        pass
+
+
+def environment() -> T.Dict[str, T.Any]:
+    return {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_benchmark(count: int, workers: int = 2, memory: bool = True, **generator_options) -> T.Dict:
+    """
+    Benchmark ingestion, timestamp parsing, referer classification and attribution separately
+
+    :param count: number of generated records
+    :param workers: workers of sharded attribution
+    :param memory: measure peak memory of stages
+    :param generator_options: options of generate_logs
+    :return: json serializable results
+    """
+    logs = list(generate_logs(count, **generator_options))
+    records = [deserialize_log(log) for log in logs]
+    batch = LogBatch.from_records(records)
+    dates = [log["date"] for log in logs]
+    referers = [log["document.referer"] for log in logs if log["document.referer"] is not None]
+
+    results: T.Dict[str, T.Dict[str, float]] = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for file_format in ("json", "ndjson"):
+            path = os.path.join(directory, f"logs.{file_format}")
+            write_logs(logs, path, file_format)
+            results[f"ingestion.{file_format}"] = measure(lambda: consume(iter_log_records(path)), count, memory)
+
+        gzip_path = os.path.join(directory, "logs.ndjson.gz")
+        with open(os.path.join(directory, "logs.ndjson"), "rb") as source, gzip.open(gzip_path, "wb") as target:
+            shutil.copyfileobj(source, target)
+
+        for parsers in (0, workers):
+            results[f"ingestion.pipeline.ndjson_gzip.{parsers}_parsers"] = measure(
+                lambda: consume(LogPipeline([gzip_path], parsers)), count, memory
+            )
+
+    text = json.dumps(logs)
+    results["ingestion.decode_only"] = measure(lambda: consume(iter_json_objects(io.StringIO(text))), count, memory)
+    results["ingestion.columnar_batch"] = measure(lambda: LogBatch.from_records(records), count, memory)
+
+    results["timestamps.strptime"] = measure(lambda: [datetime.strptime(date, DATE_FORMAT) for date in dates],
+                                             count, memory)
+    results["timestamps.fast"] = measure(lambda: [parse_epoch_us(date) for date in dates], count, memory)
+
+    results["referers.cold_cache"] = measure(lambda: list(map(RefererClassifier().classify, referers)),
+                                             len(referers), memory)
+    classifier = RefererClassifier()
+    results["referers.warm_cache"] = measure(lambda: list(map(classifier.classify, referers)), len(referers), memory)
+
+    results["attribution.sorted"] = measure(lambda: Solution.with_attribution_approach(records), count, memory)
+    results["attribution.streaming"] = measure(lambda: consume(Solution.streaming(records)), count, memory)
+    results["attribution.columnar"] = measure(lambda: Solution.columnar(batch), count, memory)
+    results["attribution.vectorized"] = measure(lambda: Solution.vectorized(batch), count, memory)
+    results["attribution.sharded"] = measure(lambda: Solution.sharded(records, workers), count, memory)
+
+    return {
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "environment": environment(),
+        "parameters": {"count": count, "workers": workers, **generator_options},
+        "results": results,
+    }
+
+
+def shuffle_batch(batch: LogBatch, seed: int = 0) -> LogBatch:
+    """
+    Rows of batch in random order, string tables are shared
+    """
+    order = np.random.default_rng(seed).permutation(len(batch))
+
+    shuffled = LogBatch()
+    shuffled.clients, shuffled.locations, shuffled.referers, shuffled.hosts = batch.tables
+    for name, dtype in (("created_at", np.int64), ("client", np.int32), ("location", np.int32),
+                        ("referer", np.int32), ("host", np.int32)):
+        setattr(shuffled, name, as_numpy(getattr(batch, name), dtype)[order])
+
+    return shuffled
+
+
+def run_attribution_benchmark(count: int, baseline: bool = True, **generator_options) -> T.Dict:
+    """
+    Vectorized against sorted attribution on large input. Batch is built directly from generated logs and
+    records for sorted solution are built only if baseline is measured, because they take most of memory.
+    Generated logs are in time order, which favours sort of both solutions, so both are measured on shuffled
+    rows as well, like logs collected from many servers
+
+    :param count: number of generated records
+    :param baseline: measure sorted solution too
+    :param generator_options: options of generate_logs
+    :return: json serializable results
+    """
+    batch = LogBatch()
+    for log in generate_logs(count, **generator_options):
+        batch.append(*deserialize_row(log))
+
+    shuffled = shuffle_batch(batch)
+    results = {
+        "attribution.vectorized": measure(lambda: Solution.vectorized(batch), count, memory=False),
+        "attribution.vectorized.shuffled": measure(lambda: Solution.vectorized(shuffled), count, memory=False),
+    }
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "logs.bin")
+        write_binary_log(batch, path)
+
+        def binary_log_stage():
+            with BinaryLog(path) as binary_log:
+                return [row.to_record() for row in Solution.vectorized(binary_log.batch)]
+
+        results["attribution.binary_log"] = measure(binary_log_stage, count, memory=False)
+    finally:
+        shutil.rmtree(directory)
+
+    if baseline:
+        records = [row.to_record() for row in batch]
+        results["attribution.sorted"] = measure(
+            lambda: Solution.with_attribution_approach(records), count, memory=False
+        )
+        results["speedup"] = results["attribution.sorted"]["seconds"] / results["attribution.vectorized"]["seconds"]
+
+        records = [row.to_record() for row in shuffled]
+        results["attribution.sorted.shuffled"] = measure(
+            lambda: Solution.with_attribution_approach(records), count, memory=False
+        )
+        results["speedup.shuffled"] = results["attribution.sorted.shuffled"]["seconds"] / \
+            results["attribution.vectorized.shuffled"]["seconds"]
+
+    return {
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "environment": environment(),
+        "parameters": {"count": count, **generator_options},
+        "results": results,
+    }
+
+
+# --- TESTS ---
+class TestBench:
+    def test_generate_logs(self):
+        logs = list(generate_logs(1000, clients=10, seed=1))
+
+        assert logs == list(generate_logs(1000, clients=10, seed=1))
+        assert len({log["client_id"] for log in logs}) == 10
+        assert [log["date"] for log in logs] == sorted(log["date"] for log in logs)
+        assert any(log["document.location"] == SALE_LOCATION for log in logs)
+
+        records = [deserialize_log(log) for log in logs]
+        assert Solution.with_attribution_approach(records), "generated traffic must have our sales"
+
+    def test_write_logs(self, tmp_path):
+        logs = list(generate_logs(100))
+
+        for file_format in ("json", "ndjson"):
+            path = str(tmp_path / f"logs.{file_format}")
+            write_logs(logs, path, file_format)
+            assert list(iter_log_records(path)) == [deserialize_log(log) for log in logs]
+
+        path = str(tmp_path / "logs.columnar")
+        write_logs(logs, path, "columnar")
+        with open(path, "rb") as f:
+            assert [row.to_record() for row in LogBatch.from_bytes(f.read())] == [deserialize_log(log) for log in logs]
+
+    def test_run_benchmark(self):
+        report = run_benchmark(200, workers=2, memory=False, clients=20)
+
+        json.dumps(report)
+        assert report["parameters"]["clients"] == 20
+        assert all(result["seconds"] >= 0 for result in report["results"].values())
+
+    def test_run_attribution_benchmark(self):
+        report = run_attribution_benchmark(200, clients=20)
+
+        json.dumps(report)
+        assert report["results"]["speedup"] > 0
+        assert report["results"]["attribution.binary_log"]["seconds"] > 0
+        assert report["results"]["speedup.shuffled"] > 0
+
+    def test_shuffle_batch(self):
+        batch = LogBatch.from_records(deserialize_log(log) for log in generate_logs(500, clients=10, seed=3))
+        shuffled = shuffle_batch(batch)
+
+        assert [row.to_record() for row in shuffled] != [row.to_record() for row in batch]
+        assert sorted(map(repr, (row.to_record() for row in shuffled))) == \
+            sorted(map(repr, (row.to_record() for row in batch)))
+        assert sorted(map(repr, (row.to_record() for row in Solution.vectorized(shuffled)))) == \
+            sorted(map(repr, (row.to_record() for row in Solution.vectorized(batch))))
+        assert "attribution.sorted" not in run_attribution_benchmark(200, baseline=False)["results"]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Log parser benchmark")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    for command in ("generate", "run", "attribution"):
+        subparser = commands.add_parser(command)
+        subparser.add_argument("--count", type=int, default=100000, help="number of records")
+        subparser.add_argument("--clients", type=int, default=10000, help="number of distinct clients")
+        subparser.add_argument("--our-share", type=float, default=0.05)
+        subparser.add_argument("--competitor-share", type=float, default=0.05)
+        subparser.add_argument("--organic-share", type=float, default=0.2)
+        subparser.add_argument("--sale-share", type=float, default=0.02)
+        subparser.add_argument("--days", type=float, default=1, help="time spread of records")
+        subparser.add_argument("--seed", type=int, default=0)
+
+        if command == "generate":
+            subparser.add_argument("--format", choices=FORMATS, default="json")
+            subparser.add_argument("--output", required=True)
+        elif command == "attribution":
+            subparser.add_argument("--no-baseline", action="store_true", help="skip sorted solution, saves memory")
+            subparser.add_argument("--output", default=None, help="results path, stdout by default")
+        else:
+            subparser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+            subparser.add_argument("--no-memory", action="store_true", help="skip memory profiling")
+            subparser.add_argument("--output", default=None, help="results path, stdout by default")
+
+    args = parser.parse_args()
+    options = {
+        "clients": args.clients,
+        "our_share": args.our_share,
+        "competitor_share": args.competitor_share,
+        "organic_share": args.organic_share,
+        "sale_share": args.sale_share,
+        "days": args.days,
+        "seed": args.seed,
+    }
+
+    if args.command == "generate":
+        write_logs(generate_logs(args.count, **options), args.output, args.format)
+    else:
+        if args.command == "attribution":
+            report = json.dumps(run_attribution_benchmark(args.count, not args.no_baseline, **options), indent=2)
+        else:
+            report = json.dumps(run_benchmark(args.count, args.workers, not args.no_memory, **options), indent=2)
+
+        if args.output is None:
+            print(report)
+        else:
+            with open(args.output, "w") as f:
+                f.write(report + "\n")
@@ -0,0 +1,304 @@
+"""
+Binary columnar log format for repeated attribution queries over the same logs
+
+File layout, all numbers are little-endian, sections are aligned to 8 bytes:
+- header: magic, number of rows, (offset, size) of each section
+- columns: created_at int64, client int32, location int32, referer int32, host int32; rows are sorted by
+  (client, created_at), so rows of one client are contiguous
+- client index: int64 offsets of first row of each client, clients count + 1 values
+- string tables of clients (sorted), locations, referers and hosts: count, uint64 offsets and utf-8 blob
+
+File is opened with mmap and columns are zero-copy numpy views, so opening does not depend on file size.
+Query of single client reads only its rows and strings, which they reference
+"""
+import mmap
+import struct
+import typing as T
+from datetime import timedelta
+
+import numpy as np
+
+from lib import NO_CODE, LogBatch, LogRecord, RefererClassifier, Solution, StringTable, as_numpy
+
+# --- CONSTANTS ---
+MAGIC = b"LOGBIN01"
+COLUMNS = (("created_at", np.int64), ("client", np.int32), ("location", np.int32), ("referer", np.int32),
+           ("host", np.int32))
+TABLES = ("clients", "locations", "referers", "hosts")
+SECTIONS = len(COLUMNS) + 1 + len(TABLES)  # columns, client index, string tables
+HEADER = struct.Struct(f"<8sQ{SECTIONS * 2}Q")
+ALIGNMENT = 8
+
+
+# --- TYPES ---
+class MappedStringTable:
+    """
+    Read only StringTable over mapped file, strings are decoded on access
+    """
+    __slots__ = ("offsets", "blob", "_values", "_codes")
+
+    def __init__(self, buffer: memoryview):
+        count, = struct.unpack_from("<Q", buffer)
+        self.offsets = np.frombuffer(buffer, dtype=np.uint64, count=count + 1, offset=8)
+        self.blob = buffer[8 * (count + 2):]
+        self._values: T.Optional[T.List[str]] = None
+        self._codes: T.Optional[T.Dict[str, int]] = None
+
+    def __getitem__(self, code: int) -> str:
+        return str(self.blob[int(self.offsets[code]):int(self.offsets[code + 1])], "utf-8")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def values(self) -> T.List[str]:
+        if self._values is None:
+            self._values = [self[code] for code in range(len(self))]
+
+        return self._values
+
+    @property
+    def codes(self) -> T.Dict[str, int]:
+        if self._codes is None:
+            self._codes = {value: code for code, value in enumerate(self.values)}
+
+        return self._codes
+
+    def find_sorted(self, value: str) -> int:
+        """
+        Binary search of value in sorted table without decoding whole table
+
+        :return: code of value or NO_CODE
+        """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low if low < len(self) and self[low] == value else NO_CODE
+
+
+class BinaryLog:
+    """
+    Memory mapped binary log, see module docstring. Columns and rows of its batches are views of mapped file,
+    which keep it mapped after close until they are freed
+
+        with BinaryLog(path) as binary_log:
+            our_sales = [row.to_record() for row in Solution.vectorized(binary_log.client_batch(client_id))]
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+
+        magic, self.size, *sections = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not binary log")
+
+        sections = [self.buffer[offset:offset + size] for offset, size in zip(sections[::2], sections[1::2])]
+
+        self.batch = LogBatch()
+        for (name, dtype), section in zip(COLUMNS, sections):
+            setattr(self.batch, name, np.frombuffer(section, dtype=dtype))
+        for name, section in zip(TABLES, sections[len(COLUMNS) + 1:]):
+            setattr(self.batch, name, MappedStringTable(section))
+
+        self.index = np.frombuffer(sections[len(COLUMNS)], dtype=np.int64)
+
+    def client_batch(self, client_id: str) -> LogBatch:
+        """
+        Rows of single client found by client index without scanning the file. String columns are encoded by
+        tables of only referenced strings, so nothing else of mapped string tables is decoded
+
+        :param client_id: LogRecord.id
+        :return: batch of client rows, empty if client is unknown
+        """
+        code = self.batch.clients.find_sorted(client_id)
+        start, end = (0, 0) if code == NO_CODE else (int(self.index[code]), int(self.index[code + 1]))
+
+        batch = LogBatch()
+        batch.created_at = self.batch.created_at[start:end]
+        batch.client = np.zeros(end - start, dtype=np.int32)
+        batch.clients = StringTable([] if code == NO_CODE else [client_id])
+
+        for column, table in (("location", "locations"), ("referer", "referers"), ("host", "hosts")):
+            codes, strings = _reencode(getattr(self.batch, column)[start:end], getattr(self.batch, table))
+            setattr(batch, column, codes)
+            setattr(batch, table, strings)
+
+        return batch
+
+    def close(self):
+        """
+        Unmap file, or let the last of still referenced views of its batches unmap it when it is freed
+        """
+        self.batch = self.index = None
+        try:
+            self.buffer.release()
+            self.mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self) -> "BinaryLog":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# --- UTILS ---
+def is_binary_log(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _reencode(codes: np.ndarray, table: MappedStringTable) -> T.Tuple[np.ndarray, StringTable]:
+    """
+    :param codes: dictionary encoded column, NO_CODE is kept
+    :return: codes of column in new table, table of strings referenced by column
+    """
+    is_set = codes != NO_CODE
+    referenced, inverse = np.unique(codes[is_set], return_inverse=True)
+
+    column = np.full(len(codes), NO_CODE, dtype=np.int32)
+    column[is_set] = inverse.reshape(-1)
+
+    return column, StringTable(table[int(code)] for code in referenced)
+
+
+def _encode_table(values: T.List[str]) -> bytes:
+    encoded = [value.encode() for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+
+    return struct.pack("<Q", len(encoded)) + offsets.tobytes() + b"".join(encoded)
+
+
+def write_binary_log(batch: LogBatch, path: str):
+    """
+    :param batch: columnar log records
+    :param path: output path
+    """
+    # clients are renumbered in sorted order of ids, so client code can be found by binary search
+    client_order = sorted(range(len(batch.clients)), key=batch.clients.__getitem__)
+    client_codes = np.empty(len(client_order), dtype=np.int32)
+    client_codes[client_order] = np.arange(len(client_order), dtype=np.int32)
+
+    columns = {name: as_numpy(getattr(batch, name), dtype) for name, dtype in COLUMNS}
+    columns["client"] = client_codes[columns["client"]]
+    order = np.lexsort((columns["created_at"], columns["client"]))
+
+    index = np.zeros(len(client_order) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns["client"], minlength=len(client_order)), out=index[1:])
+
+    sections = [columns[name][order].tobytes() for name, _ in COLUMNS]
+    sections.append(index.tobytes())
+    sections.append(_encode_table([batch.clients[code] for code in client_order]))
+    sections.extend(_encode_table(list(getattr(batch, name).values)) for name in TABLES[1:])
+
+    layout = []
+    offset = HEADER.size
+    for section in sections:
+        offset += -offset % ALIGNMENT
+        layout.extend((offset, len(section)))
+        offset += len(section)
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(batch), *layout))
+        for section_offset, section in zip(layout[::2], sections):
+            f.write(b"\0" * (section_offset - f.tell()))
+            f.write(section)
+
+
+def convert(log_records: T.Iterable[LogRecord], path: str):
+    """
+    One time conversion of log records to binary log
+    """
+    write_binary_log(LogBatch.from_records(log_records), path)
+
+
+# --- TESTS ---
+class TestBinaryLog:
+    @classmethod
+    def get_records(cls) -> T.List[LogRecord]:
+        from bench import generate_logs
+        from ingest import deserialize_log
+
+        return [deserialize_log(log) for log in generate_logs(2000, clients=50, seed=2)]
+
+    def test_round_trip(self, tmp_path):
+        path = str(tmp_path / "logs.bin")
+        records = self.get_records()
+        convert(records, path)
+
+        assert is_binary_log(path)
+        with BinaryLog(path) as binary_log:
+            assert len(binary_log.batch) == len(records)
+            assert sorted((row.id, row.created_at) for row in binary_log.batch) == \
+                sorted((record.id, record.created_at) for record in records)
+            assert sorted(map(repr, (row.to_record() for row in binary_log.batch))) == sorted(map(repr, records))
+
+        assert binary_log.mmap.closed
+
+    def test_attribution(self, tmp_path):
+        path = str(tmp_path / "logs.bin")
+        records = self.get_records()
+        convert(records, path)
+
+        with BinaryLog(path) as binary_log:
+            for classifier, window in (
+                    (None, timedelta(hours=24)),
+                    (None, timedelta(minutes=5)),
+                    (
+                        RefererClassifier(our_domains={"theirs1.com"}, competitor_domains={"referal.ours.com"}),
+                        timedelta(hours=24)
+                    ),
+            ):
+                expected = [row.to_record() for row in Solution.vectorized(LogBatch.from_records(records), classifier,
+                                                                           window)]
+
+                assert expected
+                assert [row.to_record() for row in Solution.vectorized(binary_log.batch, classifier, window)] == \
+                    expected
+
+    def test_client_batch(self, tmp_path):
+        path = str(tmp_path / "logs.bin")
+        records = self.get_records()
+        convert(records, path)
+
+        our_sales = [row.to_record() for row in Solution.vectorized(LogBatch.from_records(records))]
+
+        with BinaryLog(path) as binary_log:
+            for client_id in sorted({record.id for record in records}):
+                client_records = [
+                    row.to_record() for row in Solution.vectorized(binary_log.client_batch(client_id))
+                ]
+                assert [row.to_record() for row in binary_log.client_batch(client_id)] == sorted(
+                    (record for record in records if record.id == client_id), key=lambda record: record.created_at
+                )
+
+                # string tables of the whole file are not decoded
+                assert all(getattr(binary_log.batch, name)._values is None for name in TABLES[1:])
+
+                assert client_records == [record for record in our_sales if record.id == client_id]
+
+            assert len(binary_log.client_batch("unknown")) == 0
+            assert Solution.vectorized(binary_log.client_batch("unknown")) == []
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from pipeline import LogPipeline
+
+    parser = argparse.ArgumentParser(description="Convert logs to binary log")
+    parser.add_argument("input", nargs="+", help="logs files or glob patterns - json array or NDJSON, plain, gzip or "
+                                                 "zstd compressed")
+    parser.add_argument("output", help="binary log path")
+    args = parser.parse_args()
+
+    convert(LogPipeline(args.input), args.output)
@@ -0,0 +1,233 @@
+import heapq
+import os
+import sqlite3
+import typing as T
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from lib import (
+    ATTRIBUTION_WINDOW,
+    SALE_LOCATION,
+    STREAM_LATENESS,
+    LogRecord,
+    RefererClassifier,
+    StreamingAttribution,
+    from_epoch_us,
+    to_epoch_us,
+)
+
+# --- CONSTANTS ---
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE clicks (client_id TEXT PRIMARY KEY, clicked_at INTEGER NOT NULL);
+CREATE TABLE pending (
+    sequence INTEGER PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    location TEXT NOT NULL,
+    referer TEXT
+);
+"""
+
+
+# --- UTILS ---
+def load_state(
+        path: str,
+        classifier: T.Optional[RefererClassifier] = None,
+        window: T.Optional[timedelta] = None,
+        lateness: T.Optional[timedelta] = None
+) -> StreamingAttribution:
+    """
+    Restore streaming attribution from snapshot: our clicks inside attribution window and records from reorder
+    buffer, which are not processed yet (unresolved sales among them)
+
+    :param path: snapshot path, fresh state is returned if it does not exist
+    :param classifier: referer classifier, default_classifier by default
+    :param window: attribution window, window of snapshot or ATTRIBUTION_WINDOW by default
+    :param lateness: reorder buffer lateness, lateness of snapshot or STREAM_LATENESS by default
+    :return: streaming attribution engine
+    """
+    if not os.path.exists(path):
+        return StreamingAttribution(
+            classifier,
+            timedelta(hours=ATTRIBUTION_WINDOW) if window is None else window,
+            timedelta(hours=STREAM_LATENESS) if lateness is None else lateness
+        )
+
+    connection = sqlite3.connect(path)
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM meta"))
+        # snapshots of older versions have no settings
+        engine = StreamingAttribution(
+            classifier,
+            timedelta(microseconds=meta.get("window_us", ATTRIBUTION_WINDOW * 3600 * 10 ** 6)) if window is None
+            else window,
+            timedelta(microseconds=meta.get("lateness_us", STREAM_LATENESS * 3600 * 10 ** 6)) if lateness is None
+            else lateness
+        )
+        engine.sequence = meta["sequence"]
+        engine.clicks = OrderedDict(
+            (client_id, from_epoch_us(clicked_at))
+            for client_id, clicked_at in connection.execute(
+                "SELECT client_id, clicked_at FROM clicks ORDER BY clicked_at"
+            )
+        )
+        for sequence, client_id, created_at, location, referer in connection.execute(
+                "SELECT sequence, client_id, created_at, location, referer FROM pending"
+        ):
+            record = LogRecord(id=client_id, created_at=from_epoch_us(created_at), location=location, referer=referer)
+            engine.pending.append((record.created_at, sequence, record))
+        heapq.heapify(engine.pending)
+    finally:
+        connection.close()
+
+    return engine
+
+
+def save_state(engine: StreamingAttribution, path: str):
+    """
+    Save snapshot of streaming attribution. Snapshot is written to temporary file and atomically replaces previous one,
+    so interrupted run leaves previous snapshot untouched
+
+    :param engine: streaming attribution engine
+    :param path: snapshot path
+    """
+    temporary_path = path + ".tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+
+    connection = sqlite3.connect(temporary_path)
+    try:
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", (
+                ("sequence", engine.sequence),
+                ("window_us", engine.window // timedelta(microseconds=1)),
+                ("lateness_us", engine.lateness // timedelta(microseconds=1)),
+            ))
+            connection.executemany(
+                "INSERT INTO clicks (client_id, clicked_at) VALUES (?, ?)",
+                ((client_id, to_epoch_us(clicked_at)) for client_id, clicked_at in engine.clicks.items())
+            )
+            connection.executemany(
+                "INSERT INTO pending (sequence, client_id, created_at, location, referer) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (sequence, record.id, to_epoch_us(created_at), record.location, record.referer)
+                    for created_at, sequence, record in engine.pending
+                )
+            )
+    finally:
+        connection.close()
+
+    os.replace(temporary_path, path)
+
+
+def run_incremental(
+        log_records: T.Iterable[LogRecord],
+        state_path: str,
+        classifier: T.Optional[RefererClassifier] = None,
+        flush: bool = False,
+        window: T.Optional[timedelta] = None,
+        lateness: T.Optional[timedelta] = None
+) -> T.List[LogRecord]:
+    """
+    Process only new records on top of saved attribution state, so clicks from previous runs still win
+    sales from this one. Window and lateness are saved with state, so resumed run keeps them
+
+    :param log_records: new log records
+    :param state_path: snapshot path
+    :param classifier: referer classifier, default_classifier by default
+    :param flush: release all buffered records at the end of run instead of keeping them for the next run
+    :param window: attribution window, see load_state
+    :param lateness: reorder buffer lateness, see load_state
+    :return: sales won by our links, which became known in this run
+    """
+    engine = load_state(state_path, classifier, window, lateness)
+    result: T.List[LogRecord] = []
+
+    for record in log_records:
+        result.extend(engine.feed(record))
+
+    if flush:
+        result.extend(engine.flush())
+
+    save_state(engine, state_path)
+
+    return result
+
+
+# --- TESTS ---
+datetime_format = "%Y-%m-%d %H:%M:%S"
+
+
+def click(client_id: str, created_at: str, referer: str = "https://referal.ours.com/?ref=123hexcode") -> LogRecord:
+    return LogRecord(
+        id=client_id,
+        created_at=datetime.strptime(created_at, datetime_format),
+        location="https://shop.com",
+        referer=referer
+    )
+
+
+def sale(client_id: str, created_at: str) -> LogRecord:
+    return LogRecord(
+        id=client_id,
+        created_at=datetime.strptime(created_at, datetime_format),
+        location=SALE_LOCATION,
+        referer="https://shop.com/cart"
+    )
+
+
+class TestIncrementalAttribution:
+    def test_click_and_sale_in_different_runs(self, tmp_path):
+        state_path = str(tmp_path / "state.sqlite")
+
+        assert run_incremental([
+            click("1", "2019-10-01 23:00:00"),
+            click("2", "2019-10-01 23:10:00"),
+            click("2", "2019-10-01 23:20:00", referer="http://theirs1.com/?ref=123hexcode"),
+        ], state_path) == []
+
+        won = run_incremental([
+            sale("1", "2019-10-02 01:00:00"),
+            sale("2", "2019-10-02 01:00:00"),
+        ], state_path, flush=True)
+
+        assert [record.id for record in won] == ["1"]
+
+    def test_pending_records_are_kept(self, tmp_path):
+        state_path = str(tmp_path / "state.sqlite")
+
+        assert run_incremental([sale("1", "2019-10-01 09:00:00")], state_path) == []
+        assert len(load_state(state_path).pending) == 1
+
+        # late click arrived in the next chunk still resolves the sale
+        won = run_incremental([click("1", "2019-10-01 08:30:00")], state_path, flush=True)
+
+        assert [record.id for record in won] == ["1"]
+        assert load_state(state_path).pending == []
+
+    def test_expired_clicks_are_not_saved(self, tmp_path):
+        state_path = str(tmp_path / "state.sqlite")
+
+        run_incremental([click("1", "2019-10-01 08:00:00"), click("2", "2019-10-02 09:00:00")], state_path, flush=True)
+
+        assert list(load_state(state_path).clicks) == ["2"]
+        assert run_incremental([sale("1", "2019-10-02 10:00:00")], state_path, flush=True) == []
+
+    def test_settings_are_resumed(self, tmp_path):
+        state_path = str(tmp_path / "state.sqlite")
+        window, lateness = timedelta(hours=1), timedelta(minutes=30)
+
+        assert run_incremental([click("1", "2019-10-01 08:00:00")], state_path, window=window,
+                               lateness=lateness) == []
+
+        engine = load_state(state_path)
+        assert (engine.window, engine.lateness) == (window, lateness)
+
+        # click is older than resumed window of 1 hour, but inside default window of 24 hours
+        won = run_incremental([sale("1", "2019-10-01 10:00:00"), click("2", "2019-10-01 10:30:00"),
+                               sale("2", "2019-10-01 11:00:00")], state_path, flush=True)
+        assert [record.id for record in won] == ["2"]
+
+        assert load_state(state_path, window=timedelta(hours=24)).window == timedelta(hours=24)
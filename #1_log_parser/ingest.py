@@ -0,0 +1,286 @@
+import io
+import json
+import os
+import re
+import typing as T
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from lib import LogRecord, from_epoch_us, to_epoch_us
+
+# --- CONSTANTS ---
+READ_CHUNK_SIZE = 1 << 20  # characters
+MAX_OBJECT_SIZE = 1 << 26  # characters of single log record
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+DATE_CACHE_SIZE = 1024  # distinct days
+
+_ISO_DATETIME = re.compile(r'(\d{4}-\d{2}-\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?Z', re.ASCII)
+
+_WHITESPACE = re.compile(r'\s*')
+# decoder reports object cut by end of buffer as unterminated string or as error this close to the end of buffer -
+# cut literal, number or \\uXXXX escape
+_TRUNCATION_TAIL = 6
+
+
+# --- UTILS ---
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _date_epoch_us(date: str) -> int:
+    return to_epoch_us(datetime(int(date[:4]), int(date[5:7]), int(date[8:10])))
+
+
+def _parse_datetime_slow(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+def parse_epoch_us(value: str) -> int:
+    """
+    Fast parser of fixed ISO-8601 format of logs - "YYYY-MM-DDTHH:MM:SS[.fraction]Z" with up to 9 fraction digits
+    (truncated to microseconds). Logs are clustered by day, so date part is cached. Values in other formats go
+    through strptime / fromisoformat
+
+    :param value: datetime string
+    :return: epoch microseconds
+    """
+    match = _ISO_DATETIME.fullmatch(value)
+    if match is not None:
+        date, hours, minutes, seconds, fraction = match.groups()
+        hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+
+        if hours < 24 and minutes < 60 and seconds < 60:
+            try:
+                day = _date_epoch_us(date)
+            except ValueError:
+                pass
+            else:
+                microseconds = int(fraction[:6].ljust(6, "0")) if fraction else 0
+                return day + ((hours * 60 + minutes) * 60 + seconds) * 1000000 + microseconds
+
+    return to_epoch_us(_parse_datetime_slow(value))
+
+
+def parse_datetime(value: str, aware: bool = False) -> datetime:
+    """
+    :param value: datetime string, see parse_epoch_us
+    :param aware: return datetime with UTC timezone instead of naive one
+    :return: datetime
+    """
+    parsed = from_epoch_us(parse_epoch_us(value))
+
+    return parsed.replace(tzinfo=timezone.utc) if aware else parsed
+
+
+def deserialize_row(log: T.Dict) -> T.Tuple[str, int, str, T.Optional[str]]:
+    """
+    Cheap to pickle form of log record
+
+    :return: client id, epoch microseconds of creation, location and referer - arguments of LogBatch.append
+    """
+    return (
+        log["client_id"] + '-' + log["User-Agent"],  # is this pair true client / device identifier ?
+        parse_epoch_us(log["date"]),
+        log["document.location"],
+        log.get("document.referer"),
+    )
+
+
+def deserialize_log(log: T.Dict) -> LogRecord:
+    client_id, created_at, location, referer = deserialize_row(log)
+    return LogRecord(id=client_id, created_at=from_epoch_us(created_at), location=location, referer=referer)
+
+
+def _is_truncated(error: json.JSONDecodeError) -> bool:
+    return error.msg.startswith("Unterminated string") or len(error.doc) - error.pos <= _TRUNCATION_TAIL
+
+
+def iter_json_objects(
+        f: T.TextIO,
+        chunk_size: int = READ_CHUNK_SIZE,
+        max_object_size: int = MAX_OBJECT_SIZE
+) -> T.Iterator[T.Dict]:
+    """
+    Incrementally decode log objects from top level json array or from NDJSON (one object per line).
+    Format is detected by first meaningful char. Input is read by chunks, so only current chunk and currently
+    decoded object are held in memory
+
+    :param f: text stream
+    :param chunk_size: size of single read
+    :param max_object_size: object, which is not decoded from this number of characters, is rejected
+    :return: iterator over decoded objects
+    """
+    decoder = json.JSONDecoder()
+    buffer, position = "", 0
+    is_eof, is_array, is_array_closed = False, None, False
+    after_value, after_comma = False, False  # position of array
+    read_size = chunk_size
+
+    while True:
+        position = _WHITESPACE.match(buffer, position).end()
+
+        if position < len(buffer):
+            char = buffer[position]
+
+            if is_array is None:
+                is_array = char == "["
+                if is_array:
+                    position += 1
+                continue
+
+            if is_array and char == "]" and not after_comma:
+                is_array_closed = True
+                position += 1
+                break
+
+            if after_value:
+                if char != ",":
+                    raise ValueError(f"Expected ',' or ']' after json array element, got {char!r}")
+                after_value, after_comma = False, True
+                position += 1
+                continue
+
+            try:
+                obj, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # object may be cut by chunk border - read more, growing read size for huge objects
+                if is_eof or not _is_truncated(e):
+                    raise
+                if len(buffer) - position >= max_object_size:
+                    raise ValueError(f"Log record is longer than {max_object_size} characters")
+                read_size = min(read_size * 2, max_object_size)
+            else:
+                if not isinstance(obj, dict):
+                    raise ValueError(f"Log record must be json object, got: {obj!r}")
+
+                yield obj
+                position, read_size = end, chunk_size
+                after_value, after_comma = is_array, False
+                continue
+        elif is_eof:
+            break
+
+        chunk = f.read(read_size)
+        buffer, position = buffer[position:] + chunk, 0
+        is_eof = not chunk
+
+    if is_array and not is_array_closed:
+        raise ValueError("Unexpected end of json array")
+
+    tail = buffer[position:]
+    while tail:
+        if tail.strip():
+            raise ValueError("Unexpected data after end of json array")
+        tail = f.read(chunk_size)
+
+
+def iter_log_records(path: str, chunk_size: int = READ_CHUNK_SIZE) -> T.Iterator[LogRecord]:
+    """
+    Stream log records from json array or NDJSON file
+
+    :param path: path to logs file
+    :param chunk_size: size of single read
+    :return: iterator over log records
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for log in iter_json_objects(f, chunk_size):
+            yield deserialize_log(log)
+
+
+# --- TESTS ---
+LOGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs.json")
+
+
+class TestParseDatetime:
+    def test_matches_strptime(self):
+        for value in (
+                "2018-04-03T07:59:13.286000Z",
+                "2018-04-03T00:00:00.000000Z",
+                "2020-02-29T23:59:59.999999Z",
+                "1969-12-31T23:59:59.5Z",
+        ):
+            assert parse_datetime(value) == datetime.strptime(value, DATE_FORMAT)
+            assert parse_epoch_us(value) == to_epoch_us(datetime.strptime(value, DATE_FORMAT))
+
+    def test_variable_fraction(self):
+        assert parse_datetime("2018-04-03T07:59:13Z") == datetime(2018, 4, 3, 7, 59, 13)
+        assert parse_datetime("2018-04-03T07:59:13.1Z") == datetime(2018, 4, 3, 7, 59, 13, 100000)
+        assert parse_datetime("2018-04-03T07:59:13.123456789Z") == datetime(2018, 4, 3, 7, 59, 13, 123456)
+
+    def test_aware(self):
+        assert parse_datetime("2018-04-03T07:59:13Z", aware=True) == \
+            datetime(2018, 4, 3, 7, 59, 13, tzinfo=timezone.utc)
+
+    def test_fallback(self):
+        assert parse_datetime("2018-04-03T10:59:13.286+03:00") == datetime(2018, 4, 3, 7, 59, 13, 286000)
+        assert parse_datetime("2018-04-03 07:59:13") == datetime(2018, 4, 3, 7, 59, 13)
+
+        for value in ("2018-02-30T07:59:13.286000Z", "2018-04-03T24:00:00Z", "yesterday", "２０１８-04-03T07:59:13Z"):
+            try:
+                parse_epoch_us(value)
+            except ValueError:
+                continue
+
+            assert False, f"{value} must be rejected"
+
+
+class TestIterJsonObjects:
+    logs = [
+        {"client_id": "user1", "User-Agent": "Firefox 59", "document.location": "https://shop.com/checkout",
+         "document.referer": None, "date": "2018-04-04T08:59:16.222000Z"},
+        {"client_id": "user2", "User-Agent": "Chrome 65", "document.location": "https://shop.com/[,]",
+         "document.referer": "https://referal.ours.com/?ref=123hexcode", "date": "2018-04-04T08:30:14.104000Z"},
+    ]
+
+    def test_json_array(self):
+        text = json.dumps(self.logs, indent=2)
+
+        for chunk_size in (1, 7, 1000):
+            assert list(iter_json_objects(io.StringIO(text), chunk_size)) == self.logs
+
+    def test_ndjson(self):
+        text = "\n".join(json.dumps(log, ensure_ascii=False) for log in self.logs) + "\n"
+
+        for chunk_size in (1, 7, 1000):
+            assert list(iter_json_objects(io.StringIO(text), chunk_size)) == self.logs
+
+    def test_empty(self):
+        assert list(iter_json_objects(io.StringIO(" [ ] \n"))) == []
+        assert list(iter_json_objects(io.StringIO(""))) == []
+
+    def test_malformed(self):
+        for text in (
+                '[{"a": 1}', '[{"a": 1}, {"a": ', '{"a": 1} {"a"', '[1, 2]', '[{"a": 1}] {"a": 1}',
+                '[,,{"a": 1},,]', '[{"a": 1} {"a": 1}]', '[{"a": 1},]', '[,]', '[{"a": 1},,{"a": 1}]', '[{"a": 1}}',
+        ):
+            try:
+                list(iter_json_objects(io.StringIO(text), 3))
+            except ValueError:
+                continue
+
+            assert False, f"{text} must be rejected"
+
+    def test_malformed_object_is_rejected_without_reading_rest(self):
+        import pytest
+
+        f = io.StringIO('{"a": 1}\n{"a": 1 "b": 2}\n' + '{"a": 1}\n' * 100000)
+        with pytest.raises(ValueError):
+            list(iter_json_objects(f, 64))
+        assert f.tell() < 1000
+
+        f = io.StringIO('{"a": "' + "x" * 100000)
+        with pytest.raises(ValueError):
+            list(iter_json_objects(f, 64, max_object_size=1000))
+        assert f.tell() < 2000
+
+    def test_chunk_border(self):
+        text = '[{"a": "x\\u0444", "b": true, "c": -1.5e3, "d": null}, {"a": "y"}]'
+
+        for chunk_size in range(1, len(text) + 1):
+            assert list(iter_json_objects(io.StringIO(text), chunk_size)) == json.loads(text)
+
+    def test_logs_file(self):
+        with open(LOGS_PATH, "r", encoding="utf-8") as f:
+            expected = [deserialize_log(log) for log in json.load(f)]
+
+        assert list(iter_log_records(LOGS_PATH, 64)) == expected
@@ -1,11 +1,27 @@
+import heapq
+import json
 import re
+import struct
+import zlib
 import typing as T
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import numpy as np
 
 # --- CONSTANTS ---
 SALE_LOCATION = "https://shop.com/checkout"
 ATTRIBUTION_WINDOW = 24  # hours
+OUR_DOMAINS = frozenset({"referal.ours.com"})
+COMPETITOR_DOMAINS = frozenset({"theirs1.com"})
+REFERER_CACHE_SIZE = 4096  # distinct referer hosts
+STREAM_LATENESS = 1  # hours, records delayed more than that are processed out of time order in streaming mode
+EPOCH = datetime(1970, 1, 1)  # naive datetimes in logs are UTC
+NO_CODE = -1  # code of missing value in dictionary encoded columns
 
 
 # --- TYPES ---
@@ -17,35 +33,372 @@ class LogRecord:
     referer: T.Optional[str]  # in practice we can have no referrer (direct requests, from bookmarks and so on)
 
 
+class StringTable:
+    """
+    Dictionary encoding of repeated strings - each distinct value is stored once and referenced by int code
+    """
+    __slots__ = ("values", "codes")
+
+    def __init__(self, values: T.Iterable[str] = ()):
+        self.values: T.List[str] = []
+        self.codes: T.Dict[str, int] = {}
+
+        for value in values:
+            self.encode(value)
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+
+        return code
+
+    def __getitem__(self, code: int) -> str:
+        return self.values[code]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class LogBatch:
+    """
+    Columnar storage of log records: epoch microseconds timestamps and dictionary encoded strings in typed arrays.
+    Referer is stored twice - as full string for LogRow views and as host, which is all attribution needs
+    """
+
+    def __init__(self):
+        self.created_at = array('q')  # epoch microseconds
+        self.client = array('i')
+        self.location = array('i')
+        self.referer = array('i')  # NO_CODE - no referer
+        self.host = array('i')  # NO_CODE - no referer or referer is not http url
+
+        self.clients = StringTable()
+        self.locations = StringTable()
+        self.referers = StringTable()
+        self.hosts = StringTable()
+
+    @classmethod
+    def from_records(cls, log_records: T.Iterable[LogRecord]) -> "LogBatch":
+        batch = cls()
+        for record in log_records:
+            batch.append(record.id, to_epoch_us(record.created_at), record.location, record.referer)
+
+        return batch
+
+    def append(self, client_id: str, created_at: int, location: str, referer: T.Optional[str]):
+        """
+        :param client_id: LogRecord.id
+        :param created_at: epoch microseconds
+        :param location: document location
+        :param referer: http referer or None
+        """
+        self.created_at.append(created_at)
+        self.client.append(self.clients.encode(client_id))
+        self.location.append(self.locations.encode(location))
+
+        if referer is None:
+            self.referer.append(NO_CODE)
+            self.host.append(NO_CODE)
+        else:
+            host = extract_host(referer)
+            self.referer.append(self.referers.encode(referer))
+            self.host.append(NO_CODE if host is None else self.hosts.encode(host))
+
+    @property
+    def columns(self) -> T.Tuple[array, ...]:
+        return self.created_at, self.client, self.location, self.referer, self.host
+
+    @property
+    def tables(self) -> T.Tuple[StringTable, ...]:
+        return self.clients, self.locations, self.referers, self.hosts
+
+    def to_bytes(self) -> bytes:
+        """
+        Compact serialization for handing batches between processes: row count, raw columns and
+        string tables as json arrays with their lengths
+        """
+        chunks = [struct.pack("<Q", len(self))]
+        chunks.extend(column.tobytes() for column in self.columns)
+
+        for table in self.tables:
+            encoded = json.dumps(table.values, ensure_ascii=False).encode()
+            chunks.extend((struct.pack("<Q", len(encoded)), encoded))
+
+        return b"".join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LogBatch":
+        batch = cls()
+        view = memoryview(data)
+        size, = struct.unpack_from("<Q", view)
+        offset = 8
+
+        for column in batch.columns:
+            end = offset + size * column.itemsize
+            column.frombytes(view[offset:end])
+            offset = end
+
+        for table in batch.tables:
+            length, = struct.unpack_from("<Q", view, offset)
+            offset += 8
+            for value in json.loads(bytes(view[offset:offset + length])):
+                table.encode(value)
+            offset += length
+
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.created_at)
+
+    def __getitem__(self, index: int) -> "LogRow":
+        if not -len(self) <= index < len(self):
+            raise IndexError("LogBatch index out of range")
+
+        return LogRow(self, index % len(self))
+
+    def __iter__(self) -> T.Iterator["LogRow"]:
+        return (LogRow(self, index) for index in range(len(self)))
+
+
+class LogRow:
+    """
+    Lightweight view of single LogBatch row with LogRecord interface
+    """
+    __slots__ = ("batch", "index")
+
+    def __init__(self, batch: LogBatch, index: int):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def id(self) -> str:
+        return self.batch.clients[self.batch.client[self.index]]
+
+    @property
+    def created_at(self) -> datetime:
+        return from_epoch_us(int(self.batch.created_at[self.index]))
+
+    @property
+    def location(self) -> str:
+        return self.batch.locations[self.batch.location[self.index]]
+
+    @property
+    def referer(self) -> T.Optional[str]:
+        code = self.batch.referer[self.index]
+        return None if code == NO_CODE else self.batch.referers[code]
+
+    def to_record(self) -> LogRecord:
+        return LogRecord(id=self.id, created_at=self.created_at, location=self.location, referer=self.referer)
+
+    def __repr__(self) -> str:
+        return f"LogRow(id={self.id!r}, created_at={self.created_at!r}, location={self.location!r}, " \
+               f"referer={self.referer!r})"
+
+
 # --- UTILS ---
+def to_epoch_us(value: datetime) -> int:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_epoch_us(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=value)
+
+
+def as_numpy(column: T.Union[array, np.ndarray], dtype: T.Type[np.number]) -> np.ndarray:
+    """
+    Zero-copy numpy view of typed array column
+    """
+    return column if isinstance(column, np.ndarray) else np.frombuffer(column, dtype=dtype)
+
+
+_HOST_PATTERN = re.compile(r'^[a-z0-9\-.]+$')
+
+
+def extract_host(referer: str) -> T.Optional[str]:
+    """
+    Cheap host extraction without full url parsing
+
+    :param referer: http referer string
+    :return: host part of http(s) url followed by path or None if referer is not such url
+    """
+    scheme, separator, rest = referer.partition("://")
+    if not separator or scheme not in ("http", "https"):
+        return None
+
+    host, slash, _ = rest.partition("/")
+    return host if slash else None
+
+
+class RefererClassifier:
+    """
+    Classifies referers by registry of our and competitor domains. Domain matches host itself and all it's subdomains.
+    Referer hosts repeat heavily, so results of host lookup are kept in bounded LRU cache
+    """
+
+    def __init__(
+            self,
+            our_domains: T.Iterable[str] = OUR_DOMAINS,
+            competitor_domains: T.Iterable[str] = COMPETITOR_DOMAINS,
+            cache_size: int = REFERER_CACHE_SIZE
+    ):
+        # domain -> is_our_link, our domains win in case of intersection with competitors
+        self.domains: T.Dict[str, bool] = {domain.lower(): False for domain in competitor_domains}
+        self.domains.update({domain.lower(): True for domain in our_domains})
+        self.cache_size = cache_size
+
+        self.classify_host = lru_cache(maxsize=cache_size)(self._lookup_host)
+
+    def _lookup_host(self, host: str) -> T.Tuple[bool, bool]:
+        if not _HOST_PATTERN.match(host):
+            return False, False
+
+        is_affiliate_link = False
+        suffix_start = 0
+        while suffix_start >= 0:
+            is_our_link = self.domains.get(host[suffix_start:])
+            if is_our_link:
+                return True, True
+            if is_our_link is not None:
+                is_affiliate_link = True
+
+            suffix_start = host.find(".", suffix_start) + 1 or -1
+
+        return is_affiliate_link, False
+
+    def __reduce__(self):
+        # cache is not picklable, so classifier is rebuilt from registry in other processes
+        return self.__class__, (
+            [domain for domain, is_ours in self.domains.items() if is_ours],
+            [domain for domain, is_ours in self.domains.items() if not is_ours],
+            self.cache_size,
+        )
+
+    def classify(self, referer: str) -> T.Tuple[bool, bool]:
+        """
+        Check that ref belong to us or our competitor
+
+        :param referer: http referer string
+        :return: is_affiliate_link, is_our_link - tuple of flags
+        """
+        host = extract_host(referer)
+        if host is None:
+            return False, False
+
+        return self.classify_host(host)
+
+
+default_classifier = RefererClassifier()
+
+
 def handle_ref_link(referer: str) -> (bool, bool):
     """
-    Check that ref belong to us or our competitor
+    Check that ref belong to us or our competitor. Kept for compatibility, see RefererClassifier
 
     :param referer: http referer string
     :return: is_affiliate_link, is_our_link - tuple of flags
     """
-    basic_pattern = r'^http(s)?://([a-z0-9\-]*\.)*({})/.*'
+    return default_classifier.classify(referer)
+
+
+class StreamingAttribution:
+    """
+    Forward streaming version of attribution. Keeps time of last our affiliate click per client while it is inside
+    attribution window, so memory depends on number of active clients, not on size of log. Records are reordered
+    by small heap buffer, which releases records older than newest one by more than lateness
+    """
+
+    def __init__(
+            self,
+            classifier: T.Optional[RefererClassifier] = None,
+            window: timedelta = timedelta(hours=ATTRIBUTION_WINDOW),
+            lateness: timedelta = timedelta(hours=STREAM_LATENESS)
+    ):
+        self.classify = (classifier or default_classifier).classify
+        self.window = window
+        self.lateness = lateness
+
+        # client id -> time of last affiliate click, only our clicks are stored, ordered by time of click
+        self.clicks: T.Dict[str, datetime] = OrderedDict()
+        # reorder buffer - heap of (created_at, sequence number, record)
+        self.pending: T.List[T.Tuple[datetime, int, LogRecord]] = []
+        self.sequence = 0
+
+    def feed(self, record: LogRecord) -> T.List[LogRecord]:
+        """
+        :param record: next log record
+        :return: sales won by our links, which became known after this record
+        """
+        heapq.heappush(self.pending, (record.created_at, self.sequence, record))
+        self.sequence += 1
+
+        return self._release(record.created_at - self.lateness)
+
+    def flush(self) -> T.List[LogRecord]:
+        """
+        :return: sales won by our links among all buffered records
+        """
+        return self._release(None)
+
+    def _release(self, until: T.Optional[datetime]) -> T.List[LogRecord]:
+        result: T.List[LogRecord] = []
+
+        while self.pending and (until is None or self.pending[0][0] <= until):
+            record = heapq.heappop(self.pending)[2]
+            if self._process(record):
+                result.append(record)
+
+        return result
+
+    def _process(self, record: LogRecord) -> bool:
+        # expire clicks out of attribution window
+        while self.clicks:
+            client_id, clicked_at = next(iter(self.clicks.items()))
+            if record.created_at - clicked_at < self.window:
+                break
+            del self.clicks[client_id]
+
+        if record.location == SALE_LOCATION:
+            clicked_at = self.clicks.get(record.id)
+            return clicked_at is not None and record.created_at - clicked_at < self.window
+
+        if record.referer is not None:
+            is_affiliate_link, is_our_link = self.classify(record.referer)
+
+            if is_our_link:
+                self.clicks.pop(record.id, None)
+                self.clicks[record.id] = record.created_at
+            elif is_affiliate_link:
+                # competitor's click overrides our previous clicks
+                self.clicks.pop(record.id, None)
+
+        return False
 
-    # --- Handle our domain ---
-    our_domain = "referal.ours.com"
-    if re.compile(basic_pattern.format(re.escape(our_domain))).search(referer):
-        return True, True
 
-    # --- Handle competitor domains ---
-    competitor_domains = {"theirs1.com"}
-    if re.compile(basic_pattern.format("|".join(
-            [re.escape(domain) for domain in competitor_domains]
-    ))).search(referer):
-        return True, False
+def _attribute_shard(
+        payload: bytes,
+        classifier: T.Optional[RefererClassifier],
+        window: timedelta
+) -> T.List[T.Tuple[str, int, str, T.Optional[str]]]:
+    batch = LogBatch.from_bytes(payload)
 
-    return False, False
+    return [
+        (row.id, batch.created_at[row.index], row.location, row.referer)
+        for row in Solution.vectorized(batch, classifier, window)
+    ]
 
 
 # --- SOLUTIONS ---
 class Solution:
     @staticmethod
-    def with_attribution_approach(log_records: T.List[LogRecord]) -> T.List[LogRecord]:
+    def with_attribution_approach(
+            log_records: T.Iterable[LogRecord],
+            classifier: T.Optional[RefererClassifier] = None
+    ) -> T.List[LogRecord]:
         """
         Возможно, я неправильно понял условия задачи, но буду исходить из своих знаний того, как работает трекинг
         действий. У нас есть окно аттрибуции - максимальное время, за которое некое совершенное действие связывается с
@@ -66,10 +419,12 @@ class Solution:
         поведение. Однако на практике такое почти невозможно, так что можно этой опасностью пренебречь
 
         :param log_records: несортированный список записей в логе
+        :param classifier: классификатор реф-ссылок, по умолчанию - default_classifier
         :return: список записей в логе с продажами, совершенными по "нашей" ссылке
         """
         # --- Init ---
         result: T.List[LogRecord] = []
+        classify = (classifier or default_classifier).classify
         log_records = sorted(log_records, key=lambda x: x.created_at, reverse=True)
 
         # --- Main Algorithm - O(n) ---
@@ -84,7 +439,7 @@ class Solution:
 
             # check ref links
             if record.referer is not None:
-                is_affiliate_link, is_our_link = handle_ref_link(record.referer)
+                is_affiliate_link, is_our_link = classify(record.referer)
 
                 if is_affiliate_link and sales_candidates.get(record.id):
                     #  delete from sales cause log_records is sorted by time and in any way
@@ -101,12 +456,171 @@ class Solution:
 
         return result
 
+    @staticmethod
+    def streaming(
+            log_records: T.Iterable[LogRecord],
+            classifier: T.Optional[RefererClassifier] = None
+    ) -> T.Iterator[LogRecord]:
+        """
+        Single pass version of with_attribution_approach without global sort, see StreamingAttribution.
+        Won sales are yielded in time order as soon as checkout record is released from reorder buffer
+
+        :param log_records: log records, roughly ordered by time
+        :param classifier: referer classifier, default_classifier by default
+        :return: iterator over sales won by our links
+        """
+        engine = StreamingAttribution(classifier)
+
+        for record in log_records:
+            yield from engine.feed(record)
+
+        yield from engine.flush()
+
+    @staticmethod
+    def _host_owners(batch: LogBatch, classifier: T.Optional[RefererClassifier]) -> array:
+        """
+        :return: owner of each distinct referer host: 1 - ours, -1 - competitor, 0 - not affiliate link
+        """
+        classify_host = (classifier or default_classifier).classify_host
+
+        return array('b', [
+            1 if is_our_link else -1 if is_affiliate_link else 0
+            for is_affiliate_link, is_our_link in map(classify_host, batch.hosts.values)
+        ])
+
+    @staticmethod
+    def columnar(
+            batch: LogBatch,
+            classifier: T.Optional[RefererClassifier] = None,
+            window: timedelta = timedelta(hours=ATTRIBUTION_WINDOW)
+    ) -> T.List[LogRow]:
+        """
+        Forward version of with_attribution_approach over LogBatch. Referers are classified once per distinct host,
+        main loop works only with int columns and never builds per row objects
+
+        :param batch: columnar log records
+        :param classifier: referer classifier, default_classifier by default
+        :param window: attribution window
+        :return: views of sales won by our links in time order
+        """
+        # --- Init ---
+        host_owner = Solution._host_owners(batch, classifier)
+        sale_code = batch.locations.codes.get(SALE_LOCATION, NO_CODE)
+        window_us = window // timedelta(microseconds=1)
+
+        no_click = min(batch.created_at, default=0) - window_us  # is out of window for any record
+        clicked_at = array('q', [no_click]) * len(batch.clients)  # time of last our click per client
+        created_at, client, location, host = batch.created_at, batch.client, batch.location, batch.host
+        result: T.List[int] = []
+
+        # --- Main Algorithm ---
+        for index in sorted(range(len(batch)), key=created_at.__getitem__):
+            if location[index] == sale_code:
+                if created_at[index] - clicked_at[client[index]] < window_us:
+                    result.append(index)
+                continue
+
+            host_code = host[index]
+            if host_code != NO_CODE and host_owner[host_code]:
+                clicked_at[client[index]] = created_at[index] if host_owner[host_code] > 0 else no_click
+
+        return [LogRow(batch, index) for index in result]
+
+    @staticmethod
+    def vectorized(
+            batch: LogBatch,
+            classifier: T.Optional[RefererClassifier] = None,
+            window: timedelta = timedelta(hours=ATTRIBUTION_WINDOW)
+    ) -> T.List[LogRow]:
+        """
+        Numpy version of columnar solution without python level loop over rows:
+        - sort rows by (client, time) with lexsort
+        - forward fill index of last affiliate click, so each sale knows the click it belongs to
+        - sale is won if that click is ours, made by the same client and inside attribution window
+
+        :param batch: columnar log records
+        :param classifier: referer classifier, default_classifier by default
+        :param window: attribution window
+        :return: views of sales won by our links in time order
+        """
+        # --- Init ---
+        created_at = as_numpy(batch.created_at, np.int64)
+        client = as_numpy(batch.client, np.int32)
+        host = as_numpy(batch.host, np.int32)
+        is_sale = as_numpy(batch.location, np.int32) == batch.locations.codes.get(SALE_LOCATION, NO_CODE)
+        host_owner = np.frombuffer(Solution._host_owners(batch, classifier), dtype=np.int8)
+
+        owner = np.zeros(len(batch), dtype=np.int8)  # 1 - our click, -1 - competitor click, 0 - other
+        has_host = (host != NO_CODE) & ~is_sale  # we not parse referer of sales, same as other solutions
+        owner[has_host] = host_owner[host[has_host]]
+
+        # --- Main Algorithm ---
+        order = np.lexsort((created_at, client))
+        client, created_at, owner, is_sale = client[order], created_at[order], owner[order], is_sale[order]
+
+        last_click = np.where(owner != 0, np.arange(len(order)), -1)
+        np.maximum.accumulate(last_click, out=last_click)
+        has_click = last_click >= 0
+        last_click[~has_click] = 0
+
+        is_won = is_sale & has_click \
+            & (client[last_click] == client) \
+            & (owner[last_click] > 0) \
+            & (created_at - created_at[last_click] < window // timedelta(microseconds=1))
+
+        won = order[is_won]
+        won = won[np.argsort(created_at[is_won], kind="stable")]
+
+        return [LogRow(batch, int(index)) for index in won]
+
+    @staticmethod
+    def sharded(
+            log_records: T.Iterable[LogRecord],
+            workers: int,
+            classifier: T.Optional[RefererClassifier] = None,
+            window: timedelta = timedelta(hours=ATTRIBUTION_WINDOW)
+    ) -> T.List[LogRecord]:
+        """
+        Attribution is independent per client, so records are hash partitioned by client id into shards, which
+        are attributed by vectorized solution in worker processes. Shards are sent as serialized LogBatch
+
+        :param log_records: log records in any order
+        :param workers: number of shards and worker processes
+        :param classifier: referer classifier, default_classifier by default
+        :param window: attribution window
+        :return: sales won by our links ordered by time and client id
+        """
+        shards = [LogBatch() for _ in range(max(workers, 1))]
+
+        for record in log_records:
+            shard = shards[zlib.crc32(record.id.encode()) % len(shards)]
+            shard.append(record.id, to_epoch_us(record.created_at), record.location, record.referer)
+
+        payloads = [shard.to_bytes() for shard in shards if len(shard)]
+        if len(payloads) > 1:
+            with ProcessPoolExecutor(max_workers=len(payloads)) as executor:
+                results = list(executor.map(
+                    _attribute_shard, payloads, [classifier] * len(payloads), [window] * len(payloads)
+                ))
+        else:
+            results = [_attribute_shard(payload, classifier, window) for payload in payloads]
+
+        return [
+            LogRecord(id=client_id, created_at=from_epoch_us(created_at), location=location, referer=referer)
+            for client_id, created_at, location, referer in sorted(
+                (won for result in results for won in result),
+                key=lambda won: (won[1], won[0])
+            )
+        ]
+
 
 # --- TESTS ---
 datetime_format = "%Y-%m-%d %H:%M:%S"
 
 
 class TestWithAttributionSolution:
+    solve = staticmethod(Solution.with_attribution_approach)
+
     @classmethod
     def get_record_ids(cls, records: T.List[LogRecord]) -> T.List[str]:
         return [record.id for record in records]
@@ -127,7 +641,7 @@ class TestWithAttributionSolution:
             )
         ]
 
-        assert self.get_record_ids(Solution.with_attribution_approach(input_data)) == ["1"]
+        assert self.get_record_ids(self.solve(input_data)) == ["1"]
 
     def test_wrong_init_order(self):
         input_data = [
@@ -145,7 +659,7 @@ class TestWithAttributionSolution:
             )
         ]
 
-        assert self.get_record_ids(Solution.with_attribution_approach(input_data)) == ["1"]
+        assert self.get_record_ids(self.solve(input_data)) == ["1"]
 
     def test_multiple_sale_one_within_attribution_window(self):
         input_data = [
@@ -169,7 +683,7 @@ class TestWithAttributionSolution:
             )
         ]
 
-        assert self.get_record_ids(Solution.with_attribution_approach(input_data)) == ["1"]
+        assert self.get_record_ids(self.solve(input_data)) == ["1"]
 
     def test_competitor_wins(self):
         input_data = [
@@ -193,7 +707,7 @@ class TestWithAttributionSolution:
             )
         ]
 
-        assert self.get_record_ids(Solution.with_attribution_approach(input_data)) == []
+        assert self.get_record_ids(self.solve(input_data)) == []
 
     def test_no_winners(self):
         input_data = [
@@ -217,4 +731,184 @@ class TestWithAttributionSolution:
             )
         ]
 
-        assert self.get_record_ids(Solution.with_attribution_approach(input_data)) == []
+        assert self.get_record_ids(self.solve(input_data)) == []
+
+
+class TestRefererClassifier:
+    def test_handle_ref_link(self):
+        assert handle_ref_link("https://referal.ours.com/?ref=123hexcode") == (True, True)
+        assert handle_ref_link("http://theirs1.com/?ref=123hexcode") == (True, False)
+        assert handle_ref_link("https://ad.theirs1.com/?src=q1w2e3r4") == (True, False)
+        assert handle_ref_link("https://yandex.ru/search/?q=купить+котика") == (False, False)
+
+    def test_not_matching_urls(self):
+        # host must be followed by path, same as in original pattern
+        assert handle_ref_link("https://referal.ours.com") == (False, False)
+        assert handle_ref_link("ftp://referal.ours.com/") == (False, False)
+        assert handle_ref_link("https://notreferal.ours.com.evil.com/") == (False, False)
+        assert handle_ref_link("https://xtheirs1.com/") == (False, False)
+        assert handle_ref_link("https://evil.com/https://referal.ours.com/") == (False, False)
+        assert handle_ref_link("https://Referal.Ours.com/") == (False, False)
+
+    def test_custom_registry(self):
+        classifier = RefererClassifier(
+            our_domains={"ours.com"},
+            competitor_domains={"theirs1.com", "theirs2.com", "ads.ours.com"},
+            cache_size=2
+        )
+
+        assert classifier.classify("https://cashback.ours.com/?ref=1") == (True, True)
+        assert classifier.classify("https://ads.ours.com/?ref=1") == (True, True)
+        assert classifier.classify("https://a.b.theirs2.com/") == (True, False)
+        assert classifier.classify("https://referal.ours.com/") == (True, True)
+        assert classifier.classify_host.cache_info().currsize == 2
+
+
+class TestStreamingSolution(TestWithAttributionSolution):
+    solve = staticmethod(lambda log_records: list(Solution.streaming(log_records)))
+
+    def test_sale_emitted_before_end_of_input(self):
+        engine = StreamingAttribution(lateness=timedelta(0))
+
+        assert engine.feed(LogRecord(
+            id="1",
+            created_at=datetime.strptime("2019-10-01 08:00:00", datetime_format),
+            location="https://shop.com",
+            referer="https://referal.ours.com/?ref=123hexcode"
+        )) == []
+        assert self.get_record_ids(engine.feed(LogRecord(
+            id="1",
+            created_at=datetime.strptime("2019-10-01 09:00:00", datetime_format),
+            location=SALE_LOCATION,
+            referer=None
+        ))) == ["1"]
+
+    def test_expired_clicks_are_dropped(self):
+        engine = StreamingAttribution(lateness=timedelta(0))
+
+        for client_id in ("1", "2"):
+            engine.feed(LogRecord(
+                id=client_id,
+                created_at=datetime.strptime("2019-10-01 08:00:00", datetime_format),
+                location="https://shop.com",
+                referer="https://referal.ours.com/?ref=123hexcode"
+            ))
+        assert len(engine.clicks) == 2
+
+        engine.feed(LogRecord(
+            id="3",
+            created_at=datetime.strptime("2019-10-02 08:00:00", datetime_format),
+            location="https://shop.com",
+            referer=None
+        ))
+        assert len(engine.clicks) == 0 and len(engine.pending) == 0
+
+
+class TestColumnarSolution(TestWithAttributionSolution):
+    solve = staticmethod(lambda log_records: [
+        row.to_record() for row in Solution.columnar(LogBatch.from_records(log_records))
+    ])
+
+    def test_batch_encoding(self):
+        records = [
+            LogRecord(
+                id="1",
+                created_at=datetime.strptime("2019-10-01 08:00:00", datetime_format),
+                location="https://shop.com",
+                referer="https://referal.ours.com/?ref=123hexcode"
+            ),
+            LogRecord(
+                id="1",
+                created_at=datetime.strptime("2019-10-01 09:00:00", datetime_format),
+                location="https://shop.com",
+                referer=None
+            ),
+            LogRecord(
+                id="2",
+                created_at=datetime.strptime("2019-10-01 09:00:00", datetime_format),
+                location="https://shop.com",
+                referer="https://referal.ours.com/?ref=0xc0ffee"
+            ),
+        ]
+        batch = LogBatch.from_records(records)
+
+        assert [row.to_record() for row in batch] == records
+        assert batch[-1].id == "2" and batch[-1].referer == records[-1].referer
+        assert list(batch.client) == [0, 0, 1] and list(batch.location) == [0, 0, 0]
+        assert list(batch.host) == [0, NO_CODE, 0] and batch.hosts.values == ["referal.ours.com"]
+
+
+class TestVectorizedSolution(TestWithAttributionSolution):
+    solve = staticmethod(lambda log_records: [
+        row.to_record() for row in Solution.vectorized(LogBatch.from_records(log_records))
+    ])
+
+    def test_empty(self):
+        assert self.solve([]) == []
+
+    def test_parity_on_random_input(self):
+        import random
+
+        locations = [SALE_LOCATION, "https://shop.com", "https://shop.com/cart"]
+        referers = [
+            None, "https://referal.ours.com/?ref=1", "https://ad.theirs1.com/?src=2", "https://yandex.ru/",
+            "https://shop.com/"
+        ]
+        started_at = datetime.strptime("2019-10-01 00:00:00", datetime_format)
+
+        for seed in range(20):
+            generator = random.Random(seed)
+            records = [
+                LogRecord(
+                    id=str(generator.randrange(10)),
+                    created_at=started_at + timedelta(minutes=minutes),
+                    location=generator.choice(locations),
+                    referer=generator.choice(referers)
+                ) for minutes in generator.sample(range(5 * 24 * 60), 500)
+            ]
+
+            expected = sorted(Solution.with_attribution_approach(records), key=lambda record: record.created_at)
+            assert self.solve(records) == expected
+
+
+class TestShardedSolution(TestWithAttributionSolution):
+    solve = staticmethod(lambda log_records: Solution.sharded(log_records, workers=2))
+
+    def test_batch_serialization(self):
+        records = [
+            LogRecord(
+                id="1-Firefox 59",
+                created_at=datetime.strptime("2019-10-01 08:00:00", datetime_format),
+                location="https://shop.com",
+                referer="https://referal.ours.com/?ref=123hexcode"
+            ),
+            LogRecord(
+                id="2-Хром",
+                created_at=datetime.strptime("2019-10-01 09:00:00", datetime_format),
+                location=SALE_LOCATION,
+                referer=None
+            ),
+        ]
+        batch = LogBatch.from_bytes(LogBatch.from_records(records).to_bytes())
+
+        assert [row.to_record() for row in batch] == records
+        assert batch.hosts.values == ["referal.ours.com"] and batch.hosts.codes == {"referal.ours.com": 0}
+        assert len(LogBatch.from_bytes(LogBatch().to_bytes())) == 0
+
+    def test_custom_classifier_in_workers(self):
+        classifier = RefererClassifier(our_domains={"theirs1.com"}, competitor_domains={"referal.ours.com"})
+        input_data = [
+            LogRecord(
+                id=str(client_id),
+                created_at=datetime.strptime(f"2019-10-01 0{hour}:00:00", datetime_format),
+                location=location,
+                referer=referer
+            )
+            for client_id in range(4)
+            for hour, location, referer in (
+                (8, "https://shop.com", "https://theirs1.com/?ref=1"),
+                (9, SALE_LOCATION, None),
+            )
+        ]
+
+        assert self.get_record_ids(Solution.sharded(input_data, 3, classifier)) == ["0", "1", "2", "3"]
@@ -51,27 +51,113 @@
 """
 
 import typing as T
-from datetime import datetime
 
+from binlog import BinaryLog, is_binary_log
+from checkpoint import run_incremental
+from ingest import deserialize_log, iter_log_records
 from lib import Solution, LogRecord
+from pipeline import LogPipeline, expand_paths, is_compressed
 
 
 def deserialize_json(logs: T.List[T.Dict]) -> T.List[LogRecord]:
-    return [
-        LogRecord(
-            id=log["client_id"] + '-' + log["User-Agent"],  # is this pair true client / device identifier ?
-            created_at=datetime.strptime(log["date"], "%Y-%m-%dT%H:%M:%S.%fZ"),
-            location=log["document.location"],
-            referer=log.get("document.referer"),
-        ) for log in logs
-    ]
+    return [deserialize_log(log) for log in logs]
 
 
 if __name__ == '__main__':
+    import argparse
     import json
-
-    with open("logs.json", "r") as f:
-        records = deserialize_json(json.load(f))
-
-    for our_sale in Solution.with_attribution_approach(records):
+    import sys
+    from datetime import timedelta
+
+    from lib import ATTRIBUTION_WINDOW, STREAM_LATENESS
+
+    parser = argparse.ArgumentParser(description="Find sales won by our affiliate links")
+    parser.add_argument(
+        "paths", nargs="*", default=["logs.json"],
+        help="logs files or glob patterns - json array or NDJSON, plain, gzip or zstd compressed (see pipeline.py), "
+             "or single binary log (see binlog.py)"
+    )
+    parser.add_argument(
+        "--parsers", type=int, default=0,
+        help="parser processes of json logs, logs are parsed by decompressor thread if 0. Single plain file is "
+             "read directly without staged pipeline, unless parsers or stats are requested"
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="print throughput of read, decompress and parse stages to stderr"
+    )
+    parser.add_argument(
+        "--mode", choices=("sorted", "streaming"), default=None,
+        help=f"sorted - sort of all records, original output order; streaming - single pass with per client state, "
+             f"sales in time order, each sale is held back until records {STREAM_LATENESS} h newer are read, "
+             f"records delayed more than that are attributed in order of arrival and may differ from sorted mode; "
+             f"sorted by default, streaming with --state"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of processes, records are sharded by client id if greater than 1, mode is ignored then, "
+             "json logs only"
+    )
+    parser.add_argument(
+        "--state", default=None,
+        help="attribution snapshot path, clicks and buffered records are carried between runs, streaming mode and "
+             "single worker only, json logs only"
+    )
+    parser.add_argument("--flush", action="store_true", help="release all buffered records at the end of run")
+    parser.add_argument(
+        "--window", type=float, default=None,
+        help=f"attribution window in hours, {ATTRIBUTION_WINDOW} by default or window saved in state, binary log, "
+             f"state or workers only"
+    )
+    parser.add_argument("--client", default=None, help="attribute single client, binary log only")
+    args = parser.parse_args()
+
+    paths = expand_paths(args.paths)
+    window = timedelta(hours=ATTRIBUTION_WINDOW if args.window is None else args.window)
+    is_binary = len(paths) == 1 and is_binary_log(paths[0])
+    # flags are rejected instead of being silently ignored by the chosen solution
+    if is_binary:
+        for flag, is_set in (
+                ("--parsers", args.parsers > 0), ("--stats", args.stats), ("--mode", args.mode is not None),
+                ("--workers", args.workers > 1), ("--state", args.state is not None)
+        ):
+            if is_set:
+                parser.error(f"{flag} is not supported with binary log")
+    else:
+        if args.client is not None:
+            parser.error("--client is supported with binary log only")
+        if args.state is not None and (args.workers > 1 or args.mode == "sorted"):
+            parser.error("--state is supported in streaming mode with single worker only")
+        if args.window is not None and args.state is None and args.workers == 1:
+            parser.error("--window is supported with binary log, --state or --workers only")
+    if args.flush and args.state is None:
+        parser.error("--flush is supported with --state only")
+
+    if args.parsers > 0 or args.stats or len(paths) > 1 or is_compressed(paths[0]):
+        log_records = LogPipeline(paths, args.parsers)
+    else:
+        # stages of pipeline only cost threads and queues for single plain file parsed in one process
+        log_records = iter_log_records(paths[0])
+
+    if is_binary:
+        with BinaryLog(paths[0]) as binary_log:
+            batch = binary_log.batch if args.client is None else binary_log.client_batch(args.client)
+            # rows are views of mapped file, they are copied to records before it is closed
+            our_sales = [row.to_record() for row in Solution.vectorized(batch, window=window)]
+            del batch
+    elif args.state is not None:
+        # window saved in state is kept unless given explicitly
+        our_sales = run_incremental(
+            log_records, args.state, flush=args.flush, window=None if args.window is None else window
+        )
+    elif args.workers > 1:
+        our_sales = Solution.sharded(log_records, args.workers, window=window)
+    elif args.mode == "streaming":
+        our_sales = Solution.streaming(log_records)
+    else:
+        our_sales = Solution.with_attribution_approach(log_records)
+
+    for our_sale in our_sales:
         print(our_sale)
+
+    if args.stats:
+        print(json.dumps(log_records.report(), indent=2), file=sys.stderr)
@@ -0,0 +1,623 @@
+"""
+Pipelined ingestion of many log files - plain, gzip or zstd compressed json array / NDJSON, paths or globs
+
+Stages run concurrently and are connected by bounded queues, so slow stage blocks faster ones and memory does not
+depend on input size:
+- reader thread reads raw bytes of files in order
+- decompressor thread decompresses them and cuts NDJSON into blocks of whole lines
+- parser pool decodes blocks into log records in worker processes
+
+Records are yielded in input order. Json array can not be cut into blocks without decoding, so it is decoded by
+decompressor thread. Reading and zlib / zstd decompression release GIL, so they overlap parsing even without pool
+
+    python pipeline.py "logs/*.ndjson.gz" --parsers 4
+"""
+import codecs
+import glob
+import io
+import itertools
+import queue
+import threading
+import time
+import typing as T
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+
+from ingest import deserialize_log, deserialize_row, iter_json_objects
+from lib import LogRecord, from_epoch_us
+
+try:
+    import zstandard
+except ImportError:  # optional, required by zstd compressed input only
+    zstandard = None
+
+# --- CONSTANTS ---
+READ_CHUNK_SIZE = 1 << 20  # bytes
+BLOCK_SIZE = 1 << 20  # decompressed bytes per parser task
+ARRAY_BATCH_SIZE = 10000  # records of json array per batch
+QUEUE_SIZE = 8  # chunks / blocks between stages
+POLL_INTERVAL = 0.1  # seconds, check of pipeline stop by blocked stage
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+MAGIC_SIZE = max(len(GZIP_MAGIC), len(ZSTD_MAGIC))
+
+_END_OF_FILE = object()
+_END_OF_INPUT = object()
+
+
+# --- TYPES ---
+Row = T.Tuple[str, int, str, T.Optional[str]]  # see ingest.deserialize_row
+
+
+@dataclass
+class StageStats:
+    """
+    :param items: chunks, blocks or records passed by stage
+    :param size: bytes passed by stage, decompressed bytes for decompressor
+    :param seconds: busy time, sum over workers for parser pool
+    :param waiting: time spent waiting for input or for place in output queue
+    """
+    name: str
+    items: int = 0
+    size: int = 0
+    seconds: float = 0
+    waiting: float = 0
+
+    def as_dict(self) -> T.Dict[str, T.Any]:
+        return {
+            "items": self.items,
+            "bytes": self.size,
+            "seconds": self.seconds,
+            "waiting": self.waiting,
+            "items_per_second": self.items / self.seconds if self.seconds else None,
+            "bytes_per_second": self.size / self.seconds if self.seconds else None,
+        }
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _Decompressor:
+    """
+    Streaming decompressor of gzip or zstd by magic bytes of input, passes plain input as is.
+    Concatenated gzip members and zstd frames (pigz, zstd -T) are decompressed one after another
+    """
+
+    def __init__(self, head: bytes, path: str):
+        if head.startswith(GZIP_MAGIC):
+            self.factory = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif head.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise RuntimeError(f"{path} is zstd compressed, install zstandard package to read it")
+            self.factory = lambda: zstandard.ZstdDecompressor().decompressobj()
+        else:
+            self.factory = None
+
+        self.decompressor = None
+        self.path = path
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.factory is None:
+            return data
+
+        output = []
+        while data:
+            if self.decompressor is None:
+                self.decompressor = self.factory()
+
+            output.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+
+            data, self.decompressor = self.decompressor.unused_data, None
+
+        return b"".join(output)
+
+    def finish(self):
+        if self.decompressor is not None:
+            raise ValueError(f"Unexpected end of compressed data in {self.path}")
+
+
+class _TextReader:
+    """
+    Text stream over iterator of utf-8 bytes chunks for iter_json_objects
+    """
+
+    def __init__(self, chunks: T.Iterator[bytes]):
+        self.chunks = chunks
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+
+    def read(self, size: int) -> str:
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.buffer += self.decoder.decode(b"", final=True)
+                break
+            self.buffer += self.decoder.decode(chunk)
+
+        text, self.buffer = self.buffer[:size], self.buffer[size:]
+        return text
+
+
+# --- UTILS ---
+def expand_paths(patterns: T.Iterable[str]) -> T.List[str]:
+    """
+    :param patterns: paths or glob patterns, matches of pattern are sorted
+    :return: paths in order of patterns without repeats
+    """
+    paths = []
+    for pattern in patterns:
+        matches = [pattern] if glob.escape(pattern) == pattern else sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise FileNotFoundError(f"No files match '{pattern}'")
+
+        paths.extend(path for path in matches if path not in paths)
+
+    return paths
+
+
+def is_compressed(path: str) -> bool:
+    with open(path, "rb") as f:
+        head = f.read(MAGIC_SIZE)
+
+    return head.startswith(GZIP_MAGIC) or head.startswith(ZSTD_MAGIC)
+
+
+def _compact_rows(logs: T.Iterable[T.Dict], strings: T.Dict[str, str]) -> T.Iterator[Row]:
+    """
+    Rows with single object per distinct string, so repeated client ids and locations are pickled once
+    """
+    for log in logs:
+        client_id, created_at, location, referer = deserialize_row(log)
+        yield (
+            strings.setdefault(client_id, client_id),
+            created_at,
+            strings.setdefault(location, location),
+            referer if referer is None else strings.setdefault(referer, referer),
+        )
+
+
+def _parse_block(data: bytes) -> T.Tuple[T.List[Row], float]:
+    """
+    Parser task - decode NDJSON block of whole lines. Rows are returned instead of log records, because
+    pickling of datetimes and dataclasses costs almost as much as parsing
+
+    :return: rows and parse time
+    """
+    started_at = time.perf_counter()
+    rows = list(_compact_rows(iter_json_objects(io.StringIO(data.decode("utf-8"))), {}))
+
+    return rows, time.perf_counter() - started_at
+
+
+def _done(result: T.Any) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+# --- PIPELINE ---
+class LogPipeline:
+    """
+    Iterable over log records of many files, see module docstring. Pipeline is started by iteration and
+    stopped when iteration ends or is abandoned, stats are filled while records are read
+
+        pipeline = LogPipeline(["logs/*.ndjson.gz"], parsers=4)
+        our_sales = Solution.streaming(pipeline)
+        print(pipeline.report())
+    """
+
+    def __init__(
+            self,
+            patterns: T.Iterable[str],
+            parsers: int = 0,
+            chunk_size: int = READ_CHUNK_SIZE,
+            block_size: int = BLOCK_SIZE,
+            queue_size: int = QUEUE_SIZE
+    ):
+        """
+        :param patterns: paths or glob patterns of logs files
+        :param parsers: parser processes, NDJSON is parsed by decompressor thread if 0
+        :param chunk_size: size of single read
+        :param block_size: approximate decompressed size of parser task
+        :param queue_size: capacity of queues between stages, at least twice number of parsers
+        """
+        self.paths = expand_paths(patterns)
+        self.parsers = parsers
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.queue_size = max(queue_size, 2 * parsers)
+
+        self.reader = StageStats("read")
+        self.decompressor = StageStats("decompress")
+        self.parser = StageStats("parse")
+        self.seconds = 0.0
+
+    def report(self) -> T.Dict[str, T.Any]:
+        """
+        :return: json serializable stats of stages and wall time of last run
+        """
+        return {
+            "files": len(self.paths),
+            "parsers": self.parsers,
+            "seconds": self.seconds,
+            "stages": {stage.name: stage.as_dict() for stage in (self.reader, self.decompressor, self.parser)},
+        }
+
+    def __iter__(self) -> T.Iterator[LogRecord]:
+        self.reader, self.decompressor, self.parser = StageStats("read"), StageStats("decompress"), StageStats("parse")
+        started_at = time.perf_counter()
+
+        stop = threading.Event()
+        chunks = queue.Queue(self.queue_size)
+        batches = queue.Queue(self.queue_size)
+        executor = None
+        if self.parsers > 0:
+            executor = ProcessPoolExecutor(self.parsers)
+            executor.submit(int).result()  # workers are forked now, before stage threads are started
+
+        threads = [
+            threading.Thread(target=self._read, args=(chunks, stop), name="log-reader", daemon=True),
+            threading.Thread(
+                target=self._decompress, args=(chunks, batches, executor, stop), name="log-decompressor", daemon=True
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(batches, stop, self.parser)
+                if item is _END_OF_INPUT:
+                    break
+
+                waiting_since = time.perf_counter()
+                rows, seconds = item.result()
+                self.parser.waiting += time.perf_counter() - waiting_since
+                self.parser.items += len(rows)
+                self.parser.seconds += seconds
+
+                for client_id, created_at, location, referer in rows:
+                    yield LogRecord(id=client_id, created_at=from_epoch_us(created_at), location=location,
+                                    referer=referer)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+            self.seconds = time.perf_counter() - started_at
+
+    @staticmethod
+    def _put(target: queue.Queue, item: T.Any, stop: threading.Event, stats: StageStats) -> bool:
+        """
+        :return: False if pipeline is stopped
+        """
+        started_at = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stats.waiting += time.perf_counter() - started_at
+
+    @staticmethod
+    def _get(source: queue.Queue, stop: threading.Event, stats: StageStats) -> T.Any:
+        """
+        :return: next item, _END_OF_INPUT if pipeline is stopped
+        """
+        started_at = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    item = source.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+
+                if isinstance(item, _Failure):
+                    raise item.error
+                return item
+            return _END_OF_INPUT
+        finally:
+            stats.waiting += time.perf_counter() - started_at
+
+    # --- Reader ---
+    def _read(self, chunks: queue.Queue, stop: threading.Event):
+        try:
+            for path in self.paths:
+                with open(path, "rb") as f:
+                    if not self._put(chunks, path, stop, self.reader):
+                        return
+
+                    while True:
+                        started_at = time.perf_counter()
+                        chunk = f.read(self.chunk_size)
+                        self.reader.seconds += time.perf_counter() - started_at
+
+                        if not chunk:
+                            break
+
+                        self.reader.items += 1
+                        self.reader.size += len(chunk)
+                        if not self._put(chunks, chunk, stop, self.reader):
+                            return
+
+                if not self._put(chunks, _END_OF_FILE, stop, self.reader):
+                    return
+
+            self._put(chunks, _END_OF_INPUT, stop, self.reader)
+        except Exception as e:
+            self._put(chunks, _Failure(e), stop, self.reader)
+
+    # --- Decompressor ---
+    def _decompress(self, chunks: queue.Queue, batches: queue.Queue, executor, stop: threading.Event):
+        try:
+            while True:
+                path = self._get(chunks, stop, self.decompressor)
+                if path is _END_OF_INPUT:
+                    break
+
+                texts = self._iter_decompressed(path, chunks, stop)
+                head = b""
+                for head in texts:
+                    head = head.lstrip()
+                    if head:
+                        break
+
+                if head.startswith(b"["):
+                    submitted = self._submit_array(head, texts, batches, stop)
+                else:
+                    submitted = self._submit_blocks(head, texts, batches, executor, stop)
+
+                if not submitted:
+                    return
+
+            self._put(batches, _END_OF_INPUT, stop, self.decompressor)
+        except Exception as e:
+            self._put(batches, _Failure(e), stop, self.decompressor)
+
+    def _iter_decompressed(self, path: str, chunks: queue.Queue, stop: threading.Event) -> T.Iterator[bytes]:
+        """
+        :return: decompressed bytes of current file
+        """
+        decompressor, head = None, b""
+        while True:
+            chunk = self._get(chunks, stop, self.decompressor)
+            if chunk is _END_OF_INPUT:
+                return
+            if chunk is _END_OF_FILE:
+                break
+
+            if decompressor is None:
+                # magic bytes may be split between tiny chunks
+                head += chunk
+                if len(head) < MAGIC_SIZE:
+                    continue
+                decompressor, chunk = _Decompressor(head, path), head
+
+            started_at = time.perf_counter()
+            text = decompressor.decompress(chunk)
+            self.decompressor.seconds += time.perf_counter() - started_at
+            self.decompressor.items += 1
+            self.decompressor.size += len(text)
+
+            if text:
+                yield text
+
+        if decompressor is None:
+            decompressor = _Decompressor(head, path)
+            if head:
+                yield decompressor.decompress(head)
+
+        decompressor.finish()
+
+    def _submit_blocks(
+            self,
+            head: bytes,
+            texts: T.Iterator[bytes],
+            batches: queue.Queue,
+            executor,
+            stop: threading.Event
+    ) -> bool:
+        """
+        Cut NDJSON into blocks of whole lines for parser pool, utf-8 never has newline byte inside of character
+
+        :return: False if pipeline is stopped
+        """
+        def submit(block: bytes) -> bool:
+            if executor is None:
+                future = _done(_parse_block(block))
+            else:
+                future = executor.submit(_parse_block, block)
+
+            return self._put(batches, future, stop, self.decompressor)
+
+        parts, size = [head], len(head)
+        for text in texts:
+            parts.append(text)
+            size += len(text)
+            if size < self.block_size:
+                continue
+
+            # decompressed chunk may be much larger than block, so it is cut into many blocks
+            buffer, start = b"".join(parts), 0
+            while len(buffer) - start >= self.block_size:
+                end = buffer.find(b"\n", start + self.block_size - 1) + 1
+                if not end:
+                    break
+                if not submit(buffer[start:end]):
+                    return False
+                start = end
+
+            parts, size = [buffer[start:]], len(buffer) - start
+
+        buffer = b"".join(parts)
+        return not buffer.strip() or submit(buffer)
+
+    def _submit_array(self, head: bytes, texts: T.Iterator[bytes], batches: queue.Queue, stop: threading.Event) -> bool:
+        """
+        Decode json array in place, its records are passed by batches
+
+        :return: False if pipeline is stopped
+        """
+        def parse_time() -> float:
+            # pulling of text runs decompression and waits for reader, they are accounted by decompressor
+            return time.perf_counter() - self.decompressor.seconds - self.decompressor.waiting
+
+        logs = iter_json_objects(_TextReader(itertools.chain((head,), texts)), self.block_size)
+        rows, strings = [], {}
+        started_at = parse_time()
+
+        for row in _compact_rows(logs, strings):
+            rows.append(row)
+            if len(rows) < ARRAY_BATCH_SIZE:
+                continue
+
+            if not self._put(batches, _done((rows, parse_time() - started_at)), stop, self.decompressor):
+                return False
+            rows, strings, started_at = [], {}, parse_time()
+
+        return not rows or self._put(batches, _done((rows, parse_time() - started_at)), stop, self.decompressor)
+
+
+# --- TESTS ---
+class TestLogPipeline:
+    logs = [
+        {"client_id": f"user{index % 7}", "User-Agent": "Firefox 59", "document.location": "https://shop.com/",
+         "document.referer": "https://referal.ours.com/?ref=ёж" if index % 3 else None,
+         "date": f"2018-04-04T08:{index // 60 % 60:02d}:{index % 60:02d}.104000Z"}
+        for index in range(500)
+    ]
+
+    @classmethod
+    def expected(cls, logs: T.List[T.Dict] = None) -> T.List[LogRecord]:
+        return [deserialize_log(log) for log in (cls.logs if logs is None else logs)]
+
+    @classmethod
+    def write(cls, path, file_format: str, compression: T.Optional[str] = None, logs: T.List[T.Dict] = None) -> str:
+        import gzip
+        import json
+
+        logs = cls.logs if logs is None else logs
+        if file_format == "json":
+            text = json.dumps(logs, indent=2, ensure_ascii=False)
+        else:
+            text = "".join(json.dumps(log, ensure_ascii=False) + "\n" for log in logs)
+        data = text.encode("utf-8")
+
+        # concatenated members / frames, like output of pigz and zstd -T
+        if compression == "gzip":
+            data = gzip.compress(data[:len(data) // 2]) + gzip.compress(data[len(data) // 2:])
+        elif compression == "zstd":
+            compressor = zstandard.ZstdCompressor()
+            data = compressor.compress(data[:len(data) // 2]) + compressor.compress(data[len(data) // 2:])
+
+        path.write_bytes(data)
+        return str(path)
+
+    def check_formats(self, tmp_path, compression: T.Optional[str]):
+        for file_format in ("json", "ndjson"):
+            path = self.write(tmp_path / f"logs.{file_format}.{compression}", file_format, compression)
+            assert is_compressed(path) == (compression is not None)
+
+            for parsers, chunk_size, block_size in ((0, 1, 7), (0, 1000, 1 << 20), (2, 333, 4096)):
+                pipeline = LogPipeline([path], parsers, chunk_size, block_size)
+                assert list(pipeline) == self.expected(), (compression, file_format, parsers, chunk_size)
+
+    def test_formats(self, tmp_path):
+        for compression in (None, "gzip"):
+            self.check_formats(tmp_path, compression)
+
+    def test_zstd_formats(self, tmp_path):
+        import pytest
+
+        if zstandard is None:
+            pytest.skip("zstandard is not installed, zstd compressed input is not tested")
+
+        self.check_formats(tmp_path, "zstd")
+
+    def test_many_files_and_globs(self, tmp_path):
+        first = self.write(tmp_path / "a.ndjson.gz", "ndjson", "gzip", self.logs[:100])
+        self.write(tmp_path / "b.json", "json", None, self.logs[100:300])
+        self.write(tmp_path / "c.ndjson", "ndjson", None, self.logs[300:])
+        (tmp_path / "empty.ndjson").write_bytes(b"")
+
+        assert expand_paths([first, str(tmp_path / "*.*json*")]) == [
+            first, str(tmp_path / "b.json"), str(tmp_path / "c.ndjson"), str(tmp_path / "empty.ndjson")
+        ]
+        assert list(LogPipeline([first, str(tmp_path / "[bce]*")], parsers=2, block_size=1000)) == self.expected()
+
+    def test_invalid_input(self, tmp_path):
+        import gzip
+
+        import pytest
+
+        with pytest.raises(FileNotFoundError):
+            LogPipeline([str(tmp_path / "*.json")])
+        with pytest.raises(FileNotFoundError):
+            list(LogPipeline([str(tmp_path / "missing.json")]))
+
+        path = self.write(tmp_path / "logs.ndjson.gz", "ndjson", "gzip")
+        (tmp_path / "truncated.gz").write_bytes(gzip.compress(b'{"a": 1}\n' * 1000)[:-10])
+        (tmp_path / "malformed.ndjson").write_bytes(b'{"client_id": "user1"\n')
+
+        for name in ("truncated.gz", "malformed.ndjson"):
+            for parsers in (0, 2):
+                with pytest.raises((ValueError, KeyError)):
+                    list(LogPipeline([path, str(tmp_path / name)], parsers, chunk_size=100))
+
+    def test_abandoned_iteration(self, tmp_path):
+        path = self.write(tmp_path / "logs.ndjson.gz", "ndjson", "gzip")
+
+        for parsers in (0, 2):
+            pipeline = LogPipeline([path], parsers, chunk_size=10, block_size=100, queue_size=1)
+            records = iter(pipeline)
+            assert next(records) == self.expected()[0]
+            records.close()
+
+            assert not any(thread.name.startswith("log-") for thread in threading.enumerate())
+
+    def test_report(self, tmp_path):
+        import json
+
+        path = self.write(tmp_path / "logs.ndjson.gz", "ndjson", "gzip")
+        pipeline = LogPipeline([path], chunk_size=100, block_size=1000)
+        list(pipeline)
+
+        report = pipeline.report()
+        stages = report["stages"]
+        assert report["files"] == 1 and report["seconds"] > 0
+        assert stages["read"]["bytes"] == (tmp_path / "logs.ndjson.gz").stat().st_size
+        assert stages["decompress"]["bytes"] == sum(
+            len(json.dumps(log, ensure_ascii=False).encode("utf-8")) + 1 for log in self.logs
+        )
+        assert stages["parse"]["items"] == len(self.logs)
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+
+    parser = argparse.ArgumentParser(description="Read logs by pipeline and report throughput of its stages")
+    parser.add_argument("patterns", nargs="+", help="paths or glob patterns of plain, gzip or zstd logs files")
+    parser.add_argument("--parsers", type=int, default=os.cpu_count() or 1, help="parser processes")
+    parser.add_argument("--chunk-size", type=int, default=READ_CHUNK_SIZE)
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+
+    pipeline = LogPipeline(args.patterns, args.parsers, args.chunk_size, args.block_size)
+    for _ in pipeline:
+        pass
+
+    print(json.dumps(pipeline.report(), indent=2))
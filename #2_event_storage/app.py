@@ -1,24 +1,66 @@
-import logging
+import json
+import os
 import typing as T
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 import pydantic
-from fastapi import FastAPI, Depends, Body
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi import FastAPI, Depends, Body, Query
 from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.status import (
     HTTP_201_CREATED,
+    HTTP_400_BAD_REQUEST,
     HTTP_404_NOT_FOUND,
 )
 
+import metrics
+from cache import MODE_CHANGE_STREAM, MODE_TTL, OpenEventCache
+from storage import InvalidCursor, MemoryStorage, MongoStorage, SqliteStorage, Storage
+
 #  --- Config ---
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")  # mongo | memory | sqlite
+SQLITE_PATH = os.getenv("SQLITE_PATH", "events.sqlite")
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 4))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 2))
 DB_NAME = "storage-dev"
 TABLE_EVENTS = "events"
 
+# write-behind batching of start / finish in MongoDB, see writer.WriteCoalescer
+WRITE_BATCHING = os.getenv("WRITE_BATCHING", "0") == "1"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 100))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", 0.002))  # seconds
+
+# worker processes serving the app, set by main.py
+WORKERS = int(os.getenv("WORKERS", 1))
+
+# per worker cache of open events, see cache.OpenEventCache
+OPEN_EVENT_CACHE = os.getenv("OPEN_EVENT_CACHE", "off")  # off | ttl | changestream (mongo only)
+# ttl mode is coherent only if the only app instance with single worker writes to database, deployment has to
+# declare it by OPEN_EVENT_CACHE_SINGLE_INSTANCE=1, changestream mode is coherent across workers and instances
+OPEN_EVENT_CACHE_SINGLE_INSTANCE = os.getenv("OPEN_EVENT_CACHE_SINGLE_INSTANCE", "0") == "1"
+OPEN_EVENT_CACHE_SIZE = int(os.getenv("OPEN_EVENT_CACHE_SIZE", 10000))
+OPEN_EVENT_CACHE_TTL = float(os.getenv("OPEN_EVENT_CACHE_TTL", 1))  # seconds
+
+# archival of finished events to monthly collections in MongoDB, see archive.Archiver
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 0))  # 0 - finished events are not archived
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 60))  # seconds
+
+# prometheus metrics on /metrics, see metrics.py
+METRICS = os.getenv("METRICS", "1") == "1"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 1000
+
 
 #  --- Init ---
 class DataBase:
-    client: AsyncIOMotorClient = None
+    storage: Storage = None
+    cache: OpenEventCache = None
 
 
 app = FastAPI()
@@ -26,20 +68,62 @@ db = DataBase()
 
 
 #  --- Db Utils ---
-async def get_database():
-    return db.client
+async def get_storage():
+    return db.storage
+
+
+def create_storage() -> Storage:
+    if STORAGE_BACKEND == "mongo":
+        return MongoStorage(
+            MONGO_URL,
+            DB_NAME,
+            TABLE_EVENTS,
+            max_pool_size=MONGO_MAX_POOL_SIZE,
+            min_pool_size=MONGO_MIN_POOL_SIZE,
+            write_batching=WRITE_BATCHING,
+            write_batch_size=WRITE_BATCH_SIZE,
+            write_flush_interval=WRITE_FLUSH_INTERVAL,
+            instrument=METRICS,
+            archive_after=timedelta(days=ARCHIVE_AFTER_DAYS) if ARCHIVE_AFTER_DAYS else None,
+            archive_batch_size=ARCHIVE_BATCH_SIZE,
+            archive_interval=ARCHIVE_INTERVAL
+        )
+    if STORAGE_BACKEND == "memory":
+        return MemoryStorage()
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+
+    raise ValueError(f"Unknown storage backend '{STORAGE_BACKEND}'")
+
+
+async def connect_to_storage():
+    # entries of a worker are not invalidated by writes of the others, so start after finish by another worker
+    # or app instance would be lost until ttl expires
+    if OPEN_EVENT_CACHE == MODE_TTL and WORKERS > 1:
+        raise ValueError("Open events cache in ttl mode requires single worker, use changestream mode")
+    if OPEN_EVENT_CACHE == MODE_TTL and not OPEN_EVENT_CACHE_SINGLE_INSTANCE:
+        raise ValueError("Open events cache in ttl mode requires single app instance, declare it by "
+                         "OPEN_EVENT_CACHE_SINGLE_INSTANCE=1 or use changestream mode")
 
+    if db.storage is None:
+        db.storage = create_storage()
+    await db.storage.connect()
 
-async def connect_to_mongo():
-    logging.info("Connect to MongoDB...")
-    db.client = AsyncIOMotorClient("mongodb://localhost:27017", maxPoolSize=4, minPoolSize=2)
-    logging.info("Connection established ！")
+    if OPEN_EVENT_CACHE != "off":
+        db.cache = OpenEventCache(OPEN_EVENT_CACHE_SIZE, OPEN_EVENT_CACHE_TTL, OPEN_EVENT_CACHE)
 
+        if OPEN_EVENT_CACHE == MODE_CHANGE_STREAM:
+            if not isinstance(db.storage, MongoStorage):
+                raise ValueError("Change stream coherence of open events cache requires mongo storage")
+            db.cache.start(db.storage.collection)
 
-async def close_mongo_connection():
-    logging.info("Disconnect MongoDB...")
-    db.client.close()
-    logging.info("Connection removed ！")
+
+async def close_storage_connection():
+    if db.cache is not None:
+        await db.cache.stop()
+        db.cache = None
+
+    await db.storage.close()
 
 
 #  --- Models ---
@@ -62,30 +146,105 @@ class EventOut(EventModel):
     id: str
 
 
+class EventsIn(pydantic.BaseModel):
+    types: T.List[str]
+
+    @pydantic.validator("types", whole=True)
+    def check_batch_size(cls, v):
+        if len(v) > MAX_BATCH_SIZE:
+            raise ValueError(f"batch may contain at most {MAX_BATCH_SIZE} types")
+        return v
+
+
 #  --- Controllers ---
 ROUTE_PREFIX = "/v1"
 
 
 class GetListResponse(pydantic.BaseModel):
-    count: int
+    count: T.Optional[int]
     items: T.List[EventOut]
+    next_cursor: T.Optional[str]
 
 
 class NotGetResponse(pydantic.BaseModel):
     status: str
 
 
-@app.get(f"{ROUTE_PREFIX}/events", response_model=GetListResponse)
-async def get_list(conn: AsyncIOMotorClient = Depends(get_database)):
-    count = await conn[DB_NAME][TABLE_EVENTS].count_documents({})
-    rows = conn[DB_NAME][TABLE_EVENTS].find({}, limit=100, skip=0)
+class BatchItem(pydantic.BaseModel):
+    type: str
+    status: str  # start: created | exists, finish: finished | not_found
+
+
+class BatchResponse(pydantic.BaseModel):
+    items: T.List[BatchItem]
+
+
+def to_naive_utc(value: T.Optional[datetime]) -> T.Optional[datetime]:
+    if value is None or value.tzinfo is None:
+        return value
+
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
 
+
+def serialize_event(row: T.Dict) -> T.Dict:
     return {
-        "count": count,
-        "items": [EventOut(id=str(row.pop("_id")), **row) async for row in rows]
+        "id": row["id"],
+        "type": row["type"],
+        "state": row["state"],
+        "started_at": row["started_at"].isoformat(),
+        "finished_at": row["finished_at"] and row["finished_at"].isoformat(),
     }
 
 
+@app.get(f"{ROUTE_PREFIX}/events", response_model=GetListResponse)
+async def get_list(
+        event_type: str = Query(None, alias="type"),
+        state: int = Query(None, ge=0, le=1),
+        cursor: str = Query(None, description="next_cursor of previous page"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, gt=0, le=MAX_PAGE_SIZE),
+        count: str = Query("exact", regex="^(exact|estimated|none)$",
+                           description="exact count of filtered events by default, estimated count ignores filters, "
+                                       "none skips counting and returns null count"),
+        output: str = Query("json", alias="format", regex="^(json|ndjson)$",
+                            description="ndjson streams all events after cursor, limit and count are ignored"),
+        since: datetime = Query(None, description="events started at or after, archived events are read "
+                                                  "only for time range"),
+        until: datetime = Query(None, description="events started before"),
+        storage: Storage = Depends(get_storage)
+):
+    since, until = to_naive_utc(since), to_naive_utc(until)
+
+    try:
+        if output == "ndjson":
+            rows = storage.iterate(event_type, state, cursor, since, until)
+            # the first row is read before response is started, so invalid cursor is still reported by status code
+            first_rows = []
+            async for row in rows:
+                first_rows.append(row)
+                break
+
+            async def export():
+                for row in first_rows:
+                    yield json.dumps(serialize_event(row)) + "\n"
+                async for row in rows:
+                    yield json.dumps(serialize_event(row)) + "\n"
+
+            return StreamingResponse(export(), media_type="application/x-ndjson")
+
+        rows = await storage.list(event_type, state, cursor, limit, since, until)
+    except InvalidCursor:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"Invalid cursor '{cursor}'")
+
+    # rows are read from our own storage, so they are serialized directly without validation by response_model
+    return JSONResponse({
+        "count": None if count == "none" else await storage.count(
+            event_type, state, estimated=count == "estimated", since=since, until=until
+        ),
+        "items": [serialize_event(row) for row in rows],
+        "next_cursor": rows[-1]["id"] if len(rows) == limit else None,
+    })
+
+
 @app.post(
     f"{ROUTE_PREFIX}/events/start",
     response_model=NotGetResponse,
@@ -93,14 +252,19 @@ async def get_list(conn: AsyncIOMotorClient = Depends(get_database)):
 )
 async def start(
         event: EventIn = Body(..., embed=False),
-        conn: AsyncIOMotorClient = Depends(get_database)
+        storage: Storage = Depends(get_storage)
 ):
-    existed = await conn[DB_NAME][TABLE_EVENTS].find_one({"type": event.type})
-    if not existed:
-        await conn[DB_NAME][TABLE_EVENTS].insert_one(EventModel(
-            type=event.type,
-            state=0
-        ).dict())
+    cache_clock = None
+    if db.cache is not None:
+        is_open, _ = db.cache.get(event.type)
+        if is_open:
+            return {"status": "success"}
+        cache_clock = db.cache.clock
+
+    event_id = await storage.start(event.type)
+
+    if db.cache is not None:
+        db.cache.set(event.type, event_id, cache_clock)
 
     return {"status": "success"}
 
@@ -111,24 +275,286 @@ async def start(
 )
 async def finish(
         event: EventIn = Body(..., embed=False),
-        conn: AsyncIOMotorClient = Depends(get_database)
+        storage: Storage = Depends(get_storage)
 ):
-    existed = await conn[DB_NAME][TABLE_EVENTS].find_one({"type": event.type})
-    if not existed:
+    event_id = None
+    if db.cache is not None:
+        _, event_id = db.cache.get(event.type)
+
+    try:
+        is_finished = await storage.finish(event.type, event_id)
+    finally:
+        # after finish, so entry stored by start, which ran concurrently and saw event still open, is dropped too
+        if db.cache is not None:
+            db.cache.discard(event.type)
+
+    if not is_finished:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail=f"Event with type '{event.type}' not found",
         )
 
-    existed = EventModel(**existed)
-    existed.state = 1
-    existed.finished_at = datetime.utcnow()
+    return {"status": "success"}
 
-    await conn[DB_NAME][TABLE_EVENTS].replace_one({"type": event.type}, existed.dict())
 
-    return {"status": "success"}
+@app.post(
+    f"{ROUTE_PREFIX}/events/start:batch",
+    response_model=BatchResponse
+)
+async def start_batch(
+        events: EventsIn = Body(..., embed=False),
+        storage: Storage = Depends(get_storage)
+):
+    """
+    Start events of all types by one storage operation. Repeated type is started only once,
+    so its later items are reported as exists
+    """
+    cache_clock = None if db.cache is None else db.cache.clock
+    event_ids = await storage.start_many(list(dict.fromkeys(events.types)))
+
+    if db.cache is not None:
+        for event_type, event_id in event_ids.items():
+            db.cache.set(event_type, event_id, cache_clock)
+
+    items = []
+    for event_type in events.types:
+        items.append({"type": event_type, "status": "created" if event_ids.pop(event_type, None) else "exists"})
+
+    return {"items": items}
+
+
+@app.post(
+    f"{ROUTE_PREFIX}/events/finish:batch",
+    response_model=BatchResponse
+)
+async def finish_batch(
+        events: EventsIn = Body(..., embed=False),
+        storage: Storage = Depends(get_storage)
+):
+    """
+    Finish events of all types by one storage operation. Repeated type is finished only once,
+    so its later items are reported as not_found
+    """
+    event_types = list(dict.fromkeys(events.types))
+    try:
+        finished = await storage.finish_many(event_types)
+    finally:
+        # after finish, see finish
+        if db.cache is not None:
+            for event_type in event_types:
+                db.cache.discard(event_type)
+
+    items = []
+    for event_type in events.types:
+        items.append({"type": event_type, "status": "finished" if event_type in finished else "not_found"})
+        finished.discard(event_type)
+
+    return {"items": items}
+
+
+async def get_metrics(request: Request):
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
 
 #  --- App Configuration ---
-app.add_event_handler("startup", connect_to_mongo)
-app.add_event_handler("shutdown", close_mongo_connection)
+if METRICS:
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.add_route("/metrics", get_metrics, include_in_schema=False)
+
+app.add_event_handler("startup", connect_to_storage)
+app.add_event_handler("shutdown", close_storage_connection)
+
+
+#  --- Tests ---
+def run_app(storages: T.Iterable[Storage], test: T.Callable[[T.Any], T.Awaitable]):
+    """
+    Run async test against app with each of storages, test gets in-process client of app
+    """
+    import asyncio
+    from loadtest import AsgiClient
+
+    async def run(storage: Storage):
+        db.storage = storage
+        try:
+            await app.router.lifespan.startup()
+            try:
+                await test(AsgiClient(app))
+            finally:
+                await app.router.lifespan.shutdown()
+        finally:
+            db.storage = None
+
+    for storage in storages:
+        asyncio.run(run(storage))
+
+
+def local_storages(tmp_path) -> T.List[Storage]:
+    return [MemoryStorage(), SqliteStorage(str(tmp_path / "events.sqlite"))]
+
+
+def test_list_pages(tmp_path):
+    async def test(client):
+        for index in range(5):
+            assert (await client.request("POST", "/v1/events/start", body={"type": f"type{index}"}))[0] == 201
+        for index in range(2):
+            assert (await client.request("POST", "/v1/events/finish", body={"type": f"type{index}"}))[0] == 200
+
+        pages, cursor = [], None
+        while True:
+            status, content = await client.request(
+                "GET", "/v1/events", {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+            )
+            assert status == 200
+            page = json.loads(content)
+            assert page["count"] == 5
+            pages.append([item["type"] for item in page["items"]])
+
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        assert pages == [["type0", "type1"], ["type2", "type3"], ["type4"]]
+
+        page = json.loads((await client.request("GET", "/v1/events", {"state": 0, "count": "none"}))[1])
+        assert page["count"] is None
+        assert [item["type"] for item in page["items"]] == ["type2", "type3", "type4"]
+
+        page = json.loads((await client.request("GET", "/v1/events", {"type": "type1", "state": 1}))[1])
+        assert page["count"] == 1
+        page = json.loads((await client.request("GET", "/v1/events", {"type": "type1", "count": "estimated"}))[1])
+        assert page["count"] == 5
+        assert page["items"][0]["finished_at"] is not None
+
+        status, content = await client.request("GET", "/v1/events", {"state": 0, "format": "ndjson"})
+        assert status == 200
+        assert [json.loads(line)["type"] for line in content.decode().splitlines()] == ["type2", "type3", "type4"]
+
+        assert (await client.request("GET", "/v1/events", {"cursor": "invalid"}))[0] == 400
+        assert (await client.request("GET", "/v1/events", {"count": "invalid"}))[0] == 422
+
+    run_app(local_storages(tmp_path), test)
+
+
+def test_open_event_cache(tmp_path, monkeypatch):
+    import pytest
+
+    monkeypatch.setitem(globals(), "OPEN_EVENT_CACHE", MODE_TTL)
+
+    async def test(client):
+        assert db.cache is not None
+        for _ in range(2):
+            assert (await client.request("POST", "/v1/events/start", body={"type": "a"}))[0] == 201
+        assert (await client.request("POST", "/v1/events/finish", body={"type": "a"}))[0] == 200
+        assert (await client.request("POST", "/v1/events/finish", body={"type": "a"}))[0] == 404
+
+        # start after finish is not lost by cache entry of the previous open event
+        assert (await client.request("POST", "/v1/events/start", body={"type": "a"}))[0] == 201
+        assert (await client.request("POST", "/v1/events/finish", body={"type": "a"}))[0] == 200
+
+        assert await db.storage.count("a", None) == 2
+
+    with pytest.raises(ValueError):
+        run_app([MemoryStorage()], test)
+
+    monkeypatch.setitem(globals(), "OPEN_EVENT_CACHE_SINGLE_INSTANCE", True)
+    run_app(local_storages(tmp_path), test)
+
+    monkeypatch.setitem(globals(), "WORKERS", 2)
+    with pytest.raises(ValueError):
+        run_app([MemoryStorage()], test)
+
+
+def test_start_during_finish(monkeypatch):
+    import asyncio
+
+    monkeypatch.setitem(globals(), "OPEN_EVENT_CACHE", MODE_TTL)
+    monkeypatch.setitem(globals(), "OPEN_EVENT_CACHE_SINGLE_INSTANCE", True)
+
+    class SlowFinishStorage(MemoryStorage):
+        async def finish(self, event_type, event_id=None):
+            self.finishing.set()
+            await self.resume.wait()
+            return await super().finish(event_type, event_id)
+
+        async def finish_many(self, event_types):
+            return {event_type for event_type in event_types if await self.finish(event_type)}
+
+    async def test(client):
+        storage = db.storage
+        storage.finishing, storage.resume = asyncio.Event(), asyncio.Event()
+        for path, body in (("/v1/events/finish", {"type": "a"}), ("/v1/events/finish:batch", {"types": ["a"]})):
+            assert (await client.request("POST", "/v1/events/start", body={"type": "a"}))[0] == 201
+            db.cache.clear()  # entry of start has expired
+            storage.finishing.clear()
+            storage.resume.clear()
+
+            # start runs while finish is in progress, sees event still open and caches it
+            finish = asyncio.ensure_future(client.request("POST", path, body=body))
+            await storage.finishing.wait()
+            assert (await client.request("POST", "/v1/events/start", body={"type": "a"}))[0] == 201
+            storage.resume.set()
+            assert (await finish)[0] == 200
+
+            # entry of finished event does not survive, so the next start creates event
+            assert db.cache.get("a") == (False, None)
+            assert (await client.request("POST", "/v1/events/start", body={"type": "a"}))[0] == 201
+            assert await storage.count("a", 0) == 1
+            assert (await client.request("POST", "/v1/events/finish", body={"type": "a"}))[0] == 200
+
+    run_app([SlowFinishStorage()], test)
+
+
+def test_metrics(tmp_path):
+    async def test(client):
+        await client.request("POST", "/v1/events/start", body={"type": "a"})
+        await client.request("POST", "/v1/events/finish", body={"type": "b"})
+        await client.request("GET", "/v1/unknown")
+
+        status, content = await client.request("GET", "/metrics")
+        assert status == 200
+
+        lines = content.decode().splitlines()
+        for labels in ('method="POST",route="/v1/events/start",status="201"',
+                       'method="POST",route="/v1/events/finish",status="404"',
+                       'method="GET",route="unmatched",status="404"'):
+            assert any(line.startswith(f"http_request_duration_seconds_count{{{labels}}} ") for line in lines), labels
+
+    run_app([MemoryStorage()], test)
+
+
+def test_batch_endpoints(tmp_path):
+    async def test(client):
+        await client.request("POST", "/v1/events/start", body={"type": "a"})
+
+        status, content = await client.request("POST", "/v1/events/start:batch", body={"types": ["a", "b", "b"]})
+        assert status == 200
+        assert json.loads(content)["items"] == [
+            {"type": "a", "status": "exists"}, {"type": "b", "status": "created"}, {"type": "b", "status": "exists"},
+        ]
+
+        status, content = await client.request("POST", "/v1/events/finish:batch", body={"types": ["b", "c", "b"]})
+        assert status == 200
+        assert json.loads(content)["items"] == [
+            {"type": "b", "status": "finished"}, {"type": "c", "status": "not_found"},
+            {"type": "b", "status": "not_found"},
+        ]
+
+        assert await db.storage.count(None, 0) == 1
+
+        too_many = {"types": [f"type{index}" for index in range(MAX_BATCH_SIZE + 1)]}
+        assert (await client.request("POST", "/v1/events/start:batch", body=too_many))[0] == 422
+
+    run_app(local_storages(tmp_path), test)
+
+
+def test_serialize_event():
+    started_at = datetime(2020, 1, 2, 3, 4, 5, 6)
+    row = {"id": "1", "type": "a", "state": 1, "started_at": started_at, "finished_at": started_at}
+
+    # direct serialization gives the same items as validation by response model
+    assert serialize_event(row) == json.loads(EventOut(**row).json())
+    assert serialize_event({**row, "state": 0, "finished_at": None})["finished_at"] is None
+
+    assert to_naive_utc(datetime(2020, 1, 2, 6, tzinfo=timezone(timedelta(hours=3)))) == datetime(2020, 1, 2, 3)
+    assert to_naive_utc(started_at) == started_at
+    assert to_naive_utc(None) is None
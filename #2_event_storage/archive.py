@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import re
+import typing as T
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from writer import DUPLICATE_KEY_ERROR
+
+#  --- Config ---
+ARCHIVE_SUFFIX = "_archive_"
+RETRY_DELAY = 10  # seconds
+
+
+#  --- Utils ---
+def archive_name(collection_name: str, created_at: datetime) -> str:
+    """
+    :return: name of archive collection of month, in which event was created
+    """
+    return f"{collection_name}{ARCHIVE_SUFFIX}{created_at.year:04d}_{created_at.month:02d}"
+
+
+def month_range(name: str, collection_name: str) -> T.Optional[T.Tuple[datetime, datetime]]:
+    """
+    :return: naive UTC start and end of month of archive collection, None if name is not archive of collection
+    """
+    match = re.fullmatch(re.escape(collection_name + ARCHIVE_SUFFIX) + r"(\d{4})_(\d{2})", name)
+    if match is None:
+        return None
+
+    year, month = int(match.group(1)), int(match.group(2))
+    return datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def archives_in_range(
+        names: T.Iterable[str],
+        collection_name: str,
+        since: T.Optional[datetime],
+        until: T.Optional[datetime]
+) -> T.List[str]:
+    """
+    :param names: collection names of database
+    :param since: naive UTC start of time range or None
+    :param until: naive UTC end of time range or None
+    :return: names of archives, which months overlap time range, in chronological order
+    """
+    archives = []
+    for name in names:
+        months = month_range(name, collection_name)
+        if months is not None and (since is None or months[1] > since) and (until is None or months[0] < until):
+            archives.append((months[0], name))
+
+    return [name for _, name in sorted(archives)]
+
+
+#  --- Archiver ---
+class Archiver:
+    """
+    Background task, which moves events finished more than max_age ago from hot collection to archive collection
+    of month of event creation (time of its _id), so hot collection keeps only open and recently finished events.
+
+    Events are moved in batches of batch_size with pause between them. Batch is inserted to archives first and
+    deleted from hot collection after that, so interrupted batch is moved again by next run and its duplicates in
+    archive are ignored. Readers of hot collection and archives see moving event at least once
+    """
+
+    def __init__(
+            self,
+            collection,
+            get_archive: T.Callable[[str], T.Any],
+            max_age: timedelta,
+            batch_size: int,
+            interval: float,
+            pause: float = 0.1
+    ):
+        """
+        :param collection: hot collection of events
+        :param get_archive: archive collection by its name
+        :param max_age: age of finished events to archive
+        :param batch_size: events moved by one batch
+        :param interval: seconds between runs
+        :param pause: seconds between batches of one run
+        """
+        self.collection = collection
+        self.get_archive = get_archive
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+
+        self.indexed: T.Set[str] = set()  # archives with ensured indexes
+        self.task: T.Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def archive(self) -> int:
+        """
+        Move all finished events older than max_age
+
+        :return: number of moved events
+        """
+        moved = 0
+        while True:
+            rows = await self.collection.find(
+                {"state": 1, "finished_at": {"$lt": datetime.utcnow() - self.max_age}},
+                sort=[("state", ASCENDING), ("finished_at", ASCENDING)],
+                limit=self.batch_size
+            ).to_list(length=self.batch_size)
+            if not rows:
+                return moved
+
+            months: T.Dict[str, T.List[T.Dict]] = {}
+            for row in rows:
+                months.setdefault(archive_name(self.collection.name, row["_id"].generation_time), []).append(row)
+
+            for name, month_rows in months.items():
+                await self._insert(name, month_rows)
+
+            await self.collection.delete_many({"_id": {"$in": [row["_id"] for row in rows]}, "state": 1})
+            moved += len(rows)
+
+            if len(rows) < self.batch_size:
+                return moved
+            await asyncio.sleep(self.pause)
+
+    async def _insert(self, name: str, rows: T.List[T.Dict]):
+        archive = self.get_archive(name)
+        if name not in self.indexed:
+            await archive.create_index([("type", ASCENDING), ("_id", ASCENDING)])
+            self.indexed.add(name)
+
+        try:
+            await archive.insert_many(rows, ordered=False)
+        except BulkWriteError as e:
+            # duplicate - event is archived by interrupted batch or by archiver of other worker
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+
+    async def _run(self):
+        while True:
+            try:
+                moved = await self.archive()
+                if moved:
+                    logging.info("Archived %s finished events", moved)
+            except PyMongoError:
+                logging.exception("Archival of finished events failed, retry in %s s", RETRY_DELAY)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            await asyncio.sleep(self.interval)
+
+
+#  --- Tests ---
+def test_archive_names():
+    assert archive_name("events", datetime(2020, 3, 31, 23, 59)) == "events_archive_2020_03"
+
+    assert month_range("events_archive_2020_03", "events") == (datetime(2020, 3, 1), datetime(2020, 4, 1))
+    assert month_range("events_archive_2020_12", "events") == (datetime(2020, 12, 1), datetime(2021, 1, 1))
+    assert month_range("events_archive_2020_3", "events") is None
+    assert month_range("other_archive_2020_03", "events") is None
+
+
+def test_archives_in_range():
+    names = ["events", "events_archive_2020_12", "events_archive_2021_02", "events_archive_2021_01", "other"]
+
+    assert archives_in_range(names, "events", None, None) == [
+        "events_archive_2020_12", "events_archive_2021_01", "events_archive_2021_02",
+    ]
+    assert archives_in_range(names, "events", datetime(2021, 1, 1), None) == [
+        "events_archive_2021_01", "events_archive_2021_02",
+    ]
+    assert archives_in_range(names, "events", datetime(2020, 12, 31), datetime(2021, 1, 1)) == [
+        "events_archive_2020_12",
+    ]
+    assert archives_in_range(names, "events", datetime(2021, 3, 1), None) == []
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+import typing as T
+from collections import OrderedDict
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+#  --- Config ---
+MODE_TTL = "ttl"
+MODE_CHANGE_STREAM = "changestream"
+WATCH_RETRY_DELAY = 1  # seconds
+
+
+#  --- Cache ---
+class OpenEventCache:
+    """
+    Per worker LRU cache of open events: type -> id of open event (None if id is unknown).
+
+    Entries are kept coherent with writes of other workers and app instances either by change stream of events
+    collection, which drops type of every updated event (ttl still applies as safety net then), or by short ttl
+    only, which is coherent only if this worker is the only writer of database, so app allows it only for single
+    worker of single instance.
+    Invalidations are numbered by clock, and entry is stored only if its type was not invalidated since database
+    operation which produced it had started, so invalidation can not be lost in between, while invalidations
+    of other types do not affect it
+    """
+
+    def __init__(self, size: int, ttl: float, mode: str = MODE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.mode = mode
+
+        self.entries: T.Dict[str, T.Tuple[T.Optional[str], float]] = OrderedDict()  # type -> id, expires at
+        # type -> clock of its last invalidation, only for recently invalidated types, the rest were invalidated
+        # at forgotten_until clock or earlier
+        self.clock = 0
+        self.invalidated_at: T.Dict[str, int] = OrderedDict()
+        self.forgotten_until = 0
+        self.is_coherent = mode == MODE_TTL  # change stream mode serves nothing until stream is opened
+        self.task: T.Optional[asyncio.Task] = None
+
+    def get(self, event_type: str) -> T.Tuple[bool, T.Optional[str]]:
+        """
+        :return: is event of type known to be open, its id
+        """
+        entry = self.entries.get(event_type) if self.is_coherent else None
+        if entry is None:
+            return False, None
+
+        event_id, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[event_type]
+            return False, None
+
+        self.entries.move_to_end(event_type)
+        return True, event_id
+
+    def set(self, event_type: str, event_id: T.Optional[str], clock: int):
+        """
+        :param event_type: type of open event
+        :param event_id: id of open event if known
+        :param clock: clock of cache before database operation, which found out that event is open
+        """
+        if self.invalidated_at.get(event_type, self.forgotten_until) > clock or not self.is_coherent:
+            return
+
+        self.entries[event_type] = (event_id, time.monotonic() + self.ttl)
+        self.entries.move_to_end(event_type)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, event_type: str):
+        self.clock += 1
+        self.invalidated_at[event_type] = self.clock
+        self.invalidated_at.move_to_end(event_type)
+        self.entries.pop(event_type, None)
+
+        while len(self.invalidated_at) > self.size:
+            _, self.forgotten_until = self.invalidated_at.popitem(last=False)
+
+    def clear(self):
+        self.clock += 1
+        self.invalidated_at.clear()
+        self.forgotten_until = self.clock
+        self.entries.clear()
+
+    def start(self, collection: AsyncIOMotorCollection):
+        if self.mode == MODE_CHANGE_STREAM:
+            self.task = asyncio.ensure_future(self._watch(collection))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _watch(self, collection: AsyncIOMotorCollection):
+        # only finished events are deleted (by archiver) and they are never cached, so deletes are not watched
+        pipeline = [{"$match": {"operationType": {"$in": ["update", "replace"]}}}]
+
+        while True:
+            try:
+                async with collection.watch(pipeline, full_document="updateLookup") as stream:
+                    self.clear()
+                    self.is_coherent = True
+
+                    async for change in stream:
+                        event_type = (change.get("fullDocument") or {}).get("type")
+                        if event_type is None:
+                            self.clear()  # event is deleted before its update is looked up, type is unknown
+                        else:
+                            self.discard(event_type)
+            except PyMongoError:
+                logging.exception("Change stream of open events cache failed, retry in %s s", WATCH_RETRY_DELAY)
+            finally:
+                self.is_coherent = False
+                self.clear()
+
+            await asyncio.sleep(WATCH_RETRY_DELAY)
+
+
+#  --- Tests ---
+def test_entries():
+    cache = OpenEventCache(size=2, ttl=60)
+
+    cache.set("a", "1", cache.clock)
+    cache.set("b", None, cache.clock)
+    assert cache.get("a") == (True, "1")
+    assert cache.get("b") == (True, None)
+
+    cache.set("c", "3", cache.clock)  # the least recently used "a" is evicted
+    assert cache.get("a") == (False, None)
+    assert cache.get("c") == (True, "3")
+
+    cache.discard("c")
+    assert cache.get("c") == (False, None)
+
+    cache.ttl = -1
+    cache.set("d", "4", cache.clock)
+    assert cache.get("d") == (False, None)
+
+
+def test_invalidation_during_operation():
+    cache = OpenEventCache(size=3, ttl=60)
+
+    # operation on type, which was invalidated while operation was in progress, does not store its result
+    clock = cache.clock
+    cache.discard("a")
+    cache.set("a", "1", clock)
+    assert cache.get("a") == (False, None)
+
+    # invalidations of other types do not affect it
+    clock = cache.clock
+    for event_type in "bcd":
+        cache.discard(event_type)
+    cache.set("a", "1", clock)
+    assert cache.get("a") == (True, "1")
+
+    # unless they are so many, that invalidation of its type during operation may be forgotten
+    clock = cache.clock
+    for event_type in "efgi":
+        cache.discard(event_type)
+    cache.set("h", "8", clock)
+    assert cache.get("h") == (False, None)
+
+    clock = cache.clock
+    cache.clear()
+    cache.set("a", "1", clock)
+    assert cache.get("a") == (False, None)
@@ -0,0 +1,451 @@
+"""
+Load test of event storage API
+
+    python loadtest.py --backend sqlite --concurrency 50 --duration 10
+    python loadtest.py --url http://localhost:8000 --concurrency 50 --requests 100000
+    python loadtest.py --serve dev prod --backend sqlite --duration 10
+
+Without --url the app is called in-process through ASGI interface, so http layer can be measured with
+local stand-in storage and no network. Memory storage never waits, so in-process requests on it are served one
+by one and concurrency has no effect, report marks such results as sequential.
+Report is json with throughput, latency percentiles and histograms per route, and the list of types with more
+than one open event after the run.
+With --serve each serving mode of main.py is started in turn and startup time is measured as well
+"""
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import typing as T
+from collections import Counter
+from urllib.parse import urlencode, urlsplit
+
+#  --- Config ---
+ROUTES = {
+    "start": ("POST", "/v1/events/start"),
+    "finish": ("POST", "/v1/events/finish"),
+    "list": ("GET", "/v1/events"),
+}
+HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)  # ms
+PERCENTILES = (50, 90, 99, 99.9)
+STARTUP_TIMEOUT = 30  # seconds
+
+
+#  --- Clients ---
+class AsgiClient:
+    """
+    Calls ASGI app in the same process and event loop
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def request(
+            self,
+            method: str,
+            path: str,
+            params: T.Optional[T.Dict] = None,
+            body: T.Optional[T.Dict] = None
+    ) -> T.Tuple[int, bytes]:
+        content = b"" if body is None else json.dumps(body).encode()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": urlencode(params or {}).encode(),
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode())],
+            "client": ("127.0.0.1", 0),
+            "server": ("loadtest", 80),
+        }
+        status, chunks = 0, []
+
+        async def receive():
+            return {"type": "http.request", "body": content, "more_body": False}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+
+        return status, b"".join(chunks)
+
+
+class HttpClient:
+    """
+    Minimal keep-alive HTTP/1.1 client on asyncio streams, one connection per client
+    """
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.reader: T.Optional[asyncio.StreamReader] = None
+        self.writer: T.Optional[asyncio.StreamWriter] = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    async def request(
+            self,
+            method: str,
+            path: str,
+            params: T.Optional[T.Dict] = None,
+            body: T.Optional[T.Dict] = None
+    ) -> T.Tuple[int, bytes]:
+        content = b"" if body is None else json.dumps(body).encode()
+        target = path + ("?" + urlencode(params) if params else "")
+
+        self.writer.write(
+            f"{method} {target} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(content)}\r\n\r\n".encode() + content
+        )
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                chunks.append(await self.reader.readexactly(size + 2))
+                if not size:
+                    break
+            response = b"".join(chunk[:-2] for chunk in chunks)
+        else:
+            response = await self.reader.readexactly(int(headers.get("content-length", 0)))
+
+        if headers.get("connection") == "close":
+            await self.close()
+            await self.connect()
+
+        return status, response
+
+
+#  --- Load ---
+class Stats:
+    def __init__(self):
+        self.latencies: T.Dict[str, T.List[float]] = {route: [] for route in ROUTES}
+        self.statuses: T.Dict[str, Counter] = {route: Counter() for route in ROUTES}
+        self.errors: Counter = Counter()
+
+    def add(self, route: str, status: int, latency: float):
+        self.latencies[route].append(latency)
+        self.statuses[route][status] += 1
+
+    def report(self, seconds: float) -> T.Dict:
+        routes = {}
+        for route, latencies in self.latencies.items():
+            if not latencies:
+                continue
+
+            latencies = sorted(latency * 1000 for latency in latencies)
+            histogram, position = {}, 0
+            for bucket in HISTOGRAM_BUCKETS:
+                while position < len(latencies) and latencies[position] <= bucket:
+                    position += 1
+                histogram[f"le_{bucket}"] = position
+            histogram["le_inf"] = len(latencies)
+
+            routes[route] = {
+                "requests": len(latencies),
+                "rps": len(latencies) / seconds,
+                "statuses": {str(status): count for status, count in sorted(self.statuses[route].items())},
+                "latency_ms": {
+                    "mean": sum(latencies) / len(latencies),
+                    **{
+                        f"p{percentile}": latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+                        for percentile in PERCENTILES
+                    },
+                    "max": latencies[-1],
+                },
+                "histogram_ms": histogram,
+            }
+
+        requests = sum(route["requests"] for route in routes.values())
+        return {
+            "seconds": seconds,
+            "requests": requests,
+            "rps": requests / seconds if seconds else None,
+            "errors": dict(self.errors),
+            "routes": routes,
+        }
+
+
+async def worker(
+        client,
+        stats: Stats,
+        deadline: float,
+        budget: T.List[int],
+        types: int,
+        mix: T.Dict[str, float],
+        generator: random.Random
+):
+    routes, weights = list(mix), list(mix.values())
+    await client.connect()
+
+    try:
+        while time.perf_counter() < deadline and budget[0] > 0:
+            budget[0] -= 1
+            route = generator.choices(routes, weights)[0]
+            method, path = ROUTES[route]
+
+            if route == "list":
+                params, body = {"limit": 100}, None
+            else:
+                params, body = None, {"type": f"type{generator.randrange(types)}"}
+
+            started_at = time.perf_counter()
+            try:
+                status, _ = await client.request(method, path, params, body)
+            except Exception as e:
+                stats.errors[type(e).__name__] += 1
+                await client.close()
+                await client.connect()
+                continue
+
+            stats.add(route, status, time.perf_counter() - started_at)
+    finally:
+        await client.close()
+
+
+async def find_duplicate_open_events(client) -> T.Dict[str, int]:
+    """
+    :return: type -> number of open events for types with more than one open event
+    """
+    await client.connect()
+    try:
+        status, content = await client.request("GET", "/v1/events", {"state": 0, "format": "ndjson"})
+    finally:
+        await client.close()
+
+    if status != 200:
+        raise RuntimeError(f"Failed to export open events, status {status}")
+
+    counts = Counter(json.loads(line)["type"] for line in content.decode().splitlines() if line)
+    return {event_type: count for event_type, count in counts.items() if count > 1}
+
+
+async def run_load(
+        client_factory: T.Callable[[], T.Any],
+        concurrency: int,
+        duration: float,
+        requests: T.Optional[int],
+        types: int,
+        mix: T.Dict[str, float],
+        seed: int = 0
+) -> T.Dict:
+    stats = Stats()
+    budget = [requests if requests is not None else float("inf")]
+    started_at = time.perf_counter()
+
+    await asyncio.gather(*(
+        worker(client_factory(), stats, started_at + duration, budget, types, mix, random.Random(seed + index))
+        for index in range(concurrency)
+    ))
+
+    report = stats.report(time.perf_counter() - started_at)
+    report["duplicate_open_types"] = await find_duplicate_open_events(client_factory())
+    report["parameters"] = {
+        "concurrency": concurrency, "duration": duration, "requests": requests, "types": types, "mix": mix,
+    }
+
+    return report
+
+
+async def run_in_process(backend: str, **options) -> T.Dict:
+    """
+    Run load against app in this process with given storage backend
+    """
+    import app as app_module
+
+    app_module.STORAGE_BACKEND = backend
+    with tempfile.TemporaryDirectory() as directory:
+        app_module.SQLITE_PATH = os.path.join(directory, "events.sqlite")
+
+        await app_module.app.router.lifespan.startup()
+        try:
+            report = await run_load(lambda: AsgiClient(app_module.app), **options)
+        finally:
+            await app_module.app.router.lifespan.shutdown()
+            app_module.db.storage = None
+
+    report["target"] = {"in_process": True, "backend": backend, "sequential": backend == "memory"}
+    if backend == "memory":
+        report["target"]["note"] = "memory storage never yields to event loop, requests were served one by one " \
+                                   "regardless of concurrency, use sqlite or mongo backend or --url to measure " \
+                                   "concurrent load"
+    return report
+
+
+async def wait_until_ready(url: str, timeout: float) -> float:
+    """
+    :return: seconds until server answered list request
+    """
+    started_at = time.perf_counter()
+    while time.perf_counter() - started_at < timeout:
+        client = HttpClient(url)
+        try:
+            await client.connect()
+            status, _ = await client.request("GET", "/v1/events", {"limit": 1})
+            if status == 200:
+                return time.perf_counter() - started_at
+        except (OSError, IndexError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            await client.close()
+
+        await asyncio.sleep(0.05)
+
+    raise TimeoutError(f"Server at {url} is not ready in {timeout} s")
+
+
+async def run_served(modes: T.List[str], backend: str, port: int, workers: T.Optional[int], **options) -> T.Dict:
+    """
+    Start server by main.py in each mode and run the same load against it
+    """
+    url = f"http://127.0.0.1:{port}"
+    reports = {}
+
+    for mode in modes:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, STORAGE_BACKEND=backend, SQLITE_PATH=os.path.join(directory, "events.sqlite"))
+            command = [sys.executable, "main.py", "--mode", mode, "--host", "127.0.0.1", "--port", str(port)]
+            if workers is not None:
+                command += ["--workers", str(workers)]
+
+            # own session, so reloader or worker processes are stopped together with server
+            server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                      start_new_session=True)
+            try:
+                startup = await wait_until_ready(url, STARTUP_TIMEOUT)
+                report = await run_load(lambda: HttpClient(url), **options)
+            finally:
+                os.killpg(server.pid, signal.SIGTERM)
+                server.wait()
+
+        report["startup_seconds"] = startup
+        reports[mode] = report
+
+    return {"target": {"served": True, "backend": backend, "workers": workers}, "modes": reports}
+
+
+def parse_mix(value: str) -> T.Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        route, _, weight = item.partition("=")
+        if route not in ROUTES:
+            raise ValueError(f"Unknown route '{route}', expected one of {', '.join(ROUTES)}")
+        mix[route] = float(weight)
+
+    return mix
+
+
+#  --- Tests ---
+def test_report():
+    stats = Stats()
+    for latency in range(1, 101):
+        stats.add("start", 201 if latency % 10 else 500, latency / 1000)
+
+    report = stats.report(2)
+    route = report["routes"]["start"]
+
+    assert report["requests"] == 100 and report["rps"] == 50
+    assert list(report["routes"]) == ["start"]
+    assert route["statuses"] == {"201": 90, "500": 10}
+    assert route["latency_ms"]["p50"] == 51 and route["latency_ms"]["max"] == 100
+    assert route["histogram_ms"]["le_50"] == 50 and route["histogram_ms"]["le_inf"] == 100
+
+    assert parse_mix("start=1,list=0.5") == {"start": 1, "list": 0.5}
+
+
+def test_run_in_process(monkeypatch):
+    import app as app_module
+
+    monkeypatch.setattr(app_module, "STORAGE_BACKEND", app_module.STORAGE_BACKEND)
+    monkeypatch.setattr(app_module, "SQLITE_PATH", app_module.SQLITE_PATH)
+
+    for backend in ("memory", "sqlite"):
+        report = asyncio.run(run_in_process(
+            backend, concurrency=10, duration=60, requests=200, types=5, mix=parse_mix("start=5,finish=4,list=1")
+        ))
+
+        assert report["requests"] == 200 and not report["errors"]
+        assert report["duplicate_open_types"] == {}
+        assert report["target"]["sequential"] == (backend == "memory")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load test of event storage API")
+    parser.add_argument("--url", default=None, help="server url, app is called in-process if omitted")
+    parser.add_argument("--serve", nargs="+", choices=("dev", "prod"), default=None,
+                        help="start server by main.py in each mode and compare them")
+    parser.add_argument("--port", type=int, default=8765, help="port of --serve servers")
+    parser.add_argument("--workers", type=int, default=None, help="workers of --serve prod server")
+    parser.add_argument("--backend", choices=("memory", "sqlite", "mongo"), default="sqlite",
+                        help="storage backend of in-process app or --serve servers, memory is per worker process "
+                             "and serves in-process requests sequentially")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--requests", type=int, default=None, help="stop after number of requests")
+    parser.add_argument("--types", type=int, default=100, help="number of distinct event types")
+    parser.add_argument("--mix", type=parse_mix, default="start=45,finish=45,list=10", help="weights of routes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="report path, stdout by default")
+    args = parser.parse_args()
+
+    options = {
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "requests": args.requests,
+        "types": args.types,
+        "mix": args.mix,
+        "seed": args.seed,
+    }
+
+    loop = asyncio.get_event_loop()
+    if args.serve is not None:
+        result = loop.run_until_complete(run_served(args.serve, args.backend, args.port, args.workers, **options))
+    elif args.url is None:
+        result = loop.run_until_complete(run_in_process(args.backend, **options))
+    else:
+        result = loop.run_until_complete(run_load(lambda: HttpClient(args.url), **options))
+        result["target"] = {"url": args.url}
+
+    output = json.dumps(result, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
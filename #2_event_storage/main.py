@@ -49,8 +49,56 @@
 Если необходимо, документ может быть расширен.
 """
 
+import importlib.util
+import multiprocessing
+import os
+
 import uvicorn
 from app import app
 
+#  --- Config ---
+WORKERS = int(os.getenv("WORKERS", multiprocessing.cpu_count()))
+
+
+def has_module(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def run_dev(host: str, port: int):
+    os.environ["WORKERS"] = "1"
+    uvicorn.run(app, host=host, port=port, reload=True, debug="true")
+
+
+def run_prod(host: str, port: int, workers: int):
+    """
+    Worker processes share listening socket, each of them imports app by its import string and opens its own
+    storage connection on startup, so MONGO_MAX_POOL_SIZE is pool size of one worker. Number of workers is passed
+    to them by WORKERS environment variable, app refuses configurations, which are not safe for many workers
+    """
+    os.environ["WORKERS"] = str(workers)
+    uvicorn.run(
+        "app:app",
+        host=host,
+        port=port,
+        workers=workers,
+        loop="uvloop" if has_module("uvloop") else "asyncio",
+        http="httptools" if has_module("httptools") else "h11",
+        log_level="warning",
+        access_log=False,
+    )
+
+
 if __name__ == '__main__':
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True, debug="true")
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Event storage server")
+    parser.add_argument("--mode", choices=("dev", "prod"), default="dev")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes of prod mode")
+    args = parser.parse_args()
+
+    if args.mode == "prod":
+        run_prod(args.host, args.port, args.workers)
+    else:
+        run_dev(args.host, args.port)
@@ -0,0 +1,372 @@
+"""
+Prometheus metrics of event storage: request latency per route, duration of MongoDB collection calls and
+state of connection pool. Metrics are rendered in Prometheus text format on /metrics
+"""
+import bisect
+import threading
+import time
+import typing as T
+
+from pymongo import monitoring
+
+#  --- Config ---
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+#  --- Metrics ---
+class Metric:
+    """
+    Metric with fixed label names, values are kept per tuple of label values.
+    Metrics are updated from event loop and from threads of MongoDB driver, so updates are under lock
+    """
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: T.Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: T.Dict[T.Tuple[str, ...], T.Any] = {}
+        self.lock = threading.Lock()
+
+    def _format_labels(self, values: T.Tuple[str, ...], extra: str = "") -> str:
+        labels = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            labels.append(extra)
+
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def _samples(self) -> T.Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        with self.lock:
+            samples = list(self._samples())
+
+        return "\n".join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *samples])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{self._format_labels(labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: T.Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)  # buckets, +Inf, sum
+
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        for labels, counts in self.values.items():
+            total = 0
+            for bucket, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                bucket_label = 'le="%s"' % bucket
+                yield f"{self.name}_bucket{self._format_labels(labels, bucket_label)} {total}"
+            yield f"{self.name}_sum{self._format_labels(labels)} {counts[-1]}"
+            yield f"{self.name}_count{self._format_labels(labels)} {total}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: T.List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Latency of http requests", ("method", "route", "status")
+))
+DB_CALL_SECONDS = REGISTRY.register(Histogram(
+    "mongo_call_duration_seconds", "Duration of MongoDB collection calls", ("operation",)
+))
+DB_CALL_ERRORS = REGISTRY.register(Counter(
+    "mongo_call_errors_total", "Failed MongoDB collection calls", ("operation",)
+))
+POOL_CHECKOUT_SECONDS = REGISTRY.register(Histogram(
+    "mongo_pool_checkout_wait_seconds", "Wait for connection from MongoDB pool"
+))
+POOL_CHECKOUT_FAILURES = REGISTRY.register(Counter(
+    "mongo_pool_checkout_failures_total", "Failed checkouts of connection from MongoDB pool", ("reason",)
+))
+POOL_IN_USE = REGISTRY.register(Gauge("mongo_pool_connections_in_use", "Connections checked out of MongoDB pool"))
+POOL_OPEN = REGISTRY.register(Gauge("mongo_pool_connections", "Open connections of MongoDB pool"))
+
+
+#  --- Http ---
+class MetricsMiddleware:
+    """
+    ASGI middleware, which records latency of each http request. Route label is path template of matched route,
+    router stores endpoint in scope of request, so it is known after request is handled
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes: T.Optional[T.Dict[T.Callable, str]] = None  # endpoint -> path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started_at, scope["method"], self._route(scope), str(status))
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+
+        if self.routes is None:
+            self.routes = {getattr(route, "endpoint", None): route.path for route in scope["router"].routes}
+
+        return self.routes.get(endpoint, "unmatched")
+
+
+#  --- MongoDB ---
+class InstrumentedCursor:
+    """
+    Motor cursor, which records time spent waiting for documents as one observation when iteration ends
+    """
+
+    def __init__(self, cursor, operation: str):
+        self.cursor = cursor
+        self.operation = operation
+        self.elapsed = 0.0
+
+    async def to_list(self, length: T.Optional[int]):
+        started_at = time.perf_counter()
+        try:
+            return await self.cursor.to_list(length=length)
+        except Exception:
+            DB_CALL_ERRORS.inc(self.operation)
+            raise
+        finally:
+            DB_CALL_SECONDS.observe(time.perf_counter() - started_at, self.operation)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        started_at = time.perf_counter()
+        try:
+            return await self.cursor.__anext__()
+        except StopAsyncIteration:
+            DB_CALL_SECONDS.observe(self.elapsed + time.perf_counter() - started_at, self.operation)
+            raise
+        except Exception:
+            DB_CALL_ERRORS.inc(self.operation)
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - started_at
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class InstrumentedCollection:
+    """
+    Motor collection, which records duration of each call in DB_CALL_SECONDS by name of method
+    """
+    COROUTINES = {
+        "bulk_write", "count_documents", "create_index", "estimated_document_count", "find_one",
+        "find_one_and_update", "insert_many", "insert_one", "update_many", "update_one", "delete_many",
+    }
+    CURSORS = {"find"}
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        if name in self.CURSORS:
+            return lambda *args, **kwargs: InstrumentedCursor(method(*args, **kwargs), name)
+
+        if name not in self.COROUTINES:
+            return method
+
+        async def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                DB_CALL_ERRORS.inc(name)
+                raise
+            finally:
+                DB_CALL_SECONDS.observe(time.perf_counter() - started_at, name)
+
+        return timed
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """
+    Connection pool events of MongoDB driver. Checkout starts and ends in the same driver thread,
+    so start time of checkout is thread local
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self.local.started_at = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        POOL_IN_USE.inc()
+        self._observe_wait()
+
+    def connection_check_out_failed(self, event):
+        POOL_CHECKOUT_FAILURES.inc(str(event.reason))
+        self._observe_wait()
+
+    def connection_checked_in(self, event):
+        POOL_IN_USE.dec()
+
+    def connection_created(self, event):
+        POOL_OPEN.inc()
+
+    def connection_closed(self, event):
+        POOL_OPEN.dec()
+
+    def _observe_wait(self):
+        started_at = getattr(self.local, "started_at", None)
+        if started_at is not None:
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started_at)
+            self.local.started_at = None
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+#  --- Tests ---
+def test_render():
+    histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(1, 2))
+    for value in (0.5, 1, 3):
+        histogram.observe(value, "/a")
+
+    assert histogram.render().splitlines() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="1"} 2',
+        'latency_seconds_bucket{route="/a",le="2"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 4.5',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+
+    registry = Registry()
+    counter = registry.register(Counter("errors_total", "Errors", ("operation",)))
+    gauge = registry.register(Gauge("in_use", "In use"))
+    counter.inc("find", amount=2)
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert registry.render() == "# HELP errors_total Errors\n# TYPE errors_total counter\n" \
+                                'errors_total{operation="find"} 2\n' \
+                                "# HELP in_use In use\n# TYPE in_use gauge\nin_use 1\n"
+
+
+def test_instrumented_collection():
+    import asyncio
+
+    import pytest
+
+    class Cursor:
+        def __init__(self, rows):
+            self.rows = iter(rows)
+
+        async def __anext__(self):
+            try:
+                return next(self.rows)
+            except StopIteration:
+                raise StopAsyncIteration
+
+    class Collection:
+        name = "events"
+
+        async def find_one(self, query):
+            return query
+
+        async def update_one(self, query, update):
+            raise ValueError("failed update")
+
+        def find(self, query):
+            return Cursor([query, query])
+
+    def count(metric: Metric, operation: str):
+        values = metric.values.get((operation,), 0)
+        return values if isinstance(values, (int, float)) else sum(values[:-1])
+
+    async def test():
+        collection = InstrumentedCollection(Collection())
+        calls = {operation: count(DB_CALL_SECONDS, operation) for operation in ("find_one", "update_one", "find")}
+        errors = count(DB_CALL_ERRORS, "update_one")
+
+        assert collection.name == "events"
+        assert await collection.find_one({"a": 1}) == {"a": 1}
+        with pytest.raises(ValueError):
+            await collection.update_one({}, {})
+        assert [row async for row in collection.find({"b": 2})] == [{"b": 2}, {"b": 2}]
+
+        # each call, including iteration of cursor, is one observation
+        assert {operation: count(DB_CALL_SECONDS, operation) - calls[operation] for operation in calls} == {
+            "find_one": 1, "update_one": 1, "find": 1,
+        }
+        assert count(DB_CALL_ERRORS, "update_one") == errors + 1
+
+    asyncio.run(test())
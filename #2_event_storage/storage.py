@@ -0,0 +1,891 @@
+import asyncio
+import bisect
+import heapq
+import logging
+import queue
+import sqlite3
+import threading
+import typing as T
+import uuid
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from archive import Archiver, archives_in_range
+from metrics import InstrumentedCollection, PoolListener
+from writer import DUPLICATE_KEY_ERROR, WriteCoalescer
+
+
+#  --- Utils ---
+class InvalidCursor(ValueError):
+    pass
+
+
+def new_event(event_type: str) -> T.Dict:
+    return {"type": event_type, "state": 0, "started_at": datetime.utcnow(), "finished_at": None}
+
+
+async def merge_sorted(iterators: T.List[T.AsyncIterator[T.Dict]], key: T.Callable[[T.Dict], T.Any]):
+    """
+    Merge of async iterators sorted by key, rows with key equal to previous one are skipped
+    """
+    heap = []
+    for index, iterator in enumerate(iterators):
+        try:
+            row = await iterator.__anext__()
+        except StopAsyncIteration:
+            continue
+        heap.append((key(row), index, row))
+    heapq.heapify(heap)
+
+    last_key = None
+    while heap:
+        row_key, index, row = heap[0]
+        if row_key != last_key:
+            yield row
+            last_key = row_key
+
+        try:
+            row = await iterators[index].__anext__()
+            heapq.heapreplace(heap, (key(row), index, row))
+        except StopAsyncIteration:
+            heapq.heappop(heap)
+
+
+#  --- Interface ---
+class Storage:
+    """
+    Storage of events. Only one not finished event of each type may exist.
+    Events are listed in order of creation by keyset pagination: cursor is id of last event of previous page,
+    since / until filter events by time of start (naive UTC)
+    """
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def start(self, event_type: str) -> T.Optional[str]:
+        """
+        Create open event of type, if there is no one
+
+        :return: id of created event, None if open event already exists or its id is unknown
+        """
+        raise NotImplementedError
+
+    async def finish(self, event_type: str, event_id: T.Optional[str] = None) -> bool:
+        """
+        Finish open event of type
+
+        :param event_type: event type
+        :param event_id: id of open event, if it is known to the caller
+        :return: False if there is no open event of type
+        """
+        raise NotImplementedError
+
+    async def start_many(self, event_types: T.List[str]) -> T.Dict[str, T.Optional[str]]:
+        """
+        Create open event of each type, which has no one
+
+        :param event_types: distinct event types
+        :return: type -> id of created event, None if open event already exists or its id is unknown
+        """
+        return {event_type: await self.start(event_type) for event_type in event_types}
+
+    async def finish_many(self, event_types: T.List[str]) -> T.Set[str]:
+        """
+        Finish open event of each type
+
+        :param event_types: distinct event types
+        :return: types, which had open event
+        """
+        return {event_type for event_type in event_types if await self.finish(event_type)}
+
+    async def list(
+            self,
+            event_type: T.Optional[str],
+            state: T.Optional[int],
+            cursor: T.Optional[str],
+            limit: int,
+            since: T.Optional[datetime] = None,
+            until: T.Optional[datetime] = None
+    ) -> T.List[T.Dict]:
+        """
+        :return: events as dicts with id, type, state, started_at, finished_at
+        """
+        raise NotImplementedError
+
+    def iterate(
+            self,
+            event_type: T.Optional[str],
+            state: T.Optional[int],
+            cursor: T.Optional[str],
+            since: T.Optional[datetime] = None,
+            until: T.Optional[datetime] = None
+    ) -> T.AsyncIterator[T.Dict]:
+        """
+        All events after cursor, see list
+        """
+        raise NotImplementedError
+
+    async def count(
+            self,
+            event_type: T.Optional[str],
+            state: T.Optional[int],
+            estimated: bool = False,
+            since: T.Optional[datetime] = None,
+            until: T.Optional[datetime] = None
+    ) -> int:
+        """
+        :param estimated: cheap estimation of total number of events, filters are ignored
+        """
+        raise NotImplementedError
+
+
+#  --- MongoDB ---
+class MongoStorage(Storage):
+    """
+    Finished events may be moved by Archiver to monthly archive collections, see archive.py.
+    List with time range reads archives of months in range as well, rows of all collections are merged by _id
+    """
+    # _id is created a bit later than started_at, so bound of _id range is wider than time range
+    ID_TIME_SLACK = timedelta(minutes=1)
+
+    def __init__(
+            self,
+            url: str,
+            db_name: str,
+            collection_name: str,
+            max_pool_size: int,
+            min_pool_size: int,
+            write_batching: bool = False,
+            write_batch_size: int = 100,
+            write_flush_interval: float = 0.002,
+            instrument: bool = False,
+            archive_after: T.Optional[timedelta] = None,
+            archive_batch_size: int = 1000,
+            archive_interval: float = 60
+    ):
+        self.url = url
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.write_batching = write_batching
+        self.write_batch_size = write_batch_size
+        self.write_flush_interval = write_flush_interval
+        self.instrument = instrument
+        self.archive_after = archive_after
+        self.archive_batch_size = archive_batch_size
+        self.archive_interval = archive_interval
+
+        self.client: T.Optional[AsyncIOMotorClient] = None
+        self.writer: T.Optional[WriteCoalescer] = None
+        self.archiver: T.Optional[Archiver] = None
+
+    def get_collection(self, name: str):
+        collection = self.client[self.db_name][name]
+        return InstrumentedCollection(collection) if self.instrument else collection
+
+    @property
+    def collection(self):
+        return self.get_collection(self.collection_name)
+
+    async def connect(self):
+        logging.info("Connect to MongoDB...")
+        self.client = AsyncIOMotorClient(
+            self.url,
+            maxPoolSize=self.max_pool_size,
+            minPoolSize=self.min_pool_size,
+            event_listeners=[PoolListener()] if self.instrument else []
+        )
+        logging.info("Connection established ！")
+
+        await self._create_open_event_index()
+        # keyset pagination of events list by _id with optional filters
+        await self.collection.create_index([("type", ASCENDING), ("_id", ASCENDING)])
+        await self.collection.create_index([("state", ASCENDING), ("_id", ASCENDING)])
+        # lookup of events finished by batch
+        await self.collection.create_index([("finish_batch", ASCENDING)], sparse=True)
+        # lookup of finished events to archive
+        await self.collection.create_index([("state", ASCENDING), ("finished_at", ASCENDING)])
+
+        if self.write_batching:
+            self.writer = WriteCoalescer(
+                self.collection,
+                new_event,
+                batch_size=self.write_batch_size,
+                flush_interval=self.write_flush_interval
+            )
+            self.writer.start()
+
+        if self.archive_after is not None:
+            self.archiver = Archiver(
+                self.collection,
+                self.get_collection,
+                max_age=self.archive_after,
+                batch_size=self.archive_batch_size,
+                interval=self.archive_interval
+            )
+            self.archiver.start()
+
+    async def _duplicate_open_events(self) -> T.Dict[str, T.List[ObjectId]]:
+        """
+        :return: type -> ids of open events in order of creation, only types with more than one open event
+        """
+        groups = self.collection.aggregate([
+            {"$match": {"state": 0}},
+            {"$sort": {"_id": ASCENDING}},
+            {"$group": {"_id": "$type", "ids": {"$push": "$_id"}}},
+            {"$match": {"ids.1": {"$exists": True}}},
+        ])
+        return {group["_id"]: group["ids"] async for group in groups}
+
+    async def _create_open_event_index(self):
+        """
+        Unique index of open events can not be built while duplicates created before it exist, so older open events
+        of each type are finished first, only the latest one is kept open as if it was started by them
+        """
+        duplicates = await self._duplicate_open_events()
+        for event_type, event_ids in duplicates.items():
+            await self.collection.update_many(
+                {"_id": {"$in": event_ids[:-1]}, "state": 0},
+                {"$set": {"state": 1, "finished_at": datetime.utcnow()}}
+            )
+            logging.warning("Finished %s duplicate open events of type '%s'", len(event_ids) - 1, event_type)
+
+        try:
+            # only one not finished event of each type, start and finish look up open event by this index
+            await self.collection.create_index(
+                [("type", ASCENDING)],
+                name="open_event_type",
+                unique=True,
+                partialFilterExpression={"state": 0},
+            )
+        except DuplicateKeyError as e:
+            # duplicates are still created by a worker, which runs without the index
+            types = sorted(await self._duplicate_open_events())
+            raise RuntimeError(f"Unique index of open events is not built, types with many open events: {types}") \
+                from e
+
+    async def close(self):
+        if self.archiver is not None:
+            await self.archiver.stop()
+            self.archiver = None
+
+        if self.writer is not None:
+            await self.writer.stop()
+            self.writer = None
+
+        logging.info("Disconnect MongoDB...")
+        self.client.close()
+        logging.info("Connection removed ！")
+
+    async def start(self, event_type: str) -> T.Optional[str]:
+        if self.writer is not None:
+            await self.writer.start_event(event_type)
+            return None
+
+        try:
+            result = await self.collection.update_one(
+                {"type": event_type, "state": 0},
+                {"$setOnInsert": new_event(event_type)},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return None  # concurrent start has just created open event, the same result for us
+
+        return result.upserted_id and str(result.upserted_id)
+
+    async def finish(self, event_type: str, event_id: T.Optional[str] = None) -> bool:
+        if self.writer is not None:
+            return await self.writer.finish_event(event_type)
+
+        update = {"$set": {"state": 1, "finished_at": datetime.utcnow()}}
+        finished = None
+
+        if event_id is not None:
+            # known id of open event - update by primary key, type lookup is needed only if it is stale
+            finished = await self.collection.find_one_and_update(
+                {"_id": ObjectId(event_id), "state": 0}, update, projection={"_id": True}
+            )
+        if not finished:
+            finished = await self.collection.find_one_and_update(
+                {"type": event_type, "state": 0}, update, projection={"_id": True}
+            )
+
+        return finished is not None
+
+    async def start_many(self, event_types: T.List[str]) -> T.Dict[str, T.Optional[str]]:
+        if not event_types:
+            return {}
+
+        requests = [
+            UpdateOne({"type": event_type, "state": 0}, {"$setOnInsert": new_event(event_type)}, upsert=True)
+            for event_type in event_types
+        ]
+        try:
+            upserted = (await self.collection.bulk_write(requests, ordered=False)).upserted_ids
+        except BulkWriteError as e:
+            # duplicate - concurrent start has just created open event, the rest of unordered bulk is applied
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+            upserted = {item["index"]: item["_id"] for item in e.details["upserted"]}
+
+        return {
+            event_type: str(upserted[index]) if index in upserted else None
+            for index, event_type in enumerate(event_types)
+        }
+
+    async def finish_many(self, event_types: T.List[str]) -> T.Set[str]:
+        if not event_types:
+            return set()
+
+        # update result has only number of finished events, so they are marked by batch id and found by it
+        batch_id = uuid.uuid4().hex
+        await self.collection.update_many(
+            {"type": {"$in": event_types}, "state": 0},
+            {"$set": {"state": 1, "finished_at": datetime.utcnow(), "finish_batch": batch_id}}
+        )
+
+        return {
+            row["type"] async for row in self.collection.find(
+                {"finish_batch": batch_id}, projection={"_id": False, "type": True}
+            )
+        }
+
+    def _query(
+            self,
+            event_type: T.Optional[str],
+            state: T.Optional[int],
+            cursor: T.Optional[str],
+            since: T.Optional[datetime] = None,
+            until: T.Optional[datetime] = None
+    ) -> T.Dict:
+        query = {}
+        if event_type is not None:
+            query["type"] = event_type
+        if state is not None:
+            query["state"] = state
+
+        id_range = {}
+        if cursor is not None:
+            try:
+                id_range["$gt"] = ObjectId(cursor)
+            except (InvalidId, TypeError):
+                raise InvalidCursor(cursor)
+        if since is not None:
+            id_range["$gte"] = ObjectId.from_datetime(since - self.ID_TIME_SLACK)
+            query["started_at"] = {"$gte": since}
+        if until is not None:
+            id_range["$lt"] = ObjectId.from_datetime(until + self.ID_TIME_SLACK)
+            query.setdefault("started_at", {})["$lt"] = until
+        if id_range:
+            query["_id"] = id_range
+
+        return query
+
+    async def _collections(self, since: T.Optional[datetime], until: T.Optional[datetime]) -> T.List:
+        """
+        :return: hot collection and archives of time range, if it is given
+        """
+        if since is None and until is None:
+            return [self.collection]
+
+        names = await self.client[self.db_name].list_collection_names()
+        return [self.collection] + [
+            self.get_collection(name) for name in archives_in_range(
+                names,
+                self.collection_name,
+                since and since - self.ID_TIME_SLACK,
+                until and until + self.ID_TIME_SLACK
+            )
+        ]
+
+    @staticmethod
+    def _row(row: T.Dict) -> T.Dict:
+        row["id"] = str(row.pop("_id"))
+        return row
+
+    def _find(self, collection, query: T.Dict, limit: int = 0):
+        return collection.find(
+            query,
+            projection={"type": True, "state": True, "started_at": True, "finished_at": True},
+            sort=[("_id", ASCENDING)],
+            limit=limit
+        )
+
+    async def list(self, event_type, state, cursor, limit, since=None, until=None):
+        query = self._query(event_type, state, cursor, since, until)
+        hot, *archives = await self._collections(since, until)
+
+        # archiver inserts event to archive before deleting it from hot collection, so hot collection is read
+        # first to see moving event at least once, duplicates are skipped by merge
+        pages = [await self._find(hot, query, limit).to_list(length=limit)]
+        pages += await asyncio.gather(
+            *(self._find(archive, query, limit).to_list(length=limit) for archive in archives)
+        )
+
+        rows = []
+        for row in heapq.merge(*pages, key=lambda row: row["_id"]):
+            if len(rows) == limit:
+                break
+            if not rows or rows[-1]["_id"] != row["_id"]:
+                rows.append(row)
+
+        return [self._row(row) for row in rows]
+
+    async def iterate(self, event_type, state, cursor, since=None, until=None):
+        query = self._query(event_type, state, cursor, since, until)
+        cursors = [self._find(collection, query) for collection in await self._collections(since, until)]
+
+        async for row in merge_sorted(cursors, key=lambda row: row["_id"]):
+            yield self._row(row)
+
+    async def count(self, event_type, state, estimated=False, since=None, until=None):
+        collections = await self._collections(since, until)
+
+        if estimated:
+            counts = [collection.estimated_document_count() for collection in collections]
+        else:
+            query = self._query(event_type, state, None, since, until)
+            counts = [collection.count_documents(query) for collection in collections]
+
+        return sum(await asyncio.gather(*counts))
+
+
+#  --- In-memory ---
+class MemoryStorage(Storage):
+    """
+    Storage in process memory with the same semantics, for tests, benchmarks of http layer and local runs.
+    Id of event is its position in creation order
+    """
+
+    def __init__(self):
+        self.events: T.List[T.Dict] = []
+        self.open: T.Dict[str, int] = {}  # type -> position of open event
+        self.by_type: T.Dict[str, T.List[int]] = {}  # type -> positions of events
+
+    async def start(self, event_type: str) -> T.Optional[str]:
+        if event_type in self.open:
+            return None
+
+        position = len(self.events)
+        self.events.append({"id": str(position), **new_event(event_type)})
+        self.open[event_type] = position
+        self.by_type.setdefault(event_type, []).append(position)
+
+        return str(position)
+
+    async def finish(self, event_type: str, event_id: T.Optional[str] = None) -> bool:
+        position = self.open.pop(event_type, None)
+        if position is None:
+            return False
+
+        self.events[position].update(state=1, finished_at=datetime.utcnow())
+        return True
+
+    def _positions(
+            self,
+            event_type: T.Optional[str],
+            state: T.Optional[int],
+            cursor: T.Optional[str],
+            since: T.Optional[datetime] = None,
+            until: T.Optional[datetime] = None
+    ) -> T.Iterator[int]:
+        try:
+            after = -1 if cursor is None else int(cursor)
+        except ValueError:
+            raise InvalidCursor(cursor)
+
+        if event_type is None:
+            positions = range(after + 1, len(self.events))
+        else:
+            positions = self.by_type.get(event_type, [])
+            positions = positions[bisect.bisect_right(positions, after):]
+
+        return (
+            position for position in positions
+            if (state is None or self.events[position]["state"] == state)
+            and (since is None or self.events[position]["started_at"] >= since)
+            and (until is None or self.events[position]["started_at"] < until)
+        )
+
+    async def list(self, event_type, state, cursor, limit, since=None, until=None):
+        rows = []
+        for position in self._positions(event_type, state, cursor, since, until):
+            if len(rows) == limit:
+                break
+            rows.append(dict(self.events[position]))
+
+        return rows
+
+    async def iterate(self, event_type, state, cursor, since=None, until=None):
+        for position in self._positions(event_type, state, cursor, since, until):
+            yield dict(self.events[position])
+
+    async def count(self, event_type, state, estimated=False, since=None, until=None):
+        if estimated:
+            return len(self.events)
+
+        return sum(1 for _ in self._positions(event_type, state, None, since, until))
+
+
+#  --- SQLite ---
+class SqliteStorage(Storage):
+    """
+    SQLite storage in WAL mode. All writes go through single writer thread, which commits all queued writes
+    in one transaction, reads run in thread pool on per thread connections
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS open_event_type ON events (type) WHERE state = 0;
+        CREATE INDEX IF NOT EXISTS events_type ON events (type, id);
+        CREATE INDEX IF NOT EXISTS events_state ON events (state, id);
+    """
+    PAGE_SIZE = 1000  # rows per read of iterate
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writes: queue.Queue = queue.Queue()
+        self.writer: T.Optional[threading.Thread] = None
+        self.local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+
+        return connection
+
+    async def connect(self):
+        logging.info("Open SQLite database %s...", self.path)
+        self._connection().executescript(self.SCHEMA)
+
+        self.writer = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+        self.writer.start()
+
+    async def close(self):
+        self.writes.put(None)
+        await asyncio.get_event_loop().run_in_executor(None, self.writer.join)
+
+    def _write_loop(self):
+        connection = self._connection()
+
+        while True:
+            writes = [self.writes.get()]
+            while not self.writes.empty() and writes[-1] is not None:
+                writes.append(self.writes.get_nowait())
+
+            is_closing = writes[-1] is None
+            if is_closing:
+                writes.pop()
+
+            try:
+                results = self._apply(connection, writes)
+            except Exception:
+                # failed write must not fail the others of transaction, so they are retried one by one
+                results = []
+                for write in writes:
+                    try:
+                        results.extend(self._apply(connection, [write]))
+                    except Exception as e:
+                        results.append(e)
+
+            for (_, _, loop, future), result in zip(writes, results):
+                if isinstance(result, Exception):
+                    loop.call_soon_threadsafe(future.set_exception, result)
+                else:
+                    loop.call_soon_threadsafe(future.set_result, result)
+
+            if is_closing:
+                return
+
+    @staticmethod
+    def _apply(connection: sqlite3.Connection, writes: T.List[T.Tuple]) -> T.List:
+        """
+        Apply writes in one transaction, which is rolled back if any of them fails
+
+        :return: results of writes
+        """
+        results = []
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for operation, args, _, _ in writes:
+                results.append(operation(connection, *args))
+            connection.execute("COMMIT")
+        except Exception:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+
+        return results
+
+    def _write(self, operation: T.Callable, *args) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.writes.put((operation, args, loop, future))
+
+        return future
+
+    def _read(self, operation: T.Callable, *args) -> asyncio.Future:
+        return asyncio.get_event_loop().run_in_executor(None, lambda: operation(self._connection(), *args))
+
+    @staticmethod
+    def _start(connection: sqlite3.Connection, event_type: str) -> T.Optional[str]:
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO events (type, state, started_at) VALUES (?, 0, ?)",
+            (event_type, datetime.utcnow().isoformat())
+        )
+        return str(cursor.lastrowid) if cursor.rowcount else None
+
+    @staticmethod
+    def _finish(connection: sqlite3.Connection, event_type: str) -> bool:
+        return connection.execute(
+            "UPDATE events SET state = 1, finished_at = ? WHERE type = ? AND state = 0",
+            (datetime.utcnow().isoformat(), event_type)
+        ).rowcount > 0
+
+    async def start(self, event_type: str) -> T.Optional[str]:
+        return await self._write(self._start, event_type)
+
+    async def finish(self, event_type: str, event_id: T.Optional[str] = None) -> bool:
+        return await self._write(self._finish, event_type)
+
+    async def start_many(self, event_types: T.List[str]) -> T.Dict[str, T.Optional[str]]:
+        return await self._write(
+            lambda connection: {event_type: self._start(connection, event_type) for event_type in event_types}
+        )
+
+    async def finish_many(self, event_types: T.List[str]) -> T.Set[str]:
+        return await self._write(
+            lambda connection: {event_type for event_type in event_types if self._finish(connection, event_type)}
+        )
+
+    @staticmethod
+    def _where(
+            event_type: T.Optional[str],
+            state: T.Optional[int],
+            cursor: T.Optional[str],
+            since: T.Optional[datetime] = None,
+            until: T.Optional[datetime] = None
+    ) -> T.Tuple[str, list]:
+        conditions, params = [], []
+        if event_type is not None:
+            conditions.append("type = ?")
+            params.append(event_type)
+        if state is not None:
+            conditions.append("state = ?")
+            params.append(state)
+        if cursor is not None:
+            try:
+                params.append(int(cursor))
+            except ValueError:
+                raise InvalidCursor(cursor)
+            conditions.append("id > ?")
+        # iso format of naive datetimes is ordered as datetimes
+        if since is not None:
+            conditions.append("started_at >= ?")
+            params.append(since.isoformat())
+        if until is not None:
+            conditions.append("started_at < ?")
+            params.append(until.isoformat())
+
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+    @staticmethod
+    def _select(connection: sqlite3.Connection, where: str, params: list, limit: int) -> T.List[T.Dict]:
+        return [
+            {
+                "id": str(row[0]),
+                "type": row[1],
+                "state": row[2],
+                "started_at": datetime.fromisoformat(row[3]),
+                "finished_at": row[4] and datetime.fromisoformat(row[4]),
+            }
+            for row in connection.execute(
+                f"SELECT id, type, state, started_at, finished_at FROM events{where} ORDER BY id LIMIT ?",
+                (*params, limit)
+            )
+        ]
+
+    async def list(self, event_type, state, cursor, limit, since=None, until=None):
+        where, params = self._where(event_type, state, cursor, since, until)
+        return await self._read(self._select, where, params, limit)
+
+    async def iterate(self, event_type, state, cursor, since=None, until=None):
+        while True:
+            rows = await self.list(event_type, state, cursor, self.PAGE_SIZE, since, until)
+            for row in rows:
+                yield row
+
+            if len(rows) < self.PAGE_SIZE:
+                return
+            cursor = rows[-1]["id"]
+
+    async def count(self, event_type, state, estimated=False, since=None, until=None):
+        if estimated:
+            # ids are never reused, so the last one is upper bound of events count
+            return await self._read(lambda connection: connection.execute(
+                "SELECT coalesce(max(id), 0) FROM events"
+            ).fetchone()[0])
+
+        where, params = self._where(event_type, state, None, since, until)
+        return await self._read(lambda connection: connection.execute(
+            f"SELECT count(*) FROM events{where}", params
+        ).fetchone()[0])
+
+
+#  --- Tests ---
+def run_with_storages(tmp_path, test: T.Callable[[Storage], T.Awaitable]):
+    """
+    Run async test against each of local storages
+    """
+    async def run(storage: Storage):
+        await storage.connect()
+        try:
+            await test(storage)
+        finally:
+            await storage.close()
+
+    for storage in (MemoryStorage(), SqliteStorage(str(tmp_path / "events.sqlite"))):
+        asyncio.run(run(storage))
+
+
+def test_concurrent_start(tmp_path):
+    async def test(storage: Storage):
+        for event_type in ("a", "b"):
+            event_ids = await asyncio.gather(*(storage.start(event_type) for _ in range(50)))
+
+            assert len([event_id for event_id in event_ids if event_id is not None]) == 1
+            assert await storage.count(event_type, 0) == 1
+
+        assert await storage.finish("a")
+        assert not await storage.finish("a")
+        assert await storage.start("a") is not None
+        assert await storage.count("a", 0) == 1
+        assert await storage.count("a", None) == 2
+
+    run_with_storages(tmp_path, test)
+
+
+def test_concurrent_start_many(tmp_path):
+    async def test(storage: Storage):
+        results = await asyncio.gather(
+            *(storage.start_many(["a", "b", "c"]) for _ in range(20)),
+            *(storage.start("b") for _ in range(20))
+        )
+        started = [result for result in results[:20] for result in result.values()] + results[20:]
+
+        assert len([event_id for event_id in started if event_id is not None]) == 3
+        assert await storage.count(None, 0) == 3
+
+    run_with_storages(tmp_path, test)
+
+
+def test_sqlite_failed_write(tmp_path):
+    import time
+
+    def fail(connection: sqlite3.Connection):
+        connection.execute("INSERT INTO events (type, state, started_at) VALUES ('c', 0, ?)", (datetime.utcnow(),))
+        raise ValueError("failed write")
+
+    async def test():
+        storage = SqliteStorage(str(tmp_path / "events.sqlite"))
+        await storage.connect()
+        try:
+            # the first write holds writer, so the rest are applied by one transaction
+            results = await asyncio.gather(
+                storage._write(lambda connection: time.sleep(0.1)),
+                storage.start("a"),
+                storage._write(fail),
+                storage.start("b"),
+                return_exceptions=True
+            )
+
+            assert results[1] is not None and results[3] is not None
+            assert isinstance(results[2], ValueError)
+            assert [row["type"] for row in await storage.list(None, 0, None, 10)] == ["a", "b"]
+        finally:
+            await storage.close()
+
+    asyncio.run(test())
+
+
+def test_list_and_iterate(tmp_path, monkeypatch):
+    import pytest
+
+    monkeypatch.setattr(SqliteStorage, "PAGE_SIZE", 2)
+
+    async def test(storage: Storage):
+        for event_type in ("a", "b", "c", "a", "b", "a"):
+            await storage.finish(event_type)
+            await storage.start(event_type)
+            await asyncio.sleep(0.001)  # distinct start times
+        started_at = [row["started_at"] for row in await storage.list(None, None, None, 10)]
+
+        rows, cursor = [], None
+        while True:
+            page = await storage.list("a", None, cursor, 2)
+            rows += page
+            if len(page) < 2:
+                break
+            cursor = page[-1]["id"]
+
+        assert [row["state"] for row in rows] == [1, 1, 0]
+        assert [row["id"] for row in rows] == [row["id"] async for row in storage.iterate("a", None, None)]
+        assert [row["type"] async for row in storage.iterate(None, 1, rows[0]["id"])] == ["b", "a"]
+
+        assert await storage.count(None, None) == 6
+        assert await storage.count(None, 0) == 3
+        assert await storage.count("b", 1) == 1
+        assert await storage.count("b", 1, estimated=True) == 6
+
+        since, until = started_at[2], started_at[4]
+        assert [row["type"] for row in await storage.list(None, None, None, 10, since, until)] == ["c", "a"]
+        assert await storage.count(None, None, since=since, until=until) == 2
+
+        with pytest.raises(InvalidCursor):
+            await storage.list(None, None, "invalid", 10)
+
+    run_with_storages(tmp_path, test)
+
+
+def test_start_many_and_finish_many(tmp_path):
+    async def test(storage: Storage):
+        await storage.start("a")
+
+        started = await storage.start_many(["a", "b", "c"])
+        assert started["a"] is None and started["b"] is not None and started["c"] is not None
+
+        assert await storage.finish_many(["a", "c", "d"]) == {"a", "c"}
+        assert await storage.finish_many(["a", "b"]) == {"b"}
+        assert await storage.count(None, 0) == 0
+
+    run_with_storages(tmp_path, test)
+
+
+def test_merge_sorted():
+    async def rows(keys: T.List[int]):
+        for key in keys:
+            yield {"_id": key}
+
+    async def test():
+        # event being archived is in hot collection and in archive at once, it is yielded once
+        iterators = [rows([1, 4, 6]), rows([]), rows([2, 4, 5]), rows([3])]
+        return [row["_id"] async for row in merge_sorted(iterators, key=lambda row: row["_id"])]
+
+    assert asyncio.run(test()) == [1, 2, 3, 4, 5, 6]
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import typing as T
+import uuid
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+#  --- Config ---
+DUPLICATE_KEY_ERROR = 11000
+
+OP_START = "start"
+OP_FINISH = "finish"
+
+
+class CoalescerStopped(RuntimeError):
+    pass
+
+
+#  --- Coalescer ---
+class WriteCoalescer:
+    """
+    Write-behind batching of start / finish operations. Operations are collected for flush_interval seconds or
+    until batch_size of them are pending and flushed as one ordered bulk_write. Batches are flushed one by one,
+    so operations on each type are applied in order of requests.
+
+    Bulk write result has no per operation counters, so finish marks the event with id of batch and index of
+    operation, and matched finishes are found by one query after bulk_write
+    """
+
+    def __init__(
+            self,
+            collection: AsyncIOMotorCollection,
+            new_event: T.Callable[[str], T.Dict],
+            batch_size: int,
+            flush_interval: float
+    ):
+        self.collection = collection
+        self.new_event = new_event
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending: T.List[T.Tuple[str, str, asyncio.Future]] = []  # operation, type, future of result
+        self.has_pending = asyncio.Event()
+        self.is_full = asyncio.Event()
+        self.is_closing = False
+        self.task: T.Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Flush pending operations and stop background task, operations submitted after that are rejected
+        """
+        self.is_closing = True
+        self.has_pending.set()
+        self.is_full.set()
+
+        await self.task
+
+    async def start_event(self, event_type: str):
+        await self._submit(OP_START, event_type)
+
+    async def finish_event(self, event_type: str) -> bool:
+        """
+        :return: False if there is no open event of this type
+        """
+        return await self._submit(OP_FINISH, event_type)
+
+    def _submit(self, operation: str, event_type: str) -> asyncio.Future:
+        if self.is_closing:
+            raise CoalescerStopped(f"Write coalescer is stopped, {operation} of '{event_type}' is rejected")
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((operation, event_type, future))
+
+        self.has_pending.set()
+        if len(self.pending) >= self.batch_size:
+            self.is_full.set()
+
+        return future
+
+    def _take_batch(self) -> T.List[T.Tuple[str, str, asyncio.Future]]:
+        batch = self.pending[:self.batch_size]
+        del self.pending[:self.batch_size]
+
+        if not self.pending and not self.is_closing:
+            self.has_pending.clear()
+        if len(self.pending) < self.batch_size and not self.is_closing:
+            self.is_full.clear()
+
+        return batch
+
+    async def _run(self):
+        while True:
+            await self.has_pending.wait()
+            try:
+                await asyncio.wait_for(self.is_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            if self.pending:
+                await self._flush(self._take_batch())
+            elif self.is_closing:
+                return
+
+    async def _flush(self, batch: T.List[T.Tuple[str, str, asyncio.Future]]):
+        batch_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        requests = [
+            UpdateOne({"type": event_type, "state": 0}, {"$setOnInsert": self.new_event(event_type)}, upsert=True)
+            if operation == OP_START else
+            UpdateOne(
+                {"type": event_type, "state": 0},
+                {"$set": {"state": 1, "finished_at": now, "finish_batch": batch_id, "finish_op": index}}
+            )
+            for index, (operation, event_type, _) in enumerate(batch)
+        ]
+        errors: T.Dict[int, Exception] = {}
+
+        try:
+            offset = 0
+            while offset < len(requests):
+                try:
+                    await self.collection.bulk_write(requests[offset:], ordered=True)
+                    break
+                except BulkWriteError as e:
+                    # ordered bulk stops at first error, the rest is retried
+                    error = e.details["writeErrors"][0]
+                    if error["code"] != DUPLICATE_KEY_ERROR:  # duplicate - concurrent start created open event
+                        errors[offset + error["index"]] = BulkWriteError(e.details)
+                    offset += error["index"] + 1
+
+            finished = set()
+            if any(operation == OP_FINISH for operation, _, _ in batch):
+                finished = {
+                    row["finish_op"] async for row in self.collection.find(
+                        {"finish_batch": batch_id}, projection={"_id": False, "finish_op": True}
+                    )
+                }
+        except Exception as e:
+            logging.exception("Failed to flush batch of %s operations", len(batch))
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for index, (operation, _, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in errors:
+                future.set_exception(errors[index])
+            else:
+                future.set_result(index in finished if operation == OP_FINISH else None)
+
+
+#  --- Tests ---
+def test_submit_after_stop():
+    import pytest
+
+    async def test():
+        coalescer = WriteCoalescer(None, lambda event_type: {"type": event_type}, batch_size=10, flush_interval=0.01)
+        coalescer.start()
+        await coalescer.stop()
+
+        with pytest.raises(CoalescerStopped):
+            await coalescer.start_event("a")
+        with pytest.raises(CoalescerStopped):
+            await coalescer.finish_event("a")
+
+    asyncio.run(test())
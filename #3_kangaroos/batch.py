@@ -0,0 +1,191 @@
+"""
+Batch mode: whitespace separated quadruples x1 v1 x2 v2 are read in chunks, checked by vectorized closed form
+of lib.find_collision and answered by YES / NO line per quadruple. Memory is bounded by chunk size, so input
+may be unbounded stream
+"""
+import typing as T
+import warnings
+
+import numpy as np
+
+# --- Config ---
+READ_CHUNK_SIZE = 1 << 24  # bytes
+MAX_ABS_VALUE = 1 << 61  # differences of values fit into int64
+
+ANSWERS = np.array([b"NO\n", b"YES\n"], dtype=object)
+WHITESPACE = b" \t\r\n\v\f"
+
+
+# --- Utils ---
+def _last_whitespace(chunk: bytes) -> int:
+    return max(chunk.rfind(whitespace) for whitespace in WHITESPACE)
+
+
+def parse_values(text: bytes) -> np.ndarray:
+    """
+    :return: int64 numbers of whitespace separated text
+    """
+    if not text or text.isspace():
+        return np.empty(0, dtype=np.int64)  # numpy parses blank text as single zero
+
+    with warnings.catch_warnings():
+        # old numpy warns instead of raising on invalid text and returns only parsed prefix
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            values = np.fromstring(text, dtype=np.int64, sep=" ")
+        except DeprecationWarning as e:
+            raise ValueError(str(e)) from e
+
+    # out of int64 values are saturated by numpy, so they fail the check too
+    if values.size and (values.min() < -MAX_ABS_VALUE or values.max() > MAX_ABS_VALUE):
+        raise ValueError(f"Values must be in range -{MAX_ABS_VALUE} : {MAX_ABS_VALUE}")
+
+    return values
+
+
+def iter_values(stream: T.BinaryIO, chunk_size: int = READ_CHUNK_SIZE) -> T.Iterator[np.ndarray]:
+    """
+    Numbers of stream by chunks, number is never split between chunks. Chunk is what is available by single read
+    up to chunk_size, so numbers of slow pipe are yielded as soon as they arrive
+
+    :param stream: binary stream
+    :param chunk_size: max bytes per read
+    """
+    read = getattr(stream, "read1", stream.read)
+    tail = b""
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+
+        chunk = tail + chunk
+        end = _last_whitespace(chunk) + 1
+        tail = chunk[end:]
+
+        if end:
+            yield parse_values(chunk[:end])
+
+    if tail:
+        yield parse_values(tail)
+
+
+def iter_queries(stream: T.BinaryIO, chunk_size: int = READ_CHUNK_SIZE) -> T.Iterator[np.ndarray]:
+    """
+    :return: int64 arrays of shape (n, 4) with rows x1, v1, x2, v2
+    """
+    rest = np.empty(0, dtype=np.int64)
+    for values in iter_values(stream, chunk_size):
+        if rest.size:
+            values = np.concatenate((rest, values))
+
+        end = values.size - values.size % 4
+        rest = values[end:]
+
+        if end:
+            yield values[:end].reshape(-1, 4)
+
+    if rest.size:
+        raise ValueError(f"Incomplete query at the end of input: {' '.join(map(str, rest))}")
+
+
+# --- Solution ---
+def collide_many(queries: np.ndarray) -> np.ndarray:
+    """
+    Vectorized lib.find_collision: kangaroos meet if and only if (x2 - x1) is divisible by (v1 - v2)
+    with non negative quotient
+
+    :param queries: int64 array of shape (n, 4) with rows x1, v1, x2, v2
+    :return: bool array of shape (n, )
+    """
+    x1, v1, x2, v2 = queries.T
+    gap = x2 - x1
+    speed = v1 - v2
+
+    same_speed = speed == 0
+    divisor = np.where(same_speed, 1, speed)
+
+    return np.where(
+        same_speed,
+        gap == 0,
+        (gap % divisor == 0) & ((gap == 0) | (np.sign(gap) == np.sign(speed)))
+    )
+
+
+def solve_stream(source: T.BinaryIO, target: T.BinaryIO, chunk_size: int = READ_CHUNK_SIZE) -> int:
+    """
+    Answer YES / NO line for each quadruple of source
+
+    :return: number of answered queries
+    """
+    answered = 0
+    for queries in iter_queries(source, chunk_size):
+        target.write(b"".join(ANSWERS[collide_many(queries).astype(np.intp)].tolist()))
+        target.flush()
+        answered += len(queries)
+
+    return answered
+
+
+# --- Tests ---
+def test_collide_many():
+    from lib import Kangaroo, find_collision
+
+    values = np.arange(-9, 10)
+    grid = np.array(np.meshgrid(values, values, values[::2], values[::3])).reshape(4, -1).T
+
+    expected = [find_collision(Kangaroo(x1, v1), Kangaroo(x2, v2)) is not None for x1, v1, x2, v2 in grid.tolist()]
+    assert collide_many(grid).tolist() == expected
+
+    # large values
+    assert collide_many(np.array([[-10 ** 18, 10 ** 9 + 1, 0, 1]])).tolist() == [True]
+
+
+def test_solve_stream():
+    import io
+
+    text = b"0 3 4 2\n0 2 5 3\n  -10000 10000\t10000 -10000\n\n7 1 7 1\n0 1 1 1"
+    for chunk_size in (1, 2, 3, 7, 1 << 10):
+        target = io.BytesIO()
+        assert solve_stream(io.BytesIO(text), target, chunk_size) == 5
+        assert target.getvalue() == b"YES\nNO\nYES\nYES\nNO\n"
+
+    target = io.BytesIO()
+    assert solve_stream(io.BytesIO(b""), target) == 0
+    assert target.getvalue() == b""
+
+
+def test_solve_stream_invalid_input():
+    import io
+
+    import pytest
+
+    with pytest.raises(ValueError):
+        solve_stream(io.BytesIO(b"0 3 4 2\n0 2 5\n"), io.BytesIO())
+
+    with pytest.raises(ValueError):
+        solve_stream(io.BytesIO(b"0 3 4 x\n"), io.BytesIO())
+
+    for value in (1 << 62, -(1 << 62), -(1 << 63), (1 << 63) - 1, 1 << 70, -(1 << 70)):
+        with pytest.raises(ValueError):
+            solve_stream(io.BytesIO(b"0 3 4 %d\n" % value), io.BytesIO())
+
+
+def test_solve_stream_answers_before_end_of_input():
+    import os
+    import threading
+
+    read_end, write_end = os.pipe()
+    answers_read, answers_write = os.pipe()
+
+    with open(read_end, "rb") as source, open(answers_write, "wb") as target:
+        thread = threading.Thread(target=solve_stream, args=(source, target))
+        thread.start()
+
+        with open(write_end, "wb", buffering=0) as queries, open(answers_read, "rb", buffering=0) as answers:
+            queries.write(b"0 3 4 2\n")
+            assert answers.read(4) == b"YES\n"  # blocks forever if answer waits for full chunk
+
+            queries.write(b"0 2 5 3\n")
+            assert answers.read(3) == b"NO\n"
+
+        thread.join()
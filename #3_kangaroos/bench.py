@@ -0,0 +1,142 @@
+"""
+Benchmark of collision search for many kangaroos
+
+    python bench.py --sizes 10000 100000 1000000 --all-sizes 1000 3000 --brute-force-sizes 1000 3000
+    python bench.py --disorder 0.0001 --sizes --all-sizes 10000 100000 --brute-force-sizes 3000
+
+Positions are spread wide enough, that no kangaroos start at the same position and the first collision needs
+jumps, otherwise search stops at trivial collision without jumps and measures only sorting.
+Search of all collisions checks all pairs if many of them cross, like with random steps, and takes time
+proportional to number of crossing pairs if few do, like with low --disorder (most of steps ordered as
+positions, like traffic).
+Results are json, so they can be stored and compared between versions
+"""
+import json
+import platform
+import random
+import sys
+import time
+import typing as T
+
+from lib import Kangaroo, find_all_collisions, find_collision, find_first_collision
+
+
+# --- Utils ---
+def generate_kangaroos(
+        count: int,
+        position_spread: int,
+        step_spread: int,
+        seed: int = 0,
+        disorder: float = 1
+) -> T.List[Kangaroo]:
+    """
+    :param disorder: share of kangaroos with random step, steps of the rest grow with position, so they never cross
+    """
+    generator = random.Random(seed)
+    positions = sorted(generator.randint(-position_spread, position_spread) for _ in range(count))
+    steps = sorted(generator.randint(-step_spread, step_spread) for _ in range(count))
+
+    for index in range(count):
+        if generator.random() < disorder:
+            steps[index] = generator.randint(-step_spread, step_spread)
+
+    kangaroos = [Kangaroo(position, step) for position, step in zip(positions, steps)]
+    generator.shuffle(kangaroos)
+
+    return kangaroos
+
+
+def measure(search: T.Callable[[], T.Any]) -> T.Tuple[float, T.Any]:
+    started_at = time.perf_counter()
+    result = search()
+    return time.perf_counter() - started_at, result
+
+
+def brute_force(kangaroos: T.List[Kangaroo]) -> int:
+    """
+    Number of colliding pairs by check of all pairs
+    """
+    return sum(
+        1 for index, first in enumerate(kangaroos) for second in kangaroos[index + 1:]
+        if find_collision(first, second) is not None
+    )
+
+
+# --- Solution ---
+def run_benchmark(
+        sizes: T.List[int],
+        all_sizes: T.List[int],
+        brute_force_sizes: T.List[int],
+        position_spread: int,
+        step_spread: int,
+        seed: int = 0,
+        disorder: float = 1
+) -> T.Dict:
+    """
+    :param sizes: numbers of kangaroos for the first collision search
+    :param all_sizes: numbers of kangaroos for search of all collisions, it is proportional to number of crossings
+    :param brute_force_sizes: numbers of kangaroos for check of all pairs
+    :return: json serializable results
+    """
+    results = {}
+
+    for size in sizes:
+        kangaroos = generate_kangaroos(size, position_spread, step_spread, seed, disorder)
+        seconds, collision = measure(lambda: find_first_collision(kangaroos))
+        results[f"first.{size}"] = {"seconds": seconds, "collision": collision and collision._asdict()}
+
+    for size in all_sizes:
+        kangaroos = generate_kangaroos(size, position_spread, step_spread, seed, disorder)
+        seconds, collisions = measure(lambda: find_all_collisions(kangaroos))
+        results[f"all.{size}"] = {"seconds": seconds, "collisions": len(collisions)}
+
+    for size in brute_force_sizes:
+        kangaroos = generate_kangaroos(size, position_spread, step_spread, seed, disorder)
+        seconds, collisions = measure(lambda: brute_force(kangaroos))
+        results[f"brute_force.{size}"] = {"seconds": seconds, "collisions": collisions}
+
+    return {
+        "environment": {"python": sys.version.split()[0], "platform": platform.platform()},
+        "parameters": {
+            "position_spread": position_spread, "step_spread": step_spread, "seed": seed, "disorder": disorder,
+        },
+        "results": results,
+    }
+
+
+# --- Tests ---
+def test_run_benchmark():
+    for disorder in (1, 0.1):
+        report = run_benchmark([100], [50], [50], position_spread=100, step_spread=10, disorder=disorder)
+
+        json.dumps(report)
+        assert report["results"]["all.50"]["collisions"] == report["results"]["brute_force.50"]["collisions"]
+
+    report = run_benchmark([1000], [], [], position_spread=10 ** 15, step_spread=10 ** 4)
+    assert report["results"]["first.1000"]["collision"]["jumps"] > 0
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark of collision search for many kangaroos")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10000, 100000, 1000000])
+    parser.add_argument("--all-sizes", type=int, nargs="*", default=[1000, 3000])
+    parser.add_argument("--brute-force-sizes", type=int, nargs="*", default=[1000, 3000])
+    parser.add_argument("--position-spread", type=int, default=10 ** 15)
+    parser.add_argument("--step-spread", type=int, default=10 ** 4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--disorder", type=float, default=1, help="share of kangaroos with random step")
+    parser.add_argument("--output", default=None, help="results path, stdout by default")
+    args = parser.parse_args()
+
+    report = json.dumps(run_benchmark(
+        args.sizes, args.all_sizes, args.brute_force_sizes, args.position_spread, args.step_spread, args.seed,
+        args.disorder
+    ), indent=2)
+
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
@@ -1,3 +1,11 @@
+import bisect
+import heapq
+import typing as T
+
+# --- Constants ---
+KINETIC_CROSSING_COST = 16  # crossing of kinetic search costs about as much as check of this many pairs
+
+
 # --- Types ---
 class Kangaroo:
     def __init__(self, initial_position: int, step: int):
@@ -8,53 +16,217 @@ class Kangaroo:
         self.position += self.step
 
 
-# --- Utils ---
-def is_one_of_kangaroos_unreachable(first: Kangaroo, second: Kangaroo) -> bool:
-    if first.position != second.position:
-        favorite, outsider = (first, second) \
-            if first.position > second.position else (second, first)
+class Collision(T.NamedTuple):
+    jumps: int
+    position: int
 
-        if favorite.step >= outsider.step:
-            return True
-    # handle situation with equal positions, but not equal steps
-    else:
-        if first.step != second.step: return True
 
-    return False
+class PairCollision(T.NamedTuple):
+    jumps: int
+    position: int
+    first: int  # index of kangaroo, first < second
+    second: int
 
 
 # --- Solution ---
-MAX_POSITION = 10000
+def find_collision(first: Kangaroo, second: Kangaroo) -> T.Optional[Collision]:
+    """
+    After n jumps positions are x1 + n * v1 and x2 + n * v2, so kangaroos meet if and only if
+    (x2 - x1) is divisible by (v1 - v2) with non negative quotient n. Valid for any integers
+
+    :return: the first collision or None if kangaroos never meet
+    """
+    gap = second.position - first.position
+    speed = first.step - second.step
+
+    if speed == 0:
+        # the same step - distance never changes
+        return Collision(0, first.position) if gap == 0 else None
+
+    jumps, remainder = divmod(gap, speed)
+    if remainder != 0 or jumps < 0:
+        return None
+
+    return Collision(jumps, first.position + jumps * first.step)
 
 
 def will_kangaroos_collide(first: Kangaroo, second: Kangaroo) -> bool:
-    while first.position < MAX_POSITION and second.position < MAX_POSITION:
-        if first.position == second.position:
-            return True
+    return find_collision(first, second) is not None
 
-        if is_one_of_kangaroos_unreachable(first, second): break
 
-        first.jump()
-        second.jump()
+# --- Many kangaroos ---
+class _Time:
+    """
+    Exact rational time of crossing, compared by cross multiplication of ints, so huge positions and steps
+    neither lose precision nor overflow float. It is compared only if whole parts of times are equal
+    """
+    __slots__ = ("numerator", "denominator")
 
-    return False
+    def __init__(self, numerator: int, denominator: int):
+        self.numerator = numerator
+        self.denominator = denominator  # positive
 
+    def __lt__(self, other: "_Time") -> bool:
+        return self.numerator * other.denominator < other.numerator * self.denominator
 
-# --- Tests ---
-def test_is_one_of_kangaroos_unreachable():
-    # simple
-    assert is_one_of_kangaroos_unreachable(Kangaroo(0, 2), Kangaroo(5, 3)) is True
 
-    # position is greater, step is lower
-    assert is_one_of_kangaroos_unreachable(Kangaroo(9, 2), Kangaroo(5, 3)) is False
+def _start_groups(kangaroos: T.Sequence[Kangaroo], order: T.List[int]) -> T.Iterator[T.List[int]]:
+    """
+    :param order: indexes of kangaroos sorted by position
+    :return: groups of kangaroos with the same initial position, they collide without jumps
+    """
+    start = 0
+    for end in range(1, len(order) + 1):
+        if end == len(order) or kangaroos[order[end]].position != kangaroos[order[start]].position:
+            if end - start > 1:
+                yield order[start:end]
+            start = end
+
+
+def _crossings(kangaroos: T.Sequence[Kangaroo], order: T.List[int]) -> T.Iterator[PairCollision]:
+    """
+    Kinetic sorted order: kangaroos are kept in order of position just after current time, the next change of
+    order is crossing of adjacent pair, which is the earliest in heap of crossing times of adjacent pairs.
+    Every crossing pair becomes adjacent when it crosses, so each crossing is found by swap of adjacent pair.
+    Crossing at integer time is collision, kangaroos pass each other without meeting otherwise
+
+    :param order: indexes of kangaroos sorted by (position, step) - order just after start
+    :return: collisions after start in order of time
+    """
+    positions = [kangaroo.position for kangaroo in kangaroos]
+    steps = [kangaroo.step for kangaroo in kangaroos]
+    order = list(order)
+    places = [0] * len(order)  # index of kangaroo -> its place in order
+    for place, index in enumerate(order):
+        places[index] = place
+
+    def crossing(left: int, right: int):
+        gap, speed = positions[right] - positions[left], steps[left] - steps[right]
+        return gap // speed, _Time(gap, speed), left, right
+
+    heap = [crossing(left, right) for left, right in zip(order, order[1:]) if steps[left] > steps[right]]
+    heapq.heapify(heap)
+
+    while heap:
+        _, time, left, right = heapq.heappop(heap)
+        place = places[left]
+        if place + 1 == len(order) or order[place + 1] != right:
+            continue  # pair is not adjacent anymore
+
+        jumps, remainder = divmod(time.numerator, time.denominator)
+        if remainder == 0:
+            yield PairCollision(jumps, positions[left] + steps[left] * jumps, min(left, right), max(left, right))
+
+        order[place], order[place + 1] = right, left
+        places[right], places[left] = place, place + 1
+
+        if place > 0 and steps[order[place - 1]] > steps[right]:
+            heapq.heappush(heap, crossing(order[place - 1], right))
+        if place + 2 < len(order) and steps[left] > steps[order[place + 2]]:
+            heapq.heappush(heap, crossing(left, order[place + 2]))
+
+
+def _count_crossings(steps: T.List[int]) -> int:
+    """
+    Number of pairs, which cross after start, by Fenwick tree over ranks of steps, O(n * log(n))
+
+    :param steps: steps of kangaroos in order of (position, step)
+    :return: pairs with greater step behind smaller one
+    """
+    ranks = sorted(set(steps))
+    tree = [0] * (len(ranks) + 1)  # counts of seen steps by rank
+    crossings = 0
+
+    for seen, step in enumerate(steps):
+        rank = bisect.bisect_right(ranks, step)
+        not_greater = 0
+        position = rank
+        while position > 0:
+            not_greater += tree[position]
+            position -= position & -position
+        crossings += seen - not_greater
+
+        while rank < len(tree):
+            tree[rank] += 1
+            rank += rank & -rank
+
+    return crossings
+
+
+def _pairwise_collisions(kangaroos: T.Sequence[Kangaroo]) -> T.Iterator[PairCollision]:
+    """
+    Collisions by closed form check of every pair, see find_collision, O(n ** 2)
+    """
+    positions = [kangaroo.position for kangaroo in kangaroos]
+    steps = [kangaroo.step for kangaroo in kangaroos]
+
+    for first, (first_position, first_step) in enumerate(zip(positions, steps)):
+        for second in range(first + 1, len(positions)):
+            gap, speed = positions[second] - first_position, first_step - steps[second]
+            if speed == 0:
+                if gap == 0:
+                    yield PairCollision(0, first_position, first, second)
+                continue
+
+            jumps, remainder = divmod(gap, speed)
+            if remainder == 0 and jumps >= 0:
+                yield PairCollision(jumps, first_position + jumps * first_step, first, second)
+
+
+def iter_collisions(kangaroos: T.Sequence[Kangaroo]) -> T.Iterator[PairCollision]:
+    """
+    All colliding pairs of kangaroos in order of time of collision, O((n + k) * log(n)) for k crossing pairs.
+    Pair with the same position and step is reported once, as collision without jumps
+    """
+    order = sorted(range(len(kangaroos)), key=lambda index: (kangaroos[index].position, kangaroos[index].step))
+
+    for group in _start_groups(kangaroos, order):
+        for place, first in enumerate(group):
+            for second in group[place + 1:]:
+                yield PairCollision(0, kangaroos[first].position, min(first, second), max(first, second))
+
+    yield from _crossings(kangaroos, order)
+
+
+def find_first_collision(kangaroos: T.Sequence[Kangaroo]) -> T.Optional[PairCollision]:
+    """
+    The earliest collision of any pair, ties are broken by position and then by indexes of kangaroos
+
+    :return: collision or None if no pair ever meets
+    """
+    order = sorted(range(len(kangaroos)), key=lambda index: (kangaroos[index].position, kangaroos[index].step))
+
+    groups = list(_start_groups(kangaroos, order))
+    if groups:
+        return min(PairCollision(0, kangaroos[group[0]].position, *sorted(group)[:2]) for group in groups)
+
+    first = None
+    for collision in _crossings(kangaroos, order):
+        if first is not None and collision.jumps > first.jumps:
+            break
+        if first is None or collision < first:
+            first = collision
+
+    return first
+
 
-    # equal positions, equal steps
-    assert is_one_of_kangaroos_unreachable(Kangaroo(0, 2), Kangaroo(0, 2)) is False
+def find_all_collisions(kangaroos: T.Sequence[Kangaroo]) -> T.List[PairCollision]:
+    """
+    Kinetic search visits each crossing pair at much higher cost than closed form check of pair, so it is used only
+    if few pairs cross, like in traffic, and all pairs are checked otherwise
 
-    # equal positions, not equal steps
-    assert is_one_of_kangaroos_unreachable(Kangaroo(0, 2), Kangaroo(0, 3)) is True
+    :return: all colliding pairs sorted by time, position and indexes
+    """
+    order = sorted(range(len(kangaroos)), key=lambda index: (kangaroos[index].position, kangaroos[index].step))
+    crossings = _count_crossings([kangaroos[index].step for index in order])
 
+    if crossings * KINETIC_CROSSING_COST < len(kangaroos) * (len(kangaroos) - 1) // 2:
+        return sorted(iter_collisions(kangaroos))
 
+    return sorted(_pairwise_collisions(kangaroos))
+
+
+# --- Tests ---
 def test_will_kangaroos_collide():
     # simple success
     assert will_kangaroos_collide(Kangaroo(0, 3), Kangaroo(4, 2)) is True
@@ -62,5 +234,134 @@ def test_will_kangaroos_collide():
     # simple failure
     assert will_kangaroos_collide(Kangaroo(0, 2), Kangaroo(5, 3)) is False
 
-    # max position abortion
-    assert will_kangaroos_collide(Kangaroo(MAX_POSITION - 1, 10), Kangaroo(MAX_POSITION + 1, 3)) is False
+    # gap is not divisible by difference of steps
+    assert will_kangaroos_collide(Kangaroo(9999, 10), Kangaroo(10001, 3)) is False
+
+    # meeting point far beyond start positions
+    assert will_kangaroos_collide(Kangaroo(9999, 10), Kangaroo(10001, 8)) is True
+
+    # negative steps
+    assert will_kangaroos_collide(Kangaroo(0, -2), Kangaroo(-6, -5)) is False
+    assert will_kangaroos_collide(Kangaroo(0, -5), Kangaroo(-6, -2)) is True
+
+
+def test_find_collision():
+    assert find_collision(Kangaroo(0, 3), Kangaroo(4, 2)) == Collision(4, 12)
+
+    # the same position - collision without jumps
+    assert find_collision(Kangaroo(7, 3), Kangaroo(7, 3)) == Collision(0, 7)
+    assert find_collision(Kangaroo(7, 3), Kangaroo(7, -3)) == Collision(0, 7)
+
+    # the same step, different positions
+    assert find_collision(Kangaroo(0, 3), Kangaroo(1, 3)) is None
+
+    # kangaroos moved away from each other
+    assert find_collision(Kangaroo(4, 3), Kangaroo(0, 2)) is None
+
+    # negative steps and positions
+    assert find_collision(Kangaroo(0, -5), Kangaroo(-6, -2)) == Collision(2, -10)
+
+    # arbitrary integers
+    assert find_collision(Kangaroo(-10 ** 30, 10 ** 20 + 1), Kangaroo(0, 1)) == Collision(10 ** 10, 10 ** 10)
+
+
+def simulate_collision(first: Kangaroo, second: Kangaroo, max_jumps: int) -> T.Optional[Collision]:
+    """
+    Reference jump by jump simulation
+    """
+    first, second = Kangaroo(first.position, first.step), Kangaroo(second.position, second.step)
+
+    for jumps in range(max_jumps + 1):
+        if first.position == second.position:
+            return Collision(jumps, first.position)
+
+        first.jump()
+        second.jump()
+
+    return None
+
+
+def brute_force_collisions(kangaroos: T.Sequence[Kangaroo]) -> T.List[PairCollision]:
+    """
+    Reference check of all pairs
+    """
+    collisions = []
+    for first in range(len(kangaroos)):
+        for second in range(first + 1, len(kangaroos)):
+            collision = find_collision(kangaroos[first], kangaroos[second])
+            if collision is not None:
+                collisions.append(PairCollision(collision.jumps, collision.position, first, second))
+
+    return sorted(collisions)
+
+
+def test_find_collision_matches_simulation():
+    values = range(-12, 13)
+
+    # meeting needs at most 24 jumps - maximal gap divided by minimal difference of steps
+    for x1 in values:
+        for v1 in values:
+            for x2 in values[::3]:
+                for v2 in values[::2]:
+                    first, second = Kangaroo(x1, v1), Kangaroo(x2, v2)
+                    assert find_collision(first, second) == simulate_collision(first, second, 24), (x1, v1, x2, v2)
+
+
+def test_find_all_collisions():
+    kangaroos = [Kangaroo(0, 3), Kangaroo(4, 2), Kangaroo(0, 2), Kangaroo(20, 0), Kangaroo(4, 2)]
+
+    assert find_all_collisions(kangaroos) == [
+        PairCollision(0, 0, 0, 2),
+        PairCollision(0, 4, 1, 4),
+        PairCollision(4, 12, 0, 1),
+        PairCollision(4, 12, 0, 4),
+        PairCollision(8, 20, 1, 3),
+        PairCollision(8, 20, 3, 4),
+        PairCollision(10, 20, 2, 3),
+    ]
+    assert find_first_collision(kangaroos) == PairCollision(0, 0, 0, 2)
+    assert find_first_collision(kangaroos[1:2] + kangaroos[3:]) == PairCollision(0, 4, 0, 2)
+
+    # crossing between jumps is not collision
+    assert find_all_collisions([Kangaroo(0, 2), Kangaroo(1, 0)]) == []
+    assert find_first_collision([Kangaroo(0, 2), Kangaroo(1, 0), Kangaroo(5, -1)]) == PairCollision(4, 1, 1, 2)
+
+    # three kangaroos meet at the same point
+    assert find_all_collisions([Kangaroo(-2, 1), Kangaroo(0, 0), Kangaroo(2, -1)]) == [
+        PairCollision(2, 0, 0, 1), PairCollision(2, 0, 0, 2), PairCollision(2, 0, 1, 2)
+    ]
+
+    assert find_first_collision([]) is None
+    assert find_all_collisions([Kangaroo(1, 1)]) == []
+
+
+def test_find_all_collisions_matches_brute_force():
+    import random
+
+    generator = random.Random(0)
+    for size in (2, 3, 5, 10, 50, 200):
+        for spread in (3, 20, 1000, 10 ** 18, 10 ** 400):  # the last one is beyond float range
+            kangaroos = [
+                Kangaroo(generator.randint(-spread, spread), generator.randint(-spread // 3 - 1, spread // 3 + 1))
+                for _ in range(size)
+            ]
+            expected = brute_force_collisions(kangaroos)
+
+            assert find_all_collisions(kangaroos) == expected, (size, spread)
+            assert sorted(iter_collisions(kangaroos)) == expected, (size, spread)
+            assert find_first_collision(kangaroos) == (expected[0] if expected else None), (size, spread)
+
+            order = sorted(range(size), key=lambda index: (kangaroos[index].position, kangaroos[index].step))
+            assert _count_crossings([kangaroos[index].step for index in order]) == sum(
+                1 for place, first in enumerate(order) for second in order[place + 1:]
+                if kangaroos[first].step > kangaroos[second].step
+            )
+
+
+def test_find_all_collisions_with_few_crossings():
+    # steps grow with position except one slow kangaroo, so kinetic search is chosen
+    kangaroos = [Kangaroo(position * 10, position) for position in range(100)] + [Kangaroo(995, 0)]
+    expected = brute_force_collisions(kangaroos)
+
+    assert find_all_collisions(kangaroos) == expected
+    assert expected == [PairCollision(189, 995, 5, 100), PairCollision(985, 995, 1, 100)]
@@ -22,6 +22,13 @@ Stdin с четырьми целыми числами, разделенными
 В stdout YES, если кенгуру могут встретится в одном месте в одно и тоже время. И NO в
 обратном случае.
 
+### Пакетный режим
+
+    python main.py --batch [файл ...]
+
+Четверки x1 v1 x2 v2, разделенные пробельными символами, читаются из файлов или stdin, в stdout
+пишется YES или NO отдельной строкой на каждую четверку.
+
 ### Примеры​
 
 Вход: 0 3 4 2
@@ -38,6 +45,19 @@ import sys
 if __name__ == '__main__':
     args = sys.argv[1:]
 
+    # batch mode: python main.py --batch [file ...] - quadruples from files or stdin, answer per line to stdout
+    if args and args[0] == "--batch":
+        from batch import solve_stream
+
+        for path in args[1:] or ["-"]:
+            if path == "-":
+                solve_stream(sys.stdin.buffer, sys.stdout.buffer)
+            else:
+                with open(path, "rb") as source:
+                    solve_stream(source, sys.stdout.buffer)
+
+        sys.exit()
+
     if len(args) != 4:
         raise ValueError("Must be 4 arguments!")
 